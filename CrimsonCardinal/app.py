@@ -1,23 +1,83 @@
 import logging
-from flask import Flask, request, render_template, jsonify, send_from_directory, url_for
+from flask import Flask, Request, request, render_template, jsonify, redirect, send_from_directory, send_file, url_for
 import os
-import imageio.v2 as imageio
+import json
+import sys
+import tempfile
+import zipfile
+from io import BytesIO
 import numpy as np
-from matplotlib import pyplot as plt
-from matplotlib.colors import LinearSegmentedColormap
-from matplotlib import cm
 
 from PIL import Image
 
-plt.switch_backend('Agg')
+from index_stats import DEFAULT_PERCENTILES, QuantileSketch, StreamingStats
+from change_detection import COMPARE_MODES, date_offsets, write_changes
+import zonal_stats
+from zonal_stats import ZonalStats
+from jobs import JobQueue, QueueFull
+import metrics
+from raster_io import OUTPUT_FORMATS, PngStripWriter, TilePyramidWriter, encode_image, read_raster, write_float_npy, write_float_tiff
+import result_cache
+import upload_store
+
+# The index library is shared with SpectralSparrow and lives at the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from vegetation_indices import INDICES, band_layout, make_plan, read_bands
+from vegetation_indices.render import ColorbarCache, apply_lut, colorbar_footer, colormap_lut, finite_range, render_colorbar, scan
 
 app = Flask(__name__)
-app.config['UPLOAD_FOLDER'] = 'uploads'
-app.config['RESULT_FOLDER'] = 'static/results'
+app.config['RESULT_FOLDER'] = os.path.join(app.root_path, 'static', 'results')
+app.config['BAND_DTYPE'] = 'float32'  # 'float64' for full double precision
+# Named band orders for sensors other than the RGN/NGB/RGB cameras, usable as
+# image_type; requests can also name the channels directly ('B,G,R,NIR,RE')
+app.config['BAND_LAYOUTS'] = {}  # e.g. {'RedEdge-MX': ('B', 'G', 'R', 'NIR', 'RE')}
+app.config['COLORBAR_CACHE_SIZE'] = 32
+app.config['COLORBAR_CACHE_FOLDER'] = None  # e.g. 'cache/colorbars' to keep strips across restarts
+# Value range the colormap spans: 'minmax' (the frame's own), 'percentile'
+# (clipped at CLIP_PERCENTILES) or 'fixed' (the index's range in the registry);
+# requests can override all three
+app.config['NORMALIZE'] = 'minmax'
+app.config['CLIP_PERCENTILES'] = (2, 98)
+app.config['SYMMETRIC_RANGE'] = False  # center the range on 0, at ±max(|low|, |high|)
+app.config['TILED_MIN_PIXELS'] = 64_000_000  # frames this large are processed in row strips
+app.config['TILE_PIXELS'] = 8_000_000  # pixels per strip in tiled mode
+app.config['TILED_COLORBAR_MAX_WIDTH'] = 4096
+app.config['SERIES_TILE_PIXELS'] = 1_000_000  # pixels per strip when comparing dates; every date is read a strip at a time
+app.config['RESULT_CACHE_MAX_BYTES'] = 2 * 1024 ** 3  # least recently used results are evicted above this
+app.config['RESULT_MAX_AGE'] = 365 * 24 * 3600  # result names are content-addressed, so they never change
+app.config['OUTPUT_FORMAT'] = 'png'  # 'png', 'jpeg', 'webp' or 'webp_lossless'; requests can override
+app.config['OUTPUT_QUALITY'] = 90  # JPEG and lossy WebP
+app.config['PNG_COMPRESS_LEVEL'] = 6  # zlib level 0-9, also sets lossless WebP effort
+app.config['PNG_FILTER'] = 'sub'  # 'none' encodes faster but produces larger files
+app.config['ENCODE_WORKERS'] = os.cpu_count() or 1  # threads deflating PNG strips
+app.config['PREVIEW_MAX_SIZE'] = 1024  # long side of the quick preview /jobs returns before the full render
+app.config['TILE_PYRAMIDS'] = True  # /jobs cuts full renders into 256 px zoom tiles for the pan-and-zoom view
+app.config['UPLOAD_SPOOL_BYTES'] = 64 * 1024 ** 2  # larger uploads spill to an anonymous temporary file
+app.config['UPLOAD_CACHE_FOLDER'] = os.path.join(app.root_path, 'upload_cache')  # decoded uploads, reused through their upload_id
+app.config['UPLOAD_CACHE_MAX_BYTES'] = 4 * 1024 ** 3
+app.config['UPLOAD_CACHE_TTL'] = 6 * 3600  # seconds since an upload was last used
+app.config['SHARED_BANDS'] = True  # /process_batch maps float bands converted once per upload (kept in the upload cache) instead of copying them per request
+app.config['ZONE_CACHE_FOLDER'] = os.path.join(app.root_path, 'zone_cache')  # rasterized plot layouts, reused through their layout_id
+app.config['ZONE_CACHE_MAX_BYTES'] = 1024 ** 3
+app.config['MAX_ZONES'] = 10_000  # per layout; each zone keeps ~16 KiB of percentile counters per index
+app.config['JOB_FOLDER'] = os.path.join(app.root_path, 'jobs')
+app.config['JOB_WORKERS'] = 2  # render processes per app worker
+app.config['JOB_QUEUE_SIZE'] = 8  # queued + running jobs before /jobs answers 429
+app.config['METRICS_ENABLED'] = True  # per-stage timings on /metrics and in the 'timing' log
+app.config['PREWARM'] = True  # wsgi.py loads matplotlib, fonts, LUTs and numexpr before serving (see prewarm)
 app.secret_key = "supersecretkey"
 
-os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 os.makedirs(app.config['RESULT_FOLDER'], exist_ok=True)
+os.makedirs(app.config['UPLOAD_CACHE_FOLDER'], exist_ok=True)
+os.makedirs(app.config['ZONE_CACHE_FOLDER'], exist_ok=True)
+
+class SpooledRequest(Request):
+    # Werkzeug spills every upload over 500 KB to disk; keep camera frames in
+    # memory so they are decoded straight from the request
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return tempfile.SpooledTemporaryFile(max_size=app.config['UPLOAD_SPOOL_BYTES'], mode='rb+')
+
+app.request_class = SpooledRequest
 
 # Setup basic logging
 logging.basicConfig(level=logging.DEBUG)
@@ -26,246 +86,14 @@ logging.basicConfig(level=logging.DEBUG)
 def favicon():
     return send_from_directory(os.path.join(app.root_path, 'templates'), 'favicon.ico', mimetype='image/vnd.microsoft.icon')
 
-# === Index calculation functions (unchanged) ===
-def calculate_ndvi(NIR, R):
-    return np.true_divide(np.subtract(NIR, R), np.add(NIR, R))
-
-def calculate_ndvi_ngb(NIR, B):
-    return np.true_divide(np.subtract(NIR, B), np.add(NIR, B))
-
-def calculate_endvi(NIR, G, B):
-    NIRG = np.add(NIR, G)
-    return np.true_divide(np.subtract(NIRG, 2*B), np.add(NIRG, 2*B))
-
-def calculate_endvi_rgn(NIR, R, G):
-    NIRR = np.add(NIR, R)
-    return np.true_divide(np.subtract(NIRR, 2*G), np.add(NIRR, 2*G))
-
-def calculate_savi(NIR, R, L=0.5):
-    NIRminusR = np.subtract(NIR, R)
-    NIRplusRplusL = np.add(np.add(NIR, R), L)
-    return np.multiply(np.true_divide(NIRminusR, NIRplusRplusL), (1 + L))
-
-def calculate_tvi(NIR, R, G):
-    return 0.5 * (120 * (NIR - G) - 200 * (R - G))
-
-def calculate_gndvi(NIR, G):
-    return np.true_divide(np.subtract(NIR, G), np.add(NIR, G))
-
-def calculate_msavi(NIR, R):
-    return 0.5 * (2 * NIR + 1 - np.sqrt((2 * NIR + 1) ** 2 - 8 * (NIR - R)))
-
-def calculate_cvi(NIR, R):
-    return np.true_divide(NIR, R) - 1
-
-def calculate_cvi2(NIR, R, G):
-    return np.true_divide(np.multiply(NIR, R), np.square(G))
-
-def calculate_pri(NIR, R):
-    return np.true_divide(np.subtract(NIR, R), np.add(NIR, R))
-
-def calculate_ndwi(G, NIR):
-    return np.true_divide(np.subtract(G, NIR), np.add(G, NIR))
-
-def calculate_vari(G, R, B):
-    return np.true_divide(np.subtract(G, R), np.add(np.subtract(G, R), B))
-
-def calculate_evi(NIR, R, B):
-    return 2.5 * np.true_divide(np.subtract(NIR, R), np.add(np.add(NIR, 6 * R), np.add(-7.5 * B, 1)))
-
-def calculate_ng(G, NIR, R):
-    return np.true_divide(G, np.add(np.add(NIR, R), G))
-
-# === New RGB indices ===
-def calculate_ngrdi(G, R):
-    return np.true_divide(np.subtract(G, R), np.add(G, R))
-
-def calculate_exg(G, R, B):
-    return 2 * G - R - B
-
-def calculate_exr(R, G):
-    return 1.4 * R - G
-
-def calculate_exgr(G, R, B):
-    return (2 * G - R - B) - (1.4 * R - G)
-
-def calculate_gli(G, R, B):
-    numerator = 2 * G - R - B
-    denominator = 2 * G + R + B
-    return np.true_divide(numerator, denominator)
-
-def calculate_gli2(G, R, B):
-    numerator = (G - R) + (G - B)
-    denominator = 2 * G + R + B
-    return np.true_divide(numerator, denominator)
-
-def calculate_rgbvi(G, R, B):
-    return np.true_divide(np.square(G) - np.multiply(R, B), np.square(G) + np.multiply(R, B))
-
-def calculate_tgi(R, G, B):
-    return -0.5 * ((660 - 550) * (R - G) - (660 - 480) * (R - B))
-
-def calculate_ngbdi(G, B):
-    return np.true_divide(np.subtract(G, B), np.add(G, B))
-
-def calculate_vdvi(G, R, B):
-    numerator = 2 * G - R - B
-    denominator = 2 * G + R + B
-    return np.true_divide(numerator, denominator)
-
-def calculate_mexg(G, R, B):
-    return 1.262 * G - 0.884 * R - 0.311 * B
-
-def calculate_veg(G, R, B):
-    return np.true_divide(G, (np.power(R, 0.667) * np.power(B, 0.333)))
-
-def calculate_gcc(G, R, B):
-    return np.true_divide(G, np.add(np.add(R, G), B))
-
-def calculate_cive(R, G, B):
-    return 0.441 * R - 0.811 * G + 0.385 * B + 18.78745
-
-def calculate_ndti(R, G):
-    return np.true_divide(np.subtract(R, G), np.add(R, G))
-
-def calculate_sci(R, G):
-    return np.true_divide(np.subtract(R, G), np.add(R, G))
-
-def calculate_ndbi(R, G):
-    return np.true_divide(np.subtract(R, G), np.add(R, G))
-
-def calculate_bi(R, G, B):
-    return np.sqrt((np.square(R) + np.square(G) + np.square(B)) / 3)
-
-def calculate_ui(R, B):
-    return np.true_divide(R, np.add(np.add(R, B), R + B))  # Safe option
-
-# === New NGB indices ===
-def calculate_ndvi_mod(NIR, G):
-    return np.true_divide(np.subtract(NIR, G), np.add(NIR, G))
-
-def calculate_gndvi(NIR, G):
-    return np.true_divide(np.subtract(NIR, G), np.add(NIR, G))
-
-def calculate_ndbi_blue(NIR, B):
-    return np.true_divide(np.subtract(NIR, B), np.add(NIR, B))
-
-def calculate_ndgi(G, B):
-    return np.true_divide(np.subtract(G, B), np.add(G, B))
-
-def calculate_bgi(G, B):
-    return np.true_divide(np.subtract(G, B), np.add(G, B))
-
-def calculate_evi_mod(NIR, G, B):
-    return 2.5 * np.true_divide(np.subtract(NIR, G), np.add(np.add(NIR, 6 * G), np.add(-7.5 * B, 1)))
-
-def calculate_msavi(NIR, G):
-    return 0.5 * (2 * NIR + 1 - np.sqrt((2 * NIR + 1) ** 2 - 8 * (NIR - G)))
-
-def calculate_endvi_ngb(NIR, G, B):
-    return np.true_divide(np.subtract(np.add(NIR, G), 2 * B), np.add(np.add(NIR, G), 2 * B))
-
-def calculate_gndwi(G, NIR):
-    return np.true_divide(np.subtract(G, NIR), np.add(G, NIR))
-
-def calculate_cig(NIR, G):
-    return np.true_divide(NIR, G) - 1
-
-def calculate_gbndvi(NIR, G, B):
-    return np.true_divide(np.subtract(NIR, np.add(G, B)), np.add(NIR, np.add(G, B)))
-
-def calculate_gsavi(NIR, G, L=0.16):
-    numerator = np.subtract(NIR, np.add(G, L))
-    denominator = np.add(np.add(NIR, G), L)
-    return np.true_divide(numerator, denominator)
-
-def calculate_grndvi(NIR, G):
-    return np.true_divide(np.subtract(NIR, G), np.add(NIR, G))
-
-def calculate_gosavi(NIR, G):
-    return np.true_divide(np.subtract(NIR, G), np.add(np.add(NIR, G), 0.16))
-
-def calculate_ndwi(G, NIR):
-    return np.true_divide(np.subtract(G, NIR), np.add(G, NIR))
-
-def calculate_bndvi(NIR, B):
-    return np.true_divide(np.subtract(NIR, B), np.add(NIR, B))
-
-def calculate_ngbvi(G, B):
-    return np.true_divide(np.subtract(G, B), np.add(G, B))
-
-def calculate_cig_simple(NIR, G):
-    return np.true_divide(NIR, G) - 1
-
-def calculate_bwdrvi(NIR, B):
-    return np.true_divide(0.1 * NIR - B, 0.1 * NIR + B)
-
-# === New RGN indices ===
-def calculate_ndvi(NIR, R):
-    return np.true_divide(np.subtract(NIR, R), np.add(NIR, R))
-
-def calculate_gndvi(NIR, G):
-    return np.true_divide(np.subtract(NIR, G), np.add(NIR, G))
-
-def calculate_savi(NIR, R, L=0.5):
-    NIRminusR = np.subtract(NIR, R)
-    NIRplusRplusL = np.add(np.add(NIR, R), L)
-    return np.multiply(np.true_divide(NIRminusR, NIRplusRplusL), (1 + L))
-
-def calculate_msavi(NIR, R):
-    return 0.5 * (2 * NIR + 1 - np.sqrt((2 * NIR + 1) ** 2 - 8 * (NIR - R)))
-
-def calculate_osavi(NIR, R):
-    return np.multiply(np.true_divide(np.subtract(NIR, R), np.add(NIR, R) + 0.16), (1 + 0.16))
-
-def calculate_evi2(NIR, R):
-    return 2.5 * np.true_divide(np.subtract(NIR, R), np.add(NIR, 2.4 * R + 1))
-
-def calculate_sr(NIR, R):
-    return np.true_divide(NIR, R)
-
-def calculate_rdvi(NIR, R):
-    return np.true_divide(np.subtract(NIR, R), np.sqrt(np.add(NIR, R)))
-
-def calculate_wdrvi(NIR, R, a=0.1):
-    return np.true_divide(a * NIR - R, a * NIR + R)
-
-def calculate_mtvi2(NIR, R, G):
-    numerator = 1.5 * (1.2 * (NIR - G) - 2.5 * (R - G))
-    denominator = np.sqrt((NIR + 1) ** 2 - (R + 1) ** 2)
-    return np.true_divide(numerator, denominator)
-
-def calculate_dvi(NIR, R):
-    return np.subtract(NIR, R)
-
-def calculate_ndwi(G, NIR):
-    return np.true_divide(np.subtract(G, NIR), np.add(G, NIR))
-
-def calculate_cig(NIR, G):
-    return np.true_divide(NIR, G) - 1
-
-def calculate_cired(NIR, R):
-    return np.true_divide(NIR, R) - 1
-
-def calculate_cvi(NIR, R, G):
-    return np.true_divide(np.multiply(NIR, R), np.square(G))
-
-def calculate_grvi(G, R):
-    return np.true_divide(np.subtract(G, R), np.add(G, R))
-
-def calculate_rgri(R, G):
-    return np.true_divide(R, G)
-
-def calculate_ngrdi(G, R):
-    return np.true_divide(np.subtract(G, R), np.add(G, R))
-
 # === Define Haxby colormap ===
+# Color stops only; the colormap is built from them on first use, so importing
+# the app doesn't load matplotlib
 haxby_colors = [
     (0, '#000080'), (0.1, '#0000ff'), (0.2, '#00ffff'), (0.3, '#00ff00'), 
     (0.4, '#ffff00'), (0.5, '#ffa500'), (0.6, '#ff4500'), (0.7, '#ff0000'), 
     (0.8, '#8b0000'), (1.0, '#000000')
 ]
-haxby_cmap = LinearSegmentedColormap.from_list('Haxby', haxby_colors)
 
 # === Colormap options ===
 colormap_options = {
@@ -278,7 +106,7 @@ colormap_options = {
     'RdYlGn': 'RdYlGn',
     'Blues': 'Blues',
     'Greys': 'Greys',
-    'Haxby': haxby_cmap,
+    'Haxby': haxby_colors,
     'Cool': 'cool',
     'Spring': 'spring',
     'Summer': 'summer',
@@ -288,289 +116,1105 @@ colormap_options = {
     'Coolwarm': 'coolwarm'
 }
 
-# === Process function ===
-def process_and_save(image_path, output_name, calculation_func, label, colormap_name, *args):
+# === Colormap rendering ===
+_colormap_luts = {}
+
+def get_colormap_lut(colormap_name, lut_size=256):
+    key = (colormap_name, lut_size)
+    lut = _colormap_luts.get(key)
+    if lut is None:
+        lut = _colormap_luts[key] = colormap_lut(colormap_options[colormap_name], lut_size)
+    return lut
+
+def render_colormap(result, colormap_name, vmin, vmax, lut_size=256, bad_color=(255, 255, 255), out=None, valid=None):
+    return apply_lut(result, get_colormap_lut(colormap_name, lut_size), vmin, vmax, bad_color, out, valid)
+
+# === Colorbar cache ===
+_colorbars = ColorbarCache()
+
+def get_colorbar(colormap_name, label, vmin, vmax, width, height):
+    return _colorbars.get(colormap_name, colormap_options[colormap_name], label, vmin, vmax, width, height,
+                          app.config['COLORBAR_CACHE_SIZE'], app.config['COLORBAR_CACHE_FOLDER'])
+
+# === Normalization ===
+# A few hot pixels or near-zero denominators (SR, CVI, RGRI) stretch the
+# frame's own range until everything else is one color. Percentile clipping
+# takes its bounds from a one-pass QuantileSketch rather than a sorted copy,
+# so it costs about as much in tiled mode as on small frames; fixed ranges
+# need no pass at all and keep colors comparable between frames.
+NORMALIZE_MODES = ('minmax', 'percentile', 'fixed')
+
+def parse_normalization():
+    # Normalization options from the form, defaulting to the app config.
+    # Returns (normalization, None) or (None, (error message, status code)).
+    mode = request.form.get('normalize') or app.config['NORMALIZE']
+    if mode not in NORMALIZE_MODES:
+        return None, (f"Error: normalize must be one of {', '.join(NORMALIZE_MODES)}.", 400)
     try:
-        rgb = imageio.imread(image_path)
-        result = calculation_func(*args)
-        abs_max = max(abs(np.min(result)), abs(np.max(result)))
+        clip = [float(value) for value in request.form['clip'].split(',')] if request.form.get('clip') else list(app.config['CLIP_PERCENTILES'])
+    except ValueError:
+        return None, ("Error: clip must be two comma-separated percentiles.", 400)
+    if len(clip) != 2 or not 0 <= clip[0] < clip[1] <= 100:
+        return None, ("Error: clip must be two increasing percentiles within 0-100.", 400)
+    symmetric = request.form['symmetric'] == '1' if request.form.get('symmetric') else app.config['SYMMETRIC_RANGE']
+    return {'mode': mode, 'clip': clip, 'symmetric': symmetric}, None
+
+def index_normalization(normalization, index):
+    # Only what affects the rendering, so it alone goes into the cache key.
+    # Fixed mode picks up the index's range; unbounded indices (SR, EVI)
+    # have none and keep their own min-max.
+    mode = normalization['mode']
+    if mode == 'fixed' and INDICES[index].value_range is None:
+        mode = 'minmax'
+    resolved = {'mode': mode, 'symmetric': normalization['symmetric']}
+    if mode == 'percentile':
+        resolved['clip'] = normalization['clip']
+    elif mode == 'fixed':
+        resolved['range'] = list(INDICES[index].value_range)
+    return resolved
+
+def display_range(normalization, make_strips, data_range=None):
+    # (low, high) for a result given as row strips; make_strips() returns a
+    # fresh iterator over them. data_range, the result's (min, max) if
+    # already known, saves the pass in minmax mode. Without a normalization
+    # the frame's own range is used.
+    normalization = normalization or {'mode': 'minmax', 'symmetric': False}
+    mode = normalization['mode']
+    if mode == 'fixed':
+        low, high = normalization['range']
+    elif mode == 'percentile':
+        sketch = QuantileSketch()
+        for strip in make_strips():
+            with metrics.stage('normalize'):
+                sketch.add(strip)
+        low, high = (sketch.percentile(q) for q in normalization['clip']) if sketch.count else (0.0, 0.0)
+    elif data_range is not None:
+        low, high = data_range
+    else:
+        low, high = np.inf, -np.inf
+        for strip in make_strips():
+            with metrics.stage('normalize'):
+                strip_range = finite_range(strip, default=None)
+            if strip_range is not None:
+                low, high = min(low, strip_range[0]), max(high, strip_range[1])
+        if low > high:
+            low = high = 0.0
+    if normalization['symmetric']:
+        high = max(abs(low), abs(high))
+        low = -high
+    return low, high
 
-        fig, ax = plt.subplots()
-        cmap = colormap_options[colormap_name]
-        ax.imshow(result, cmap=cmap)
-        plt.axis('off')
+# === Process function ===
+def process_and_save(output_name, calculation_func, label, colormap_name, *args, tiles_folder=None, encoding=None, normalization=None):
+    try:
+        with metrics.stage('index'):
+            result = calculation_func(*args, dtype=app.config['BAND_DTYPE'])
+        save_result(result, output_name, label, colormap_name, tiles_folder, encoding, normalization)
 
-        from io import BytesIO
-        buf = BytesIO()
-        fig.savefig(buf, format='png', dpi=600, bbox_inches='tight', pad_inches=0)
-        plt.close(fig)
-        buf.seek(0)
+    except Exception as e:
+        logging.error(f"Error in processing and saving image: {e}")
+        raise
 
-        main_image = imageio.imread(buf)
-        if main_image.shape[2] == 4:
-            main_image = main_image[:, :, :3]
+def default_encoding():
+    return {'output_format': app.config['OUTPUT_FORMAT'], 'quality': app.config['OUTPUT_QUALITY'], 'compress_level': app.config['PNG_COMPRESS_LEVEL']}
+
+def write_canvas(output_name, canvas, encoding=None):
+    encode_image(output_name, canvas, png_filter=app.config['PNG_FILTER'], workers=app.config['ENCODE_WORKERS'], **(encoding or default_encoding()))
+
+def save_result(result, output_name, label, colormap_name, tiles_folder=None, encoding=None, normalization=None):
+    # The range and the no-data mask (pixels the index is undefined for, such
+    # as 0/0 on black) come from one pass; the render reuses the mask
+    with metrics.stage('normalize'):
+        vmin, vmax, valid = scan(result)
+    vmin, vmax = display_range(normalization, lambda: [result], (vmin, vmax))
+
+    # Output canvas: index image, 1% white spacer, colorbar band (10% of height)
+    height, width = result.shape
+    with metrics.stage('colorbar'):
+        colorbar_image = get_colorbar(colormap_name, label, vmin, vmax, int(width * 0.8), int(height * 0.1))
+    footer = colorbar_footer(height, width, colorbar_image)
+    canvas = np.empty((height + footer.shape[0], width, 3), dtype=np.uint8)
+    canvas[height:] = footer
+
+    with metrics.stage('colormap'):
+        render_colormap(result, colormap_name, vmin, vmax, out=canvas[:height], valid=valid)
+
+    with metrics.stage('encode'):
+        write_canvas(output_name, canvas, encoding)
+    if tiles_folder:
+        with metrics.stage('tiles'):
+            tiles = TilePyramidWriter(tiles_folder, canvas.shape[1], canvas.shape[0])
+            tiles.write_rows(canvas)
+            tiles.close()
+    logging.info(f"Image processed and saved to {output_name}")
+
+def save_preview(rgb, output_name, index, image_type, colormap_name, max_size, normalization=None):
+    # Index image alone (no colorbar) from every n-th pixel of the band stack,
+    # shown while the full-resolution render is still queued
+    step = max(1, -(-max(rgb.shape[:2]) // max_size))
+    result = INDICES[index].formula(*index_inputs(rgb[::step, ::step], image_type, index), dtype=app.config['BAND_DTYPE'])
+    vmin, vmax = display_range(normalization, lambda: [result])
+    Image.fromarray(render_colormap(result, colormap_name, vmin, vmax)).save(output_name, format='png', compress_level=1)
+
+# === Tiled processing ===
+# For orthomosaics too large to hold as float bands: the index is computed per
+# row strip twice, first for the global value range the colormap and colorbar
+# need, then to render each strip straight into a streamed PNG.
+def iter_index_strips(rgb, image_type, index):
+    func = INDICES[index].formula
+    strip_rows = max(1, app.config['TILE_PIXELS'] // rgb.shape[1])
+    for start in range(0, rgb.shape[0], strip_rows):
+        with metrics.stage('bands'):
+            args = index_inputs(rgb[start:start + strip_rows], image_type, index)
+        with metrics.stage('index'):
+            result = func(*args, dtype=app.config['BAND_DTYPE'])
+        yield result
+
+def process_tiled(rgb, output_name, index, image_type, label, colormap_name, tiles_folder=None, encoding=None, normalization=None):
+    try:
+        render_strips(lambda: iter_index_strips(rgb, image_type, index), output_name, rgb.shape[0], rgb.shape[1], label, colormap_name,
+                      tiles_folder=tiles_folder, encoding=encoding, normalization=normalization)
+        logging.info(f"Image processed in strips and saved to {output_name}")
 
-        fig, ax = plt.subplots(figsize=(main_image.shape[1] * 0.8 / 100, 1))
-        norm = plt.Normalize(vmin=-abs_max, vmax=abs_max)
-        cbar = plt.colorbar(cm.ScalarMappable(norm=norm, cmap=cmap), cax=ax, orientation='horizontal')
-        cbar.ax.tick_params(labelsize=10)
-        cbar.update_ticks()
-        cbar.set_label(label, fontsize=16, fontweight='bold', labelpad=-50)
+    except Exception as e:
+        logging.error(f"Error in tiled processing of image: {e}")
+        raise
 
-        buf = BytesIO()
-        fig.savefig(buf, format='png', dpi=600, bbox_inches='tight', pad_inches=0)
-        plt.close(fig)
-        buf.seek(0)
+def render_strips(make_strips, output_name, height, width, label, colormap_name, value_range=None, tiles_folder=None, encoding=None,
+                  normalization=None):
+    # make_strips() returns a fresh iterator over the rows as float strips; it
+    # is called once for the value range, unless value_range is given or the
+    # normalization is fixed, and once to render
+    encoding = encoding or default_encoding()
+    if encoding['output_format'] != 'png':
+        raise ValueError('Frames rendered in strips can only be written as PNG')
+    vmin, vmax = value_range or display_range(normalization, make_strips)
+
+    # Same layout as save_result, but the colorbar is capped in size so it
+    # doesn't grow with the mosaic
+    scale = min(1.0, app.config['TILED_COLORBAR_MAX_WIDTH'] / (width * 0.8))
+    with metrics.stage('colorbar'):
+        colorbar_image = get_colorbar(colormap_name, label, vmin, vmax, int(width * 0.8 * scale), int(height * 0.1 * scale))
+
+    footer = colorbar_footer(height, width, colorbar_image)
+    canvas_height = height + footer.shape[0]
+    tiles = TilePyramidWriter(tiles_folder, width, canvas_height) if tiles_folder else None
+    with PngStripWriter(output_name, width, canvas_height, encoding['compress_level'], app.config['PNG_FILTER'], app.config['ENCODE_WORKERS']) as writer:
+        for result in make_strips():
+            with metrics.stage('colormap'):
+                rows = render_colormap(result, colormap_name, vmin, vmax)
+            with metrics.stage('encode'):
+                writer.write_rows(rows)
+            if tiles:
+                with metrics.stage('tiles'):
+                    tiles.write_rows(rows)
+
+        writer.write_rows(footer)
+        if tiles:
+            tiles.write_rows(footer)
+            tiles.close()
+
+# === Raw float export ===
+# Writes the index values themselves instead of a colorized preview, for GIS
+# and statistics jobs that need numbers. Strips are computed as in tiled mode
+# and written as they come, so nothing is rendered and no full frame is held.
+EXPORT_FORMATS = {'tiff': '.tif', 'npy': '.npy'}
+
+def export_index(rgb, output_name, index, image_type, export_format):
+    height, width = rgb.shape[:2]
+    strips = (result.astype(np.float32, copy=False) for result in iter_index_strips(rgb, image_type, index))
+    if export_format == 'tiff':
+        write_float_tiff(output_name, strips, height, width)
+    else:
+        write_float_npy(output_name, strips, height, width)
+    logging.info(f"Raw values exported to {output_name}")
+
+# === Index statistics ===
+# Summary numbers for dashboards that don't need the picture, accumulated per
+# strip in a single pass (see index_stats)
+def index_statistics(rgb, image_type, index, thresholds=(), percentiles=DEFAULT_PERCENTILES, bins=64):
+    stats = StreamingStats(thresholds)
+    for result in iter_index_strips(rgb, image_type, index):
+        stats.add(result)
+    return stats.summary(percentiles, bins)
+
+# === Change detection ===
+# Co-registered frames of one field from several dates (see change_detection).
+# Each date's index values are the float32 .npy that /process exports with
+# export=npy, so a date is computed once and reused by every series it is
+# part of; adding next week's flight only computes next week.
+def date_values(upload_id, index, image_type, label):
+    # (values file, whether it had to be computed)
+    output_file = result_output_file(upload_id, index, image_type, label, None, ext=EXPORT_FORMATS['npy'], export='npy')
+    if cached_result(output_file):
+        return output_file, False
+    render_index(None, upload_id, output_file, index, image_type, label, None, export='npy')
+    return output_file, True
+
+def iter_rows(values, strip_rows):
+    for start in range(0, values.shape[0], strip_rows):
+        yield values[start:start + strip_rows]
+
+def series_changes(upload_ids, times, trend_unit, index, image_type, label, colormap_name, compare, outputs):
+    # Writes the difference and trend, as values and as images, to the result
+    # files in outputs. Returns (per-date stats, difference stats, trend
+    # stats, upload_ids whose values had to be computed).
+    folder = app.config['RESULT_FOLDER']
+    computed, series = [], []
+    for upload_id in upload_ids:
+        values_file, is_new = date_values(upload_id, index, image_type, label)
+        if is_new:
+            computed.append(upload_id)
+        # Mapped right away, so a later date's eviction can't pull it away
+        series.append(np.load(os.path.join(folder, values_file), mmap_mode='r'))
+    height, width = series[0].shape
+    strip_rows = max(1, app.config['SERIES_TILE_PIXELS'] // width)
+
+    tmp_names = {kind: result_cache.temporary_path(os.path.join(folder, output_file)) for kind, output_file in outputs.items()}
+    try:
+        with metrics.stage('change'):
+            date_stats, difference_stats, trend_stats = write_changes(series, times, tmp_names['difference'], tmp_names['trend'],
+                                                                      strip_rows, compare)
+        del series
+
+        # Gains and losses get opposite ends of the colormap, whatever their range
+        encoding = {'output_format': 'png', 'quality': None, 'compress_level': app.config['PNG_COMPRESS_LEVEL']}
+        for kind, stats, kind_label in (('difference', difference_stats, f'{label} change'), ('trend', trend_stats, f'{label} per {trend_unit}')):
+            abs_max = max(abs(stats.minimum), abs(stats.maximum)) if stats.count else 0.0
+            values = np.load(tmp_names[kind], mmap_mode='r')
+            render_strips(lambda values=values: iter_rows(values, strip_rows), tmp_names[f'{kind}_image'], height, width, kind_label, colormap_name,
+                          value_range=(-abs_max, abs_max), encoding=encoding)
+            del values
+        for kind, output_file in outputs.items():
+            os.replace(tmp_names[kind], os.path.join(folder, output_file))
+    finally:
+        for tmp_name in tmp_names.values():
+            result_cache.discard(tmp_name)
+    return date_stats, difference_stats, trend_stats, computed
+
+# === Zonal statistics ===
+# Per-plot numbers for a layout of field plots (see zonal_stats). A layout is
+# rasterized once per frame size and kept in ZONE_CACHE_FOLDER under its
+# layout_id, so clients send the polygons once and the layout_id afterwards,
+# for every index and every flight over the same field.
+def receive_zone_layout(height, width):
+    # Resolves layout_id, or rasterizes the posted zones (GeoJSON in pixel
+    # coordinates, as a form field or a file) or zone_mask (a label image)
+    # for a height x width frame, unless that layout is already stored.
+    # Returns ((layout_id, labels, zone names), None) or (None, (error
+    # message, status code)).
+    folder = app.config['ZONE_CACHE_FOLDER']
+    layout_id = request.form.get('layout_id')
+    if layout_id:
+        layout = zonal_stats.load_layout(folder, layout_id)
+        if layout is None:
+            return None, ("Unknown or expired zone layout", 404)
+        labels, zones = layout
+        if labels.shape != (height, width):
+            return None, (f"Error: The zone layout is {labels.shape[1]}x{labels.shape[0]}, the image {width}x{height}.", 400)
+        return (layout_id, labels, zones), None
+
+    mask_file = request.files.get('zone_mask')
+    if mask_file:
+        digest = result_cache.hash_stream(mask_file.stream)
+    elif request.form.get('zones') or 'zones' in request.files:
+        try:
+            geojson = json.loads(request.form.get('zones') or request.files['zones'].read())
+            zones = zonal_stats.parse_geojson(geojson)
+        except ValueError as e:
+            return None, (f"Error: Invalid zones: {e}", 400)
+        if len(zones) > app.config['MAX_ZONES']:
+            return None, (f"Error: Got {len(zones)} zones, at most {app.config['MAX_ZONES']} are allowed.", 400)
+        digest = result_cache.result_key(geojson)
+    else:
+        return None, ("Error: Send zones (GeoJSON), a zone_mask image or a layout_id.", 400)
+
+    layout_id = result_cache.result_key(digest, height=height, width=width)
+    layout = zonal_stats.load_layout(folder, layout_id)
+    if layout is None:
+        result_cache.evict(folder, app.config['ZONE_CACHE_MAX_BYTES'])
+        try:
+            with metrics.stage('rasterize'):
+                if mask_file:
+                    mask = read_raster(mask_file.stream, mask_file.filename)
+                    if mask.shape[:2] != (height, width):
+                        return None, (f"Error: The zone mask is {mask.shape[1]}x{mask.shape[0]}, the image {width}x{height}.", 400)
+                    layout = zonal_stats.store_mask(folder, layout_id, mask, app.config['MAX_ZONES'])
+                else:
+                    layout = zonal_stats.store_polygons(folder, layout_id, zones, height, width)
+        except ValueError as e:
+            return None, (f"Error: {e}", 400)
+        app.logger.debug(f"Rasterized zone layout {layout_id}")
+    labels, zones = layout
+    return (layout_id, labels, zones), None
+
+def zone_statistics(rgb, image_type, index, labels, zones, percentiles=DEFAULT_PERCENTILES):
+    # One pass over the index strips, whatever the number of zones
+    stats = ZonalStats(len(zones))
+    start = 0
+    for result in iter_index_strips(rgb, image_type, index):
+        with metrics.stage('zones'):
+            stats.add(result, labels[start:start + len(result)])
+        start += len(result)
+    return stats.summary(zones, percentiles)
+
+# === Band helpers ===
+def index_inputs(rgb, image_type, index):
+    # The formula's arguments: only the bands the index reads, as views of the
+    # (often memory-mapped) upload in its own sample type. Pass dtype=BAND_DTYPE
+    # to the formula, which converts them a block at a time.
+    spec = INDICES[index]
+    bands = read_bands(rgb, image_type, None, spec.band_names(image_type))
+    return spec.arguments(bands, image_type)
+
+def batch_bands(upload_id, rgb, image_type, names):
+    # (bands, band files) for evaluating several indices at once: float bands
+    # shared by every worker through the band store (see upload_store), or a
+    # private copy when SHARED_BANDS is off
+    dtype = app.config['BAND_DTYPE']
+    if not app.config['SHARED_BANDS']:
+        return read_bands(rgb, image_type, dtype, names), []
+    folder = app.config['UPLOAD_CACHE_FOLDER']
+    channels = {name: channel for channel, name in enumerate(band_layout(image_type)) if name in names}
+    arrays = upload_store.load_channels(folder, upload_id, rgb, channels.values(), dtype)
+    bands = {name: arrays[channel] for name, channel in channels.items()}
+    return bands, [upload_store.band_path(folder, upload_id, channel, dtype) for channel in channels.values()]
+
+# === Startup ===
+# matplotlib and imageio are imported on first use, so the batch CLI, job
+# processes and statistics requests only load what they touch. A server calls
+# prewarm() before taking traffic instead (wsgi.py does), so the first request
+# doesn't pay for it: every colormap LUT, one throwaway colorbar (matplotlib,
+# its font cache and the Agg renderer), every index formula run once (numexpr
+# compiles and caches each expression), a tiny JPEG decode and PNG encode,
+# and the page template.
+_prewarmed = False
+
+def prewarm():
+    global _prewarmed
+    if _prewarmed:
+        return
+    for colormap_name in colormap_options:
+        get_colormap_lut(colormap_name)
+    render_colorbar(colormap_options['Viridis'], 'NDVI', -1.0, 1.0, 256, 32)
+
+    rgb = np.random.default_rng(0).integers(1, 256, (8, 8, 3), dtype=np.uint8)
+    with np.errstate(all='ignore'):
+        for index, spec in INDICES.items():
+            for image_type in spec.image_types:
+                if spec.band_names(image_type) is not None:
+                    spec.formula(*index_inputs(rgb, image_type, index), dtype=app.config['BAND_DTYPE'])
+
+    buf = BytesIO()
+    Image.fromarray(rgb).save(buf, format='JPEG')
+    buf.seek(0)
+    read_raster(buf, 'prewarm.jpg')
+    with tempfile.TemporaryDirectory() as folder:
+        # One thread: a preloading server forks right after this
+        encode_image(os.path.join(folder, 'prewarm.png'), rgb, **default_encoding())
+    with app.test_request_context():
+        render_template('index.html', indices=INDICES, colormap_options=colormap_options)
+    _prewarmed = True
+    app.logger.info('Prewarmed matplotlib, colormaps, index formulas and codecs')
 
-        colorbar_image = imageio.imread(buf)
-        if (colorbar_image.shape[2] == 4):
-            colorbar_image = colorbar_image[:, :, :3]
+# === Routes ===
+@app.after_request
+def cache_result_responses(response):
+    # Result files are content-addressed, so browsers and proxies may keep them
+    # for good; Flask's static handler already supplies the ETag
+    if request.path.startswith('/static/results/') and response.status_code in (200, 304):
+        response.cache_control.no_cache = None
+        response.cache_control.public = True
+        response.cache_control.max_age = app.config['RESULT_MAX_AGE']
+        response.cache_control.immutable = True
+    return response
+
+# Endpoints timed stage by stage; the rest (pages, polls, static files) aren't worth the log line
+TIMED_ENDPOINTS = {'process', 'submit_job', 'create_upload', 'compute_stats', 'compute_series', 'compute_zones', 'process_batch'}
+
+@app.before_request
+def start_timer():
+    if app.config['METRICS_ENABLED'] and request.endpoint in TIMED_ENDPOINTS:
+        metrics.start(request.endpoint)
+
+@app.after_request
+def finish_timer(response):
+    metrics.observe(metrics.finish(response.status_code))
+    return response
+
+@app.teardown_request
+def drop_timer(exc):
+    # Only still running if the view raised past after_request
+    metrics.observe(metrics.finish(500))
+
+@app.route('/metrics')
+def prometheus_metrics():
+    if not app.config['METRICS_ENABLED']:
+        return "Metrics are disabled", 404
+    return metrics.render(), 200, {'Content-Type': metrics.CONTENT_TYPE}
 
-        colorbar_image_pil = Image.fromarray(colorbar_image)
-        colorbar_image_pil = colorbar_image_pil.resize((int(main_image.shape[1] * 0.8), int(main_image.shape[0] * 0.1)))
-        colorbar_image = np.array(colorbar_image_pil)
+@app.route('/')
+def index():
+    app.logger.debug('Index page accessed')
+    return render_template('index.html', indices=INDICES, colormap_options=colormap_options)
+
+def receive_upload():
+    # Decodes the posted image into the upload store, unless it is already
+    # there, or resolves the upload_id of an earlier one. Nothing else is
+    # written to disk. Returns ((path, upload_id, name), None) or
+    # (None, (error message, status code)).
+    folder = app.config['UPLOAD_CACHE_FOLDER']
+    upload_id = request.form.get('upload_id')
+    if upload_id:
+        if not upload_store.exists(folder, upload_id):
+            return None, ("Unknown or expired upload", 404)
+        return (upload_store.stack_path(folder, upload_id), upload_id, request.form.get('name', upload_id[:12])), None
+
+    band_files = [(name[len('band_'):], file) for name, file in request.files.items() if name.startswith('band_')]
+    if band_files:
+        files = [file for name, file in band_files]
+    elif 'image' in request.files:
+        files = [request.files['image']]
+    else:
+        return None, ("No file part", 400)
+    if any(file.filename == '' for file in files):
+        return None, ("No selected file", 400)
+    with metrics.stage('upload'):
+        if band_files:
+            upload_id = result_cache.hash_streams((name, file.stream) for name, file in band_files)
+        else:
+            upload_id = result_cache.hash_stream(files[0].stream)
+    if not upload_store.exists(folder, upload_id):
+        result_cache.evict(folder, app.config['UPLOAD_CACHE_MAX_BYTES'], max_age=app.config['UPLOAD_CACHE_TTL'])
+        try:
+            with metrics.stage('decode'):
+                if band_files:
+                    upload_store.store_band_files(folder, upload_id, [(file.stream, file.filename) for file in files])
+                else:
+                    upload_store.store_upload(folder, upload_id, files[0].stream, files[0].filename)
+        except ValueError as e:
+            return None, (f"Error: {e}", 400)
+        app.logger.debug(f"Decoded upload {upload_id}")
+    return (upload_store.stack_path(folder, upload_id), upload_id, os.path.splitext(files[0].filename)[0]), None
+
+def request_image_type():
+    # A camera type, a layout named in BAND_LAYOUTS or the band of each
+    # channel, comma-separated. Separate band files (band_NIR, band_R, ...)
+    # name their own bands, in the order they were sent.
+    image_type = request.form.get('image_type') or ','.join(name[len('band_'):] for name in request.files if name.startswith('band_'))
+    if image_type in app.config['BAND_LAYOUTS']:
+        return ','.join(app.config['BAND_LAYOUTS'][image_type])
+    return image_type
+
+def layout_error(image_type, upload_id=None):
+    # (error message, status code) if the image type isn't a valid layout, or
+    # names more bands than the upload has
+    try:
+        layout = band_layout(image_type)
+    except ValueError as e:
+        return f"Error: {e}.", 400
+    if upload_id is not None:
+        rgb = upload_store.load(app.config['UPLOAD_CACHE_FOLDER'], upload_id)
+        if rgb is not None and rgb.shape[2] < len(layout):
+            return f"Error: The image type {image_type} needs {len(layout)} bands, but the image has {rgb.shape[2]}.", 400
+    return None
+
+def open_upload(upload_id):
+    rgb = upload_store.load(app.config['UPLOAD_CACHE_FOLDER'], upload_id)
+    if rgb is None:
+        raise FileNotFoundError(f"Upload {upload_id} has expired")
+    metrics.record_input(rgb)
+    return rgb
+
+def index_error(index, image_type):
+    # (error message, status code) if the index can't be computed for this image type
+    if index not in INDICES:
+        return "Error: Invalid index selection.", 400
+    spec = INDICES[index]
+
+    error = layout_error(image_type)
+    if error:
+        return error
+
+    if not spec.offered_for(image_type):
+        return f"Error: The selected index {spec.label} is not valid for the image type {image_type}.", 400
+
+    if spec.band_names(image_type) is None:
+        return f"Error: The selected index {spec.label} requires bands that are not available in the image type {image_type}.", 400
+    return None
+
+def parse_encoding():
+    # Output format options from the form, defaulting to the app config.
+    # Returns (encoding, None) or (None, (error message, status code)).
+    encoding = default_encoding()
+    output_format = request.form.get('output_format') or encoding['output_format']
+    if output_format not in OUTPUT_FORMATS:
+        return None, (f"Error: Unknown output format {output_format}.", 400)
+    try:
+        quality = int(request.form.get('quality') or encoding['quality'])
+        compress_level = int(request.form.get('compress_level') or encoding['compress_level'])
+    except ValueError:
+        return None, ("Error: quality and compress_level must be integers.", 400)
+    if not (1 <= quality <= 100 and 0 <= compress_level <= 9):
+        return None, ("Error: quality must be within 1-100 and compress_level within 0-9.", 400)
+    # Only the option that applies to the format is kept, so it alone goes into the cache key
+    lossy = output_format in ('jpeg', 'webp')
+    return {'output_format': output_format, 'quality': quality if lossy else None, 'compress_level': None if lossy else compress_level}, None
+
+def parse_process_request():
+    # Validates the /process form and resolves the upload. Returns (job, None)
+    # or (None, (error message, status code)).
+    index = request.form['index']
+    image_type = request_image_type()
+    colormap_name = request.form['colormap']
+    error = index_error(index, image_type)
+    if error:
+        return None, error
+    label = INDICES[index].label
+
+    if colormap_name not in colormap_options:
+        colormap_name = INDICES[index].colormap
+
+    export_format = request.form.get('export') or None
+    if export_format is not None and export_format not in EXPORT_FORMATS:
+        return None, (f"Error: Unknown export format {export_format}.", 400)
+    encoding, error = parse_encoding()
+    if error:
+        return None, error
+    normalization, error = parse_normalization()
+    if error:
+        return None, error
+    normalization = index_normalization(normalization, index)
+
+    upload, error = receive_upload()
+    if error:
+        return None, error
+    filename, upload_id, name = upload
+    error = layout_error(image_type, upload_id)
+    if error:
+        return None, error
+
+    tiled = request.form.get('tiled') == '1'
+    if tiled and not export_format and encoding['output_format'] != 'png':
+        return None, ("Error: Tiled processing only writes PNG.", 400)
+    if export_format:
+        # Raw values don't depend on the colormap or on tiling
+        output_file = result_output_file(upload_id, index, image_type, label, None, ext=EXPORT_FORMATS[export_format], export=export_format)
+    else:
+        output_file = result_output_file(upload_id, index, image_type, label, colormap_name, ext=OUTPUT_FORMATS[encoding['output_format']],
+                                         tiled=tiled, normalization=normalization, **encoding)
+    return {
+        'filename': filename,
+        'upload_id': upload_id,
+        'output_file': output_file,
+        'index': index,
+        'image_type': image_type,
+        'label': label,
+        'colormap_name': colormap_name,
+        'tiled': tiled,
+        'export': export_format,
+        'encoding': encoding,
+        'normalization': normalization,
+        'tiles': tiles_folder_name(output_file) if app.config['TILE_PYRAMIDS'] and not export_format else None
+    }, None
+
+def result_output_file(digest, index, image_type, label, colormap_name, ext='.png', **options):
+    key = result_cache.result_key(digest, index=index, image_type=image_type, colormap=colormap_name,
+                                  dtype=app.config['BAND_DTYPE'], **options)
+    return f'{key}_{label}{ext}'
+
+def file_labels(indices):
+    # {index: name for output and archive file names}: the label, or label_key
+    # where requested indices share one (1 and 54 are both NDVI)
+    indices = list(dict.fromkeys(indices))
+    labels = [INDICES[index].label for index in indices]
+    return {index: label if labels.count(label) == 1 else f'{label}_{index}' for index, label in zip(indices, labels)}
+
+def tiles_folder_name(output_file):
+    return os.path.splitext(output_file)[0] + '_tiles'
+
+def result_urls(output_file, export=None):
+    url = url_for('static', filename=f'results/{output_file}')
+    if export:
+        return {'export_url': url}
+    urls = {'processed_image_url': url}
+    # Tiles are evicted on their own, so only advertise them while they exist
+    tiles = tiles_folder_name(output_file)
+    if result_cache.lookup(os.path.join(app.config['RESULT_FOLDER'], tiles)):
+        urls['tiles_url'] = url_for('static', filename=f'results/{tiles}')
+    return urls
+
+def save_json_result(output_name, data):
+    tmp_name = result_cache.temporary_path(output_name)
+    try:
+        with open(tmp_name, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp_name, output_name)
+    finally:
+        result_cache.discard(tmp_name)
+    result_cache.evict(app.config['RESULT_FOLDER'], app.config['RESULT_CACHE_MAX_BYTES'])
+
+def cached_result(output_file):
+    return result_cache.lookup(os.path.join(app.config['RESULT_FOLDER'], output_file))
+
+def render_index(filename, upload_id, output_file, index, image_type, label, colormap_name, tiled=False, export=None, tiles=None, encoding=None,
+                 normalization=None):
+    output_name = os.path.join(app.config['RESULT_FOLDER'], output_file)
+    # Render under a temporary name so a cache lookup never sees a partial file
+    tmp_name = result_cache.temporary_path(output_name)
+    tiles_folder = os.path.join(app.config['RESULT_FOLDER'], tiles) if tiles else None
+    tmp_tiles = result_cache.temporary_path(tiles_folder) if tiles else None
+    try:
+        rgb = open_upload(upload_id)
+        # Pinned, so the upload isn't evicted from under a long render
+        with result_cache.pinned([upload_store.stack_path(app.config['UPLOAD_CACHE_FOLDER'], upload_id)]):
+            if export:
+                export_index(rgb, tmp_name, index, image_type, export)
+            elif tiled or rgb.shape[0] * rgb.shape[1] >= app.config['TILED_MIN_PIXELS']:
+                process_tiled(rgb, tmp_name, index, image_type, label, colormap_name, tmp_tiles, encoding, normalization)
+            else:
+                with metrics.stage('bands'):
+                    args = index_inputs(rgb, image_type, index)
+                process_and_save(tmp_name, INDICES[index].formula, label, colormap_name, *args, tiles_folder=tmp_tiles, encoding=encoding,
+                                 normalization=normalization)
+        if tmp_tiles:
+            try:
+                os.replace(tmp_tiles, tiles_folder)
+            except OSError:
+                # Another worker finished the same pyramid first
+                pass
+        os.replace(tmp_name, output_name)
+    finally:
+        result_cache.discard(tmp_tiles)
+        result_cache.discard(tmp_name)
+    result_cache.evict(app.config['RESULT_FOLDER'], app.config['RESULT_CACHE_MAX_BYTES'])
+    app.logger.debug(f'Processed image saved: {output_name}')
 
-        padding_height = colorbar_image.shape[0]
-        white_padding = np.full((padding_height, main_image.shape[1], 3), [255, 255, 255], dtype=np.uint8)
+@app.route('/process', methods=['POST'])
+def process():
+    try:
+        job, error = parse_process_request()
+        if error:
+            app.logger.error(error[0])
+            return error
+
+        if cached_result(job['output_file']):
+            app.logger.debug(f"Serving cached result {job['output_file']}")
+        else:
+            # Tile pyramids are cut by /jobs in the background, not while the
+            # client waits here; tiles_url is still returned if a job made them
+            render_index(**{**job, 'tiles': None})
+        return jsonify({'upload_id': job['upload_id'], **result_urls(job['output_file'], job['export'])})
 
-        x_offset = (white_padding.shape[1] - colorbar_image.shape[1]) // 2
-        y_offset = (white_padding.shape[0] - colorbar_image.shape[0]) // 2
-        white_padding[y_offset:y_offset + colorbar_image.shape[0], x_offset:x_offset + colorbar_image.shape[1]] = colorbar_image
+    except Exception as e:
+        app.logger.error(f"Error during processing: {e}")
+        return "Internal server error", 500
 
-        space_height = int(main_image.shape[0] * 0.01)
-        space_padding = np.full((space_height, main_image.shape[1], 3), [255, 255, 255], dtype=np.uint8)
+# === Background jobs ===
+_job_queue = None
+
+def configure_job_worker(config):
+    # Job processes are spawned and import this module afresh, with the
+    # defaults above; they take the settings of the app that started them
+    app.config.update(config)
+
+def get_job_queue():
+    global _job_queue
+    if _job_queue is None:
+        _job_queue = JobQueue(app.config['JOB_FOLDER'], max_workers=app.config['JOB_WORKERS'], max_pending=app.config['JOB_QUEUE_SIZE'],
+                              timed=app.config['METRICS_ENABLED'], initializer=configure_job_worker, initargs=(dict(app.config),))
+    return _job_queue
+
+def job_response(record):
+    response = {key: record[key] for key in ('id', 'status', 'submitted', 'started', 'finished', 'error') if key in record}
+    response['label'] = record['kwargs']['label']
+    response['upload_id'] = record['kwargs']['upload_id']
+    response['status_url'] = url_for('job_status', job_id=record['id'])
+    if record['status'] == 'done':
+        response.update(result_urls(record['kwargs']['output_file'], record['kwargs'].get('export')))
+    return response
+
+@app.route('/jobs', methods=['POST'])
+def submit_job():
+    try:
+        job, error = parse_process_request()
+        if error:
+            app.logger.error(error[0])
+            return error
+
+        if cached_result(job['output_file']):
+            app.logger.debug(f"Serving cached result {job['output_file']}")
+            return jsonify({'status': 'done', 'label': job['label'], 'upload_id': job['upload_id'], **result_urls(job['output_file'], job['export'])})
+
+        try:
+            record = get_job_queue().submit(render_index, job)
+        except QueueFull as e:
+            app.logger.warning(f"Rejecting job, queue is full: {e}")
+            return jsonify({'error': 'Server is busy, try again shortly.'}), 429, {'Retry-After': '5'}
+
+        app.logger.debug(f"Queued job {record['id']} for {job['filename']}")
+        response = job_response(record)
+        if not job['export']:
+            # The pool renders the full frame; answer with a decimated preview meanwhile
+            preview_file = result_output_file(job['upload_id'], job['index'], job['image_type'], job['label'], job['colormap_name'],
+                                              preview=app.config['PREVIEW_MAX_SIZE'], normalization=job['normalization'])
+            preview_name = os.path.join(app.config['RESULT_FOLDER'], preview_file)
+            try:
+                if not cached_result(preview_file):
+                    tmp_name = result_cache.temporary_path(preview_name)
+                    try:
+                        with metrics.stage('preview'):
+                            save_preview(open_upload(job['upload_id']), tmp_name, job['index'], job['image_type'], job['colormap_name'],
+                                         app.config['PREVIEW_MAX_SIZE'], job['normalization'])
+                        os.replace(tmp_name, preview_name)
+                    finally:
+                        result_cache.discard(tmp_name)
+                response['preview_url'] = url_for('static', filename=f'results/{preview_file}')
+            except Exception as e:
+                # The job itself is queued; the client just waits without a preview
+                app.logger.warning(f"Preview for job {record['id']} failed: {e}")
+        return jsonify(response), 202
 
-        result_with_padding = np.vstack((main_image, space_padding, white_padding))
+    except Exception as e:
+        app.logger.error(f"Error while queueing job: {e}")
+        return "Internal server error", 500
 
-        imageio.imwrite(output_name, result_with_padding)
-        logging.info(f"Image processed and saved to {output_name}")
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    record = get_job_queue().status(job_id)
+    if record is None:
+        return jsonify({'error': 'Unknown job'}), 404
+    return jsonify(job_response(record))
+
+@app.route('/jobs/<job_id>/result')
+def job_result(job_id):
+    record = get_job_queue().status(job_id)
+    if record is None:
+        return jsonify({'error': 'Unknown job'}), 404
+    if record['status'] != 'done':
+        return jsonify(job_response(record)), 409
+    return redirect(url_for('static', filename=f"results/{record['kwargs']['output_file']}"))
+
+@app.route('/uploads', methods=['POST'])
+def create_upload():
+    # Decodes an upload ahead of any rendering; later /process, /jobs and
+    # /process_batch requests can send the returned upload_id instead of the file
+    try:
+        upload, error = receive_upload()
+        if error:
+            app.logger.error(error[0])
+            return error
+        filename, upload_id, name = upload
+        rgb = open_upload(upload_id)
+        return jsonify({
+            'upload_id': upload_id,
+            'width': rgb.shape[1],
+            'height': rgb.shape[0],
+            'bands': rgb.shape[2],
+            'dtype': str(rgb.dtype),
+            'image_type': request_image_type() or None
+        })
 
     except Exception as e:
-        logging.error(f"Error in processing and saving image: {e}")
-        raise
+        app.logger.error(f"Error while storing upload: {e}")
+        return "Internal server error", 500
 
-index_functions = {
-    '1': ('NDVI', calculate_ndvi, 'RdYlGn', ['RGN']),
-    '2': ('NDVI_NGB', calculate_ndvi_ngb, 'RdYlGn', ['NGB']),
-    '3': ('ENDVI', calculate_endvi, 'Viridis', ['NGB']),
-    '4': ('ENDVI_RGN', calculate_endvi_rgn, 'Viridis', ['RGN']),
-    '5': ('SAVI', calculate_savi, 'Magma', ['RGN']),
-    '6': ('TVI', calculate_tvi, 'Viridis', ['RGN']),
-    '7': ('GNDVI', calculate_gndvi, 'RdYlGn', ['RGN', 'NGB', 'RGB']),
-    '8': ('MSAVI', calculate_msavi, 'RdYlGn', ['RGN']),
-    '9': ('CVI', calculate_cvi, 'RdYlGn', ['RGN']),
-    '10': ('CVI2', calculate_cvi2, 'RdYlGn', ['RGN']),
-    '11': ('PRI', calculate_pri, 'Cividis', ['RGN']),
-    '12': ('NDWI', calculate_ndwi, 'Blues', ['RGN', 'NGB']),
-    '13': ('VARI', calculate_vari, 'Jet', ['RGB']),
-    '14': ('EVI', calculate_evi, 'Plasma', ['RGN']),
-    '15': ('NG', calculate_ng, 'Inferno', ['RGN']),
-    '16': ('NGRDI', calculate_ngrdi, 'RdYlGn', ['RGB']),
-    '17': ('ExG', calculate_exg, 'RdYlGn', ['RGB']),
-    '18': ('ExR', calculate_exr, 'Magma', ['RGB']),
-    '19': ('ExGR', calculate_exgr, 'Viridis', ['RGB']),
-    '20': ('GLI', calculate_gli, 'RdYlGn', ['RGB']),
-    '21': ('RGBVI', calculate_rgbvi, 'RdYlGn', ['RGB']),
-    '22': ('TGI', calculate_tgi, 'Plasma', ['RGB']),
-    '23': ('NGBDI', calculate_ngbdi, 'Blues', ['RGB']),
-    '24': ('VDVI', calculate_vdvi, 'RdYlGn', ['RGB']),
-    '25': ('MExG', calculate_mexg, 'Viridis', ['RGB']),
-    '26': ('VEG', calculate_veg, 'Cividis', ['RGB']),
-    '27': ('GCC', calculate_gcc, 'Inferno', ['RGB']),
-    '28': ('CIVE', calculate_cive, 'Greys', ['RGB']),
-    '29': ('NDTI', calculate_ndti, 'Blues', ['RGB']),
-    '30': ('SCI', calculate_sci, 'Greys', ['RGB']),
-    '31': ('NDBI', calculate_ndbi, 'Greys', ['RGB']),
-    '32': ('BI', calculate_bi, 'Cividis', ['RGB']),
-    '33': ('UI', calculate_ui, 'Greys', ['RGB']),
-    '34': ('NDVI_Mod', calculate_ndvi_mod, 'RdYlGn', ['NGB']),
-    '35': ('GNDVI', calculate_gndvi, 'RdYlGn', ['NGB']),
-    '36': ('NDBI-Blue', calculate_ndbi_blue, 'Blues', ['NGB']),
-    '37': ('NDGI', calculate_ndgi, 'RdYlGn', ['NGB']),
-    '38': ('BGI', calculate_bgi, 'RdYlGn', ['NGB']),
-    '39': ('EVI_Mod', calculate_evi_mod, 'Plasma', ['NGB']),
-    '40': ('MSAVI', calculate_msavi, 'RdYlGn', ['NGB']),
-    '41': ('ENDVI', calculate_endvi_ngb, 'Viridis', ['NGB']),
-    '42': ('GNDWI', calculate_gndwi, 'Blues', ['NGB']),
-    '43': ('CIG', calculate_cig, 'Cividis', ['NGB']),
-    '44': ('GBNDVI', calculate_gbndvi, 'RdYlGn', ['NGB']),
-    '45': ('GSAVI', calculate_gsavi, 'Magma', ['NGB']),
-    '46': ('GRNDVI', calculate_grndvi, 'RdYlGn', ['NGB']),
-    '48': ('GOSAVI', calculate_gosavi, 'Magma', ['NGB']),
-    '49': ('NDWI', calculate_ndwi, 'Blues', ['NGB']),
-    '50': ('BNDVI', calculate_bndvi, 'RdYlGn', ['NGB']),
-    '51': ('NGBVI', calculate_ngbvi, 'RdYlGn', ['NGB']),
-    '52': ('CIg', calculate_cig_simple, 'Cividis', ['NGB']),
-    '53': ('BWDRVI', calculate_bwdrvi, 'RdYlGn', ['NGB']),
-    '54': ('NDVI', calculate_ndvi, 'RdYlGn', ['RGN']),
-    '55': ('GNDVI', calculate_gndvi, 'RdYlGn', ['RGN']),
-    '56': ('SAVI', calculate_savi, 'Magma', ['RGN']),
-    '57': ('MSAVI', calculate_msavi, 'RdYlGn', ['RGN']),
-    '58': ('OSAVI', calculate_osavi, 'Magma', ['RGN']),
-    '59': ('EVI2', calculate_evi2, 'Plasma', ['RGN']),
-    '60': ('SR', calculate_sr, 'Cividis', ['RGN']),
-    '61': ('RDVI', calculate_rdvi, 'RdYlGn', ['RGN']),
-    '62': ('WDRVI', calculate_wdrvi, 'Inferno', ['RGN']),
-    '63': ('MTVI2', calculate_mtvi2, 'Viridis', ['RGN']),
-    '64': ('DVI', calculate_dvi, 'RdYlGn', ['RGN']),
-    '65': ('NDWI', calculate_ndwi, 'Blues', ['RGN']),
-    '66': ('CIg', calculate_cig, 'Cividis', ['RGN']),
-    '67': ('CIred', calculate_cired, 'Cividis', ['RGN']),
-    '68': ('CVI', calculate_cvi, 'RdYlGn', ['RGN']),
-    '69': ('GRVI', calculate_grvi, 'RdYlGn', ['RGN']),
-    '70': ('RGRI', calculate_rgri, 'RdYlGn', ['RGN']),
-    '71': ('NGRDI', calculate_ngrdi, 'RdYlGn', ['RGN']),
-    '72': ('GLI2', calculate_gli2, 'RdYlGn', ['RGB'])
-}
+@app.route('/stats', methods=['POST'])
+def compute_stats():
+    try:
+        index = request.form['index']
+        image_type = request_image_type()
+        error = index_error(index, image_type)
+        if error:
+            app.logger.error(error[0])
+            return error
+        label = INDICES[index].label
+
+        try:
+            thresholds = [float(value) for value in request.form.get('thresholds', '').split(',') if value]
+            percentiles = [float(value) for value in request.form.get('percentiles', '').split(',') if value] or list(DEFAULT_PERCENTILES)
+            bins = int(request.form.get('bins', 64))
+        except ValueError as e:
+            return f"Error: Invalid statistics option: {e}", 400
+        if not all(0 <= q <= 100 for q in percentiles) or bins < 1:
+            return "Error: Percentiles must be within 0-100 and bins positive.", 400
+
+        upload, error = receive_upload()
+        if error:
+            app.logger.error(error[0])
+            return error
+        filename, upload_id, name = upload
+        error = layout_error(image_type, upload_id)
+        if error:
+            app.logger.error(error[0])
+            return error
+
+        # Dashboards poll the same frames over and over, so the numbers are
+        # cached next to the rendered results
+        output_file = result_output_file(upload_id, index, image_type, label, None, ext='.json',
+                                         thresholds=thresholds, percentiles=percentiles, bins=bins)
+        output_name = os.path.join(app.config['RESULT_FOLDER'], output_file)
+        if cached_result(output_file):
+            with open(output_name) as f:
+                return jsonify(json.load(f))
+
+        response = {'upload_id': upload_id, 'index': index, 'label': label, 'image_type': image_type}
+        response.update(index_statistics(open_upload(upload_id), image_type, index, thresholds, percentiles, bins))
+        save_json_result(output_name, response)
+        return jsonify(response)
 
-# === Routes ===
-@app.route('/')
-def index():
-    app.logger.debug('Index page accessed')
-    return render_template('index.html', index_functions=index_functions, colormap_options=colormap_options)
+    except Exception as e:
+        app.logger.error(f"Error while computing statistics: {e}")
+        return "Internal server error", 500
 
-@app.route('/process', methods=['POST'])
-def process():
+@app.route('/series', methods=['POST'])
+def compute_series():
+    # Change detection over frames of the same field from several dates,
+    # sent as the upload_id of each (see /uploads), oldest first, with their
+    # ISO dates; without dates the trend is per date instead of per day.
+    # compare=previous diffs the last date against the one before it rather
+    # than against the first.
     try:
-        if 'image' not in request.files:
-            app.logger.error('No file part in request')
-            return "No file part", 400
-        file = request.files['image']
-        if file.filename == '':
-            app.logger.error('No selected file')
-            return "No selected file", 400
-        if file:
-            index = request.form['index']
-            image_type = request.form['image_type']
-            colormap_name = request.form['colormap']
-            label, func, default_colormap, valid_types = index_functions[index]
-
-            if image_type not in valid_types:
-                error_message = f"Error: The selected index {label} is not valid for the image type {image_type}."
-                app.logger.error(error_message)
-                return error_message, 400
-
-            if colormap_name not in colormap_options:
-                colormap_name = default_colormap
-
-            filename = os.path.join(app.config['UPLOAD_FOLDER'], file.filename)
-            file.save(filename)
-            app.logger.debug(f"File saved to {filename}")
-
-            rgb = imageio.imread(filename)
-
-            # Read bands based on type
-            if image_type == 'RGN':
-                R = np.asarray(rgb[:,:,0], float)
-                G = np.asarray(rgb[:,:,1], float)
-                NIR = np.asarray(rgb[:,:,2], float)
-                B = None
-            elif image_type == 'NGB':
-                NIR = np.asarray(rgb[:,:,0], float)
-                G = np.asarray(rgb[:,:,1], float)
-                B = np.asarray(rgb[:,:,2], float)
-                R = None
-            else:  # RGB
-                R = np.asarray(rgb[:,:,0], float)
-                G = np.asarray(rgb[:,:,1], float)
-                B = np.asarray(rgb[:,:,2], float)
-                NIR = None
-
-            # Arguments per index
-            args = {
-                '1': (NIR, R),
-                '2': (NIR, B),
-                '3': (NIR, G, B),
-                '4': (NIR, R, G),
-                '5': (NIR, R),
-                '6': (NIR, R, G),
-                '7': (NIR if NIR is not None else R, G),
-                '8': (NIR, R),
-                '9': (NIR, R),
-                '10': (NIR, R, G),
-                '11': (NIR, R),
-                '12': (G, NIR),
-                '13': (G, R, B),
-                '14': (NIR, R, B),
-                '15': (G, NIR, R),
-                '16': (G, R),
-                '17': (G, R, B),
-                '18': (R, G),
-                '19': (G, R, B),
-                '20': (G, R, B),
-                '21': (G, R, B),
-                '22': (R, G, B),
-                '23': (G, B),
-                '24': (G, R, B),
-                '25': (G, R, B),
-                '26': (G, R, B),
-                '27': (G, R, B),
-                '28': (R, G, B),
-                '29': (R, G),
-                '30': (R, G),
-                '31': (R, G),
-                '32': (R, G, B),
-                '33': (R, B),
-                '34': (NIR, G),
-                '35': (NIR, G),
-                '36': (NIR, B),
-                '37': (G, B),
-                '38': (G, B),
-                '39': (NIR, G, B),
-                '40': (NIR, G),
-                '41': (NIR, G, B),
-                '42': (G, NIR),
-                '43': (NIR, G),
-                '44': (NIR, G, B),
-                '45': (NIR, G),
-                '46': (NIR, G),
-                '48': (NIR, G),
-                '49': (G, NIR),
-                '50': (NIR, B),
-                '51': (G, B),
-                '52': (NIR, G),
-                '53': (NIR, B),
-                '54': (NIR, R),
-                '55': (NIR, G),
-                '56': (NIR, R),
-                '57': (NIR, R),
-                '58': (NIR, R),
-                '59': (NIR, R),
-                '60': (NIR, R),
-                '61': (NIR, R),
-                '62': (NIR, R),
-                '63': (NIR, R, G),
-                '64': (NIR, R),
-                '65': (G, NIR),
-                '66': (NIR, G),
-                '67': (NIR, R),
-                '68': (NIR, R, G),
-                '69': (G, R),
-                '70': (R, G),
-                '71': (G, R),
-                '72': (G, R, B)
-            }
+        upload_ids = [value for field in request.form.getlist('upload_ids') for value in field.split(',') if value]
+        dates = [value for field in request.form.getlist('dates') for value in field.split(',') if value]
+        index = request.form['index']
+        image_type = request_image_type()
+        colormap_name = request.form.get('colormap')
+        compare = request.form.get('compare', 'first')
+        error = index_error(index, image_type)
+        if error:
+            app.logger.error(error[0])
+            return error
+        label = INDICES[index].label
+
+        if len(upload_ids) < 2:
+            return "Error: A series needs the upload_id of at least two dates.", 400
+        if compare not in COMPARE_MODES:
+            return f"Error: compare must be one of {', '.join(COMPARE_MODES)}.", 400
+        if dates:
+            if len(dates) != len(upload_ids):
+                return f"Error: Got {len(dates)} dates for {len(upload_ids)} uploads.", 400
+            try:
+                times = date_offsets(dates)
+            except ValueError as e:
+                return f"Error: Invalid dates: {e}", 400
+        else:
+            times = list(range(len(upload_ids)))
+        # Diverging by default: losses red, gains green
+        if colormap_name not in colormap_options:
+            colormap_name = 'RdYlGn'
+
+        sizes = set()
+        for upload_id in upload_ids:
+            if not upload_store.exists(app.config['UPLOAD_CACHE_FOLDER'], upload_id):
+                return f"Unknown or expired upload {upload_id}", 404
+            error = layout_error(image_type, upload_id)
+            if error:
+                app.logger.error(error[0])
+                return error
+            sizes.add(upload_store.load(app.config['UPLOAD_CACHE_FOLDER'], upload_id).shape[:2])
+        if len(sizes) > 1:
+            return "Error: The frames of a series must be co-registered to the same size.", 400
+
+        options = {'times': times, 'compare': compare}
+        outputs = {
+            'difference': result_output_file(upload_ids, index, image_type, f'{label}_change', None, ext='.npy', series='difference', **options),
+            'trend': result_output_file(upload_ids, index, image_type, f'{label}_trend', None, ext='.npy', series='trend', **options),
+            'difference_image': result_output_file(upload_ids, index, image_type, f'{label}_change', colormap_name, series='difference', **options),
+            'trend_image': result_output_file(upload_ids, index, image_type, f'{label}_trend', colormap_name, series='trend', **options)
+        }
+        output_file = result_output_file(upload_ids, index, image_type, f'{label}_series', colormap_name, ext='.json', **options)
+        output_name = os.path.join(app.config['RESULT_FOLDER'], output_file)
+        if all(cached_result(name) for name in [output_file, *outputs.values()]):
+            with open(output_name) as f:
+                return jsonify({**json.load(f), 'computed': []})
+
+        trend_unit = 'day' if dates else 'date'
+        date_stats, difference_stats, trend_stats, computed = series_changes(upload_ids, times, trend_unit, index, image_type, label,
+                                                                             colormap_name, compare, outputs)
+        urls = {kind: url_for('static', filename=f'results/{name}') for kind, name in outputs.items()}
+        response = {
+            'index': index,
+            'label': label,
+            'image_type': image_type,
+            'compare': compare,
+            'trend_unit': trend_unit,
+            'dates': [{'upload_id': upload_id, 'date': dates[i] if dates else None, 'stats': stats.summary()}
+                      for i, (upload_id, stats) in enumerate(zip(upload_ids, date_stats))],
+            'difference': {'processed_image_url': urls['difference_image'], 'export_url': urls['difference'], 'stats': difference_stats.summary()},
+            'trend': {'processed_image_url': urls['trend_image'], 'export_url': urls['trend'], 'stats': trend_stats.summary()}
+        }
+        save_json_result(output_name, response)
+        app.logger.debug(f'Compared {len(upload_ids)} dates, computed {len(computed)}')
+        return jsonify({**response, 'computed': computed})
 
-            if index in args:
-                index_args = args[index]
-                if any(arg is None for arg in index_args):
-                    error_message = f"Error: The selected index {label} requires bands that are not available in the image type {image_type}."
-                    app.logger.error(error_message)
-                    return error_message, 400
-            else:
-                error_message = f"Error: Invalid index selection."
-                app.logger.error(error_message)
-                return error_message, 400
+    except Exception as e:
+        app.logger.error(f"Error while comparing dates: {e}")
+        return "Internal server error", 500
 
-            base_filename, ext = os.path.splitext(file.filename)
-            output_name = os.path.join(app.config['RESULT_FOLDER'], f'{base_filename}_{label}.png')
-            process_and_save(filename, output_name, func, label, colormap_name, *index_args)
+@app.route('/zones', methods=['POST'])
+def compute_zones():
+    # Per-zone count, mean, std, min, max and percentiles of one or more
+    # indices (repeated 'indices' fields or comma-separated) for every plot
+    # of a layout: GeoJSON polygons in pixel coordinates (x = column, y =
+    # row) as 'zones', a label image as 'zone_mask', or the layout_id an
+    # earlier response returned
+    try:
+        indices = [key for value in request.form.getlist('indices') for key in value.split(',') if key]
+        image_type = request_image_type()
+        if not indices:
+            return "Error: Invalid index selection.", 400
+        for index in indices:
+            error = index_error(index, image_type)
+            if error:
+                app.logger.error(error[0])
+                return error
+
+        try:
+            percentiles = [float(value) for value in request.form.get('percentiles', '').split(',') if value] or list(DEFAULT_PERCENTILES)
+        except ValueError as e:
+            return f"Error: Invalid statistics option: {e}", 400
+        if not all(0 <= q <= 100 for q in percentiles):
+            return "Error: Percentiles must be within 0-100.", 400
+
+        upload, error = receive_upload()
+        if error:
+            app.logger.error(error[0])
+            return error
+        filename, upload_id, name = upload
+        error = layout_error(image_type, upload_id)
+        if error:
+            app.logger.error(error[0])
+            return error
+        rgb = open_upload(upload_id)
+        layout, error = receive_zone_layout(*rgb.shape[:2])
+        if error:
+            app.logger.error(error[0])
+            return error
+        layout_id, labels, zones = layout
+
+        output_file = result_output_file(upload_id, indices, image_type, 'zones', None, ext='.json', layout=layout_id, percentiles=percentiles)
+        output_name = os.path.join(app.config['RESULT_FOLDER'], output_file)
+        if cached_result(output_file):
+            with open(output_name) as f:
+                return jsonify(json.load(f))
+
+        response = {'upload_id': upload_id, 'layout_id': layout_id, 'image_type': image_type, 'zones': zones, 'indices': {}}
+        for index in indices:
+            response['indices'][index] = {'label': INDICES[index].label,
+                                          'zones': zone_statistics(rgb, image_type, index, labels, zones, percentiles)}
+        save_json_result(output_name, response)
+        return jsonify(response)
 
-            app.logger.debug(f'Processed image saved: {output_name}')
-            return jsonify({'processed_image_url': url_for('static', filename=f'results/{base_filename}_{label}.png')})
+    except Exception as e:
+        app.logger.error(f"Error while computing zone statistics: {e}")
+        return "Internal server error", 500
+
+@app.route('/process_batch', methods=['POST'])
+def process_batch():
+    try:
+        # Accept repeated 'indices' fields or a single comma-separated value
+        indices = [key for value in request.form.getlist('indices') for key in value.split(',') if key]
+        image_type = request_image_type()
+        colormap_name = request.form.get('colormap')
+        output_format = request.form.get('format', 'json')
+
+        unknown = [key for key in indices if key not in INDICES]
+        if not indices or unknown:
+            error_message = f"Error: Invalid index selection {', '.join(unknown)}."
+            app.logger.error(error_message)
+            return error_message, 400
+        encoding, error = parse_encoding()
+        if error:
+            app.logger.error(error[0])
+            return error
+        ext = OUTPUT_FORMATS[encoding['output_format']]
+        normalization, error = parse_normalization()
+        if error:
+            app.logger.error(error[0])
+            return error
+
+        upload, error = receive_upload()
+        if error:
+            app.logger.error(error[0])
+            return error
+        filename, upload_id, base_filename = upload
+        error = layout_error(image_type, upload_id)
+        if error:
+            app.logger.error(error[0])
+            return error
+
+        results = {}
+        errors = {}
+        pending = []
+        for index in dict.fromkeys(indices):
+            spec = INDICES[index]
+            label = spec.label
+            if not spec.offered_for(image_type):
+                errors[index] = f"Error: The selected index {label} is not valid for the image type {image_type}."
+                continue
+            if spec.band_names(image_type) is None:
+                errors[index] = f"Error: Processing {label} failed: bands not available in the image type {image_type}"
+                continue
+            range_options = index_normalization(normalization, index)
+            index_colormap = colormap_name if colormap_name in colormap_options else spec.colormap
+            output_file = result_output_file(upload_id, index, image_type, label, index_colormap, ext=ext, tiled=False,
+                                             normalization=range_options, **encoding)
+            results[index] = {
+                'label': label,
+                'output_file': output_file,
+                'processed_image_url': url_for('static', filename=f'results/{output_file}')
+            }
+            if not cached_result(output_file):
+                pending.append((index, index_colormap, range_options))
+
+        if pending:
+            # Decode and split the bands once for every index not already cached
+            specs = [INDICES[index] for index, index_colormap, range_options in pending]
+            needed = {name for spec in specs for name in spec.band_names(image_type)}
+            rgb = open_upload(upload_id)
+            with metrics.stage('bands'):
+                bands, band_files = batch_bands(upload_id, rgb, image_type, needed)
+
+            # One plan for the whole batch: subexpressions shared between indices
+            # (NIR+R, NIR-R, ...) are computed once, and each index is rendered as
+            # soon as it is complete so finished results don't pile up in memory
+            plan = make_plan(specs, image_type)
+            with result_cache.pinned([filename, *band_files]):
+                for position, result in metrics.timed_iter('index', plan.run(bands)):
+                    index, index_colormap, range_options = pending[position]
+                    output_name = os.path.join(app.config['RESULT_FOLDER'], results[index]['output_file'])
+                    tmp_name = result_cache.temporary_path(output_name)
+                    try:
+                        save_result(result, tmp_name, results[index]['label'], index_colormap, encoding=encoding, normalization=range_options)
+                        os.replace(tmp_name, output_name)
+                    except Exception as e:
+                        errors[index] = f"Error: Processing {results.pop(index)['label']} failed: {e}"
+                    finally:
+                        result_cache.discard(tmp_name)
+            del bands
+            result_cache.evict(app.config['RESULT_FOLDER'], app.config['RESULT_CACHE_MAX_BYTES'])
+
+        for index, error_message in errors.items():
+            app.logger.error(error_message)
+        if not results:
+            return jsonify({'results': results, 'errors': errors}), 400
+
+        if output_format == 'zip':
+            buf = BytesIO()
+            # PNGs are already deflated, so store them as-is
+            names = file_labels(results)
+            with zipfile.ZipFile(buf, 'w', zipfile.ZIP_STORED) as archive:
+                for index, result in results.items():
+                    archive.write(os.path.join(app.config['RESULT_FOLDER'], result['output_file']), f"{base_filename}_{names[index]}{ext}")
+            buf.seek(0)
+            return send_file(buf, mimetype='application/zip', as_attachment=True, download_name=f'{base_filename}_indices.zip')
+
+        app.logger.debug(f'Processed {len(results)} indices for {filename}')
+        return jsonify({'upload_id': upload_id, 'results': results, 'errors': errors})
 
     except Exception as e:
-        app.logger.error(f"Error during processing: {e}")
+        app.logger.error(f"Error during batch processing: {e}")
         return "Internal server error", 500
 
 if __name__ == '__main__':
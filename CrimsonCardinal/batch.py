@@ -0,0 +1,196 @@
+# Headless batch processing for whole flight folders. Frames are spread over a
+# process pool; each worker renders every requested index for its frame with
+# the same code the web app uses. Finished outputs are skipped on a rerun, so
+# an interrupted flight can simply be started again.
+#
+#   python CrimsonCardinal/batch.py flights/2024-06-12 -i 1,5,8 -t RGN -o out/
+#   python CrimsonCardinal/batch.py 'flights/*/IMG_*.JPG' -i 1 -t RGN -c Jet -o out/ -j 8
+#   python CrimsonCardinal/batch.py flights/2024-06-12 -i 1 -t RGN -o values/ --export tiff
+#   python CrimsonCardinal/batch.py flights/2024-06-12 -i 1,5 -t RGN -o out/ --format jpeg --quality 85
+#   python CrimsonCardinal/batch.py 'stacks/*.tif' -i 1,2,5 -t B,G,R,NIR,RE -o out/
+#   python CrimsonCardinal/batch.py flights/2024-06-12 -i 60 -t RGN -o out/ --normalize percentile --clip 2,98
+import argparse
+import glob
+import logging
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import app
+import result_cache
+from raster_io import OUTPUT_FORMATS, open_raster
+from vegetation_indices import INDICES, band_layout, engine
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.tif', '.tiff', '.npy')
+
+
+def find_frames(sources, recursive=False):
+    frames = []
+    for source in sources:
+        if os.path.isdir(source):
+            pattern = os.path.join(source, '**', '*') if recursive else os.path.join(source, '*')
+            matches = glob.glob(pattern, recursive=recursive)
+        else:
+            matches = glob.glob(source, recursive=recursive)
+        frames.extend(path for path in matches if os.path.isfile(path) and path.lower().endswith(IMAGE_EXTENSIONS))
+    return sorted(dict.fromkeys(os.path.abspath(path) for path in frames))
+
+
+def frame_root(frames):
+    # Outputs mirror the frames' folders below this one, so IMG_1.JPG from
+    # two flight folders doesn't end up under the same name
+    return os.path.commonpath([os.path.dirname(frame) for frame in frames])
+
+
+def output_path(output_dir, root, frame, name, export=None, output_format='png'):
+    # name is the index's file label (see app.file_labels)
+    ext = app.EXPORT_FORMATS[export] if export else OUTPUT_FORMATS[output_format]
+    stem = os.path.splitext(os.path.relpath(frame, root))[0]
+    return os.path.join(output_dir, f'{stem}_{name}{ext}')
+
+
+def init_worker(dtype):
+    # Pool processes get one numexpr thread and one PNG encoding thread each;
+    # the pool already keeps every core busy
+    app.app.config['BAND_DTYPE'] = dtype
+    app.app.config['ENCODE_WORKERS'] = 1
+    logging.getLogger().setLevel(logging.WARNING)
+    if engine.numexpr is not None:
+        engine.numexpr.set_num_threads(1)
+
+
+def process_frame(frame, output_dir, root, tasks, image_type, overwrite, export=None, encoding=None):
+    # Returns (frame, pixels, output files written, skipped, errors)
+    encoding = encoding or app.default_encoding()
+    output_format = encoding['output_format']
+    todo = [task for task in tasks if overwrite or not os.path.exists(output_path(output_dir, root, frame, task[4], export, output_format))]
+    if not todo:
+        return frame, 0, [], len(tasks), []
+
+    rgb = open_raster(frame)
+    pixels = rgb.shape[0] * rgb.shape[1]
+    # Strip rendering streams PNG only; other formats need the whole canvas
+    tiled = pixels >= app.app.config['TILED_MIN_PIXELS'] and output_format == 'png'
+    if not (tiled or export):
+        # Every band the frame's indices read, converted once for all of them
+        needed = {name for index, *_ in todo for name in INDICES[index].band_names(image_type)}
+        bands = app.read_bands(rgb, image_type, app.app.config['BAND_DTYPE'], needed)
+
+    written = []
+    errors = []
+    for index, label, colormap_name, normalization, name in todo:
+        output_name = output_path(output_dir, root, frame, name, export, output_format)
+        os.makedirs(os.path.dirname(output_name), exist_ok=True)
+        # Outputs only appear under their final name once complete, which is
+        # what makes skipping existing files safe after an interruption
+        tmp_name = result_cache.temporary_path(output_name)
+        try:
+            if export:
+                app.export_index(rgb, tmp_name, index, image_type, export)
+            elif tiled:
+                app.process_tiled(rgb, tmp_name, index, image_type, label, colormap_name, encoding=encoding, normalization=normalization)
+            else:
+                spec = INDICES[index]
+                app.process_and_save(tmp_name, spec.formula, label, colormap_name, *spec.arguments(bands, image_type), encoding=encoding,
+                                     normalization=normalization)
+            os.replace(tmp_name, output_name)
+            written.append(output_name)
+        except Exception as e:
+            errors.append(f'{label}: {e}')
+        finally:
+            result_cache.discard(tmp_name)
+    return frame, pixels, written, len(tasks) - len(todo), errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Render vegetation indices for every frame of a flight.')
+    parser.add_argument('sources', nargs='+', help='frame files, directories or glob patterns')
+    parser.add_argument('-i', '--index', action='append', required=True, help='index keys, repeated or comma-separated')
+    parser.add_argument('-t', '--image-type', required=True,
+                        help="RGN, NGB, RGB, a layout from BAND_LAYOUTS or the band of each channel, e.g. 'B,G,R,NIR,RE'")
+    parser.add_argument('-c', '--colormap', help="colormap for every index (default: each index's own)")
+    parser.add_argument('-o', '--output', required=True, help='output directory')
+    parser.add_argument('-j', '--workers', type=int, default=os.cpu_count(), help='worker processes (default: all cores)')
+    parser.add_argument('-r', '--recursive', action='store_true', help='search directories and ** patterns recursively')
+    parser.add_argument('--dtype', choices=['float32', 'float64'], default=app.app.config['BAND_DTYPE'])
+    parser.add_argument('--export', choices=sorted(app.EXPORT_FORMATS), help='write raw float32 index values instead of rendered PNGs')
+    parser.add_argument('--format', choices=sorted(OUTPUT_FORMATS), default=app.app.config['OUTPUT_FORMAT'], help='rendered image format')
+    parser.add_argument('--quality', type=int, default=app.app.config['OUTPUT_QUALITY'], help='JPEG and WebP quality, 1-100')
+    parser.add_argument('--compress-level', type=int, default=app.app.config['PNG_COMPRESS_LEVEL'],
+                        help='PNG zlib level, 0-9; 1 is several times faster than the default for slightly larger files')
+    parser.add_argument('--normalize', choices=app.NORMALIZE_MODES, default=app.app.config['NORMALIZE'],
+                        help="colormap range: the frame's min-max, clipped at --clip percentiles, or the index's fixed range")
+    parser.add_argument('--clip', default=','.join(map(str, app.app.config['CLIP_PERCENTILES'])), help='low,high percentiles for --normalize percentile')
+    parser.add_argument('--symmetric', action='store_true', default=app.app.config['SYMMETRIC_RANGE'], help='center the colormap range on 0')
+    parser.add_argument('--overwrite', action='store_true', help='render outputs that already exist again')
+    options = parser.parse_args()
+
+    indices = list(dict.fromkeys(key for value in options.index for key in value.split(',') if key))
+    if options.image_type in app.app.config['BAND_LAYOUTS']:
+        options.image_type = ','.join(app.app.config['BAND_LAYOUTS'][options.image_type])
+    try:
+        band_layout(options.image_type)
+    except ValueError as e:
+        parser.error(str(e))
+    try:
+        clip = [float(value) for value in options.clip.split(',')]
+    except ValueError:
+        clip = []
+    if len(clip) != 2 or not 0 <= clip[0] < clip[1] <= 100:
+        parser.error('--clip must be two increasing percentiles within 0-100')
+    normalization = {'mode': options.normalize, 'clip': clip, 'symmetric': options.symmetric}
+    tasks = []
+    names = app.file_labels(index for index in indices if index in INDICES)
+    for index in indices:
+        if index not in INDICES:
+            parser.error(f'unknown index {index}')
+        spec = INDICES[index]
+        if not spec.offered_for(options.image_type) or spec.band_names(options.image_type) is None:
+            parser.error(f'index {index} ({spec.label}) is not valid for the image type {options.image_type}')
+        if options.colormap is not None and options.colormap not in app.colormap_options:
+            parser.error(f'unknown colormap {options.colormap}')
+        tasks.append((index, spec.label, options.colormap or spec.colormap, app.index_normalization(normalization, index), names[index]))
+
+    if not (1 <= options.quality <= 100 and 0 <= options.compress_level <= 9):
+        parser.error('--quality must be within 1-100 and --compress-level within 0-9')
+    encoding = {'output_format': options.format, 'quality': options.quality, 'compress_level': options.compress_level}
+
+    frames = find_frames(options.sources, options.recursive)
+    if not frames:
+        parser.error('no frames found')
+    os.makedirs(options.output, exist_ok=True)
+    root = frame_root(frames)
+
+    print(f'{len(frames)} frames x {len(tasks)} indices on {options.workers} workers', file=sys.stderr)
+    start = time.perf_counter()
+    pixels = skipped = 0
+    written = set()
+    failed = {}
+    with ProcessPoolExecutor(max_workers=options.workers, initializer=init_worker, initargs=(options.dtype,)) as executor:
+        futures = [executor.submit(process_frame, frame, options.output, root, tasks, options.image_type, options.overwrite, options.export, encoding) for frame in frames]
+        for done, future in enumerate(as_completed(futures), 1):
+            try:
+                frame, frame_pixels, frame_written, frame_skipped, errors = future.result()
+            except Exception as e:
+                frame = frames[futures.index(future)]
+                frame_pixels, frame_written, frame_skipped, errors = 0, [], 0, [str(e)]
+            pixels += frame_pixels
+            written.update(frame_written)
+            skipped += frame_skipped
+            if errors:
+                failed[frame] = errors
+            status = f'{len(frame_written)} rendered, {frame_skipped} skipped' + (f', {len(errors)} failed' if errors else '')
+            print(f'[{done}/{len(frames)}] {os.path.relpath(frame, root)}: {status}', file=sys.stderr)
+
+    elapsed = time.perf_counter() - start
+    for frame, errors in failed.items():
+        for error in errors:
+            print(f'error: {frame}: {error}', file=sys.stderr)
+    print(f'{len(written)} outputs written, {skipped} skipped, {sum(map(len, failed.values()))} failed in {elapsed:.1f} s')
+    print(f'{len(frames) / elapsed:.2f} frames/s, {len(written) / elapsed:.2f} outputs/s, {pixels / 1e6 / elapsed:.1f} MP/s decoded')
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,72 @@
+# === Multi-date change detection ===
+# Compares co-registered index rasters of one field flown on several dates,
+# oldest first: the change of the last date against the first (or the
+# previous) one, and each pixel's least-squares trend over all dates, with the
+# dates where the pixel is NaN left out of its fit. The per-date arrays are
+# read one row strip at a time, so a long series holds a strip per date and
+# never a whole frame.
+import datetime
+
+import numpy as np
+
+from index_stats import StreamingStats
+
+COMPARE_MODES = ('first', 'previous')
+
+
+def date_offsets(dates):
+    # Days since the first date; ISO dates (2024-06-12), oldest first
+    days = [datetime.date.fromisoformat(value).toordinal() for value in dates]
+    if any(later <= earlier for earlier, later in zip(days, days[1:])):
+        raise ValueError('Dates must be given oldest first, without repeats')
+    return [day - days[0] for day in days]
+
+
+def change_strip(strips, times, compare='first'):
+    # (difference, trend) of one row strip, both float32. The trend is the
+    # slope per time unit of the fit through a pixel's finite values, NaN
+    # where fewer than two dates have one.
+    reference = strips[0] if compare == 'first' else strips[-2]
+    difference = np.subtract(strips[-1], reference, dtype=np.float32)
+
+    # Centered times keep the sums small, so the float64 slope doesn't cancel
+    mean_time = sum(times) / len(times)
+    shape = strips[0].shape
+    count, sum_t, sum_tt, sum_y, sum_ty = (np.zeros(shape) for _ in range(5))
+    for time, values in zip(times, strips):
+        t = time - mean_time
+        valid = np.isfinite(values)
+        np.add(count, 1, out=count, where=valid)
+        np.add(sum_t, t, out=sum_t, where=valid)
+        np.add(sum_tt, t * t, out=sum_tt, where=valid)
+        np.add(sum_y, values, out=sum_y, where=valid)
+        np.add(sum_ty, np.multiply(values, t, dtype=np.float64), out=sum_ty, where=valid)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slope = (sum_ty - sum_t * sum_y / count) / (sum_tt - sum_t * sum_t / count)
+    slope[count < 2] = np.nan
+    return difference, slope.astype(np.float32)
+
+
+def write_changes(series, times, difference_path, trend_path, strip_rows, compare='first'):
+    # Streams the per-date arrays (2-D, same shape) into float32 .npy files of
+    # the difference and the trend. Returns StreamingStats for every date, the
+    # difference and the trend; the latter two count values above 0, i.e. the
+    # share of the field that improved.
+    height, width = series[0].shape
+    difference = np.lib.format.open_memmap(difference_path, mode='w+', dtype=np.float32, shape=(height, width))
+    trend = np.lib.format.open_memmap(trend_path, mode='w+', dtype=np.float32, shape=(height, width))
+    date_stats = [StreamingStats() for _ in series]
+    difference_stats, trend_stats = StreamingStats(thresholds=(0,)), StreamingStats(thresholds=(0,))
+    for start in range(0, height, strip_rows):
+        strips = [np.asarray(values[start:start + strip_rows]) for values in series]
+        for stats, strip in zip(date_stats, strips):
+            stats.add(strip)
+        strip_difference, strip_trend = change_strip(strips, times, compare)
+        difference[start:start + strip_rows] = strip_difference
+        trend[start:start + strip_rows] = strip_trend
+        difference_stats.add(strip_difference)
+        trend_stats.add(strip_trend)
+    difference.flush()
+    trend.flush()
+    del difference, trend
+    return date_stats, difference_stats, trend_stats
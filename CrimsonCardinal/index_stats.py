@@ -0,0 +1,180 @@
+# === Streaming index statistics ===
+# Summary numbers for an index are accumulated strip by strip in one pass:
+# exact count, min, max, mean, standard deviation and threshold shares, the
+# median and percentiles from a QuantileSketch (the same sketch percentile
+# normalization uses, so /stats and the clipped display range agree), and a
+# fixed-size histogram for the returned histogram. The histogram starts on
+# the first strip's range and, when a later strip falls outside it, doubles
+# its bin width until it fits, merging old bins exactly. No sorted copy of
+# the frame is made.
+import math
+
+import numpy as np
+
+DEFAULT_PERCENTILES = (1, 5, 10, 25, 50, 75, 90, 95, 99)
+SKETCH_BLOCK_ELEMENTS = 1 << 18
+
+
+class StreamingStats:
+    def __init__(self, thresholds=(), resolution=4096):
+        self.thresholds = [float(t) for t in thresholds]
+        self.resolution = resolution
+        self.count = 0
+        self.nonfinite = 0
+        self.total = 0.0
+        self.total_squares = 0.0
+        self.minimum = math.inf
+        self.maximum = -math.inf
+        self.above = [0] * len(self.thresholds)
+        self.lo = None
+        self.width = None
+        self.counts = np.zeros(resolution, dtype=np.int64)
+        self.sketch = QuantileSketch()
+
+    def add(self, values):
+        values = np.asarray(values).ravel()
+        finite = values[np.isfinite(values)]
+        self.nonfinite += values.size - finite.size
+        if not finite.size:
+            return
+        self.count += finite.size
+        self.total += float(finite.sum(dtype=np.float64))
+        self.total_squares += float(np.dot(finite, finite.astype(np.float64, copy=False)))
+        vmin, vmax = float(finite.min()), float(finite.max())
+        self.minimum = min(self.minimum, vmin)
+        self.maximum = max(self.maximum, vmax)
+        for i, threshold in enumerate(self.thresholds):
+            self.above[i] += int(np.count_nonzero(finite > threshold))
+        self.sketch.add(finite)
+
+        if self.lo is None:
+            self.lo = vmin
+            self.width = (vmax - vmin) / self.resolution if vmax > vmin else max(abs(vmin), 1.0) * 1e-6
+        self._cover(vmin, vmax)
+        index = ((finite - self.lo) / self.width).astype(np.int64)
+        np.clip(index, 0, self.resolution - 1, out=index)
+        self.counts += np.bincount(index, minlength=self.resolution)
+
+    def _cover(self, vmin, vmax):
+        lo, width, bins = self.lo, self.width, self.resolution
+        if vmin >= lo and vmax <= lo + bins * width:
+            return
+        # Shift the origin down by whole bins, widening them by powers of two
+        # only when the shift alone doesn't fit; every old bin then falls
+        # entirely inside one new bin
+        occupied = np.flatnonzero(self.counts)
+        top = occupied[-1] if occupied.size else 0
+        factor = 1
+        while True:
+            new_width = width * factor
+            shift = max(0, math.ceil((lo - vmin) / new_width))
+            new_lo = lo - shift * new_width
+            if new_lo + bins * new_width >= vmax and shift + top // factor < bins:
+                break
+            factor *= 2
+        merged = np.zeros(bins, dtype=np.int64)
+        np.add.at(merged, shift + occupied // factor, self.counts[occupied])
+        self.lo, self.width, self.counts = new_lo, new_width, merged
+
+    def percentile(self, q):
+        # Within the sketch's relative accuracy of the true value, however
+        # far a few outliers stretch the histogram's bins
+        return self.sketch.percentile(q)
+
+    def histogram(self, bins=64):
+        if not self.count:
+            return {'edges': [], 'counts': []}
+        used = np.flatnonzero(self.counts)
+        first, last = used[0], used[-1] + 1
+        factor = max(1, math.ceil((last - first) / bins))
+        last = first + math.ceil((last - first) / factor) * factor
+        counts = np.zeros(last - first, dtype=np.int64)
+        available = self.counts[first:last]
+        counts[:len(available)] = available
+        counts = counts.reshape(-1, factor).sum(axis=1)
+        edges = self.lo + (first + np.arange(len(counts) + 1) * factor) * self.width
+        return {'edges': edges.tolist(), 'counts': counts.tolist()}
+
+    def summary(self, percentiles=DEFAULT_PERCENTILES, bins=64):
+        mean = self.total / self.count if self.count else None
+        variance = max(self.total_squares / self.count - mean * mean, 0.0) if self.count else None
+        return {
+            'count': self.count,
+            'nonfinite': self.nonfinite,
+            'min': self.minimum if self.count else None,
+            'max': self.maximum if self.count else None,
+            'mean': mean,
+            'std': math.sqrt(variance) if self.count else None,
+            'median': self.percentile(50),
+            'percentiles': {f'{q:g}': self.percentile(q) for q in percentiles},
+            'above': {f'{t:g}': (above / self.count if self.count else None) for t, above in zip(self.thresholds, self.above)},
+            'histogram': self.histogram(bins)
+        }
+
+
+# === Quantile sketch ===
+# For percentiles (and display ranges clipped at them, 2-98 %), where even
+# bins fail: one hot pixel at 1e4 stretches them until the bulk of the frame
+# shares a handful. Buckets here are spaced logarithmically by
+# magnitude on either side of 0, as in DDSketch, so every quantile is
+# within `accuracy` of its true value relative to its own size, however wide
+# the range. One pass, fixed memory (a few thousand counters), and sketches
+# of separate strips simply add up.
+class QuantileSketch:
+    def __init__(self, accuracy=0.005, min_magnitude=1e-6, max_magnitude=1e12):
+        self.gamma = (1 + accuracy) / (1 - accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.min_magnitude = min_magnitude
+        self.offset = math.floor(math.log(min_magnitude) / self.log_gamma)
+        self.buckets = math.ceil(math.log(max_magnitude) / self.log_gamma) - self.offset + 1
+        # Negative buckets (largest magnitude first), one for |x| < min_magnitude, positive buckets
+        self.counts = np.zeros(2 * self.buckets + 1, dtype=np.int64)
+        self.count = 0
+        self.minimum = math.inf
+        self.maximum = -math.inf
+
+    def add(self, values):
+        # In cache-sized blocks: each value goes through a handful of ufuncs
+        values = np.asarray(values).ravel()
+        for start in range(0, values.size, SKETCH_BLOCK_ELEMENTS):
+            self._add_block(values[start:start + SKETCH_BLOCK_ELEMENTS])
+
+    def _add_block(self, values):
+        finite = np.isfinite(values)
+        finite = values if finite.all() else values[finite]
+        if not finite.size:
+            return
+        self.count += finite.size
+        self.minimum = min(self.minimum, float(finite.min()))
+        self.maximum = max(self.maximum, float(finite.max()))
+        self.counts += np.bincount(self.keys(finite), minlength=len(self.counts))
+
+    def keys(self, finite):
+        # Bucket of |x| counted from 1 (0 below min_magnitude, log(0)
+        # included), then signed around the middle: copysign(bucket, x) + buckets
+        bucket = np.abs(finite, dtype=np.result_type(finite.dtype, np.float32))
+        with np.errstate(divide='ignore'):
+            np.log(bucket, out=bucket)
+        bucket *= 1 / self.log_gamma
+        np.ceil(bucket, out=bucket)
+        bucket -= self.offset - 1
+        np.clip(bucket, 0, self.buckets, out=bucket)
+        np.copysign(bucket, finite, out=bucket)
+        bucket += self.buckets
+        return bucket.astype(np.intp)
+
+    def values(self, keys):
+        # Middle of each bucket, in relative terms; 0 for the one around 0
+        keys = np.asarray(keys)
+        bucket = np.abs(keys - self.buckets) - 1
+        value = 2 * self.gamma ** (bucket + self.offset) / (self.gamma + 1)
+        return np.where(keys == self.buckets, 0.0, np.copysign(value, keys - self.buckets))
+
+    def percentile(self, q):
+        if not self.count:
+            return None
+        if q <= 0 or q >= 100:
+            return self.minimum if q <= 0 else self.maximum
+        rank = min(int(q / 100 * self.count), self.count - 1)
+        key = int(np.searchsorted(np.cumsum(self.counts), rank, side='right'))
+        return min(max(float(self.values(key)), self.minimum), self.maximum)
@@ -0,0 +1,124 @@
+# === Background job queue ===
+# Long renders run on a bounded process pool instead of the request thread.
+# Job state is kept as small JSON files so any WSGI worker can answer a status
+# poll, not only the one that accepted the upload. With timed=True each job
+# records per-stage timings (see metrics), kept in its record and folded into
+# the submitting process's histograms when it finishes.
+import json
+import multiprocessing
+import os
+import re
+import threading
+import time
+import traceback
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import metrics
+
+JOB_ID_PATTERN = re.compile(r'^[0-9a-f]{32}$')
+
+
+class QueueFull(Exception):
+    pass
+
+
+def _write_record(folder, record):
+    path = os.path.join(folder, f"{record['id']}.json")
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(record, f)
+    os.replace(tmp_path, path)
+
+
+def read_record(folder, job_id):
+    if not JOB_ID_PATTERN.match(job_id):
+        return None
+    try:
+        with open(os.path.join(folder, f'{job_id}.json')) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _run_job(folder, record, func, timed=False):
+    # Runs in the pool process; returns the job's timings, if any
+    record.update(status='running', started=time.time())
+    _write_record(folder, record)
+    if timed:
+        metrics.start('job')
+    try:
+        func(**record['kwargs'])
+        record.update(status='done')
+    except Exception as e:
+        record.update(status='error', error=str(e), traceback=traceback.format_exc())
+    timings = metrics.finish(record['status'])
+    if timings:
+        record['timings'] = timings['stages']
+    record['finished'] = time.time()
+    _write_record(folder, record)
+    return timings
+
+
+class JobQueue:
+    def __init__(self, folder, max_workers=2, max_pending=8, ttl=24 * 3600, timed=False, initializer=None, initargs=()):
+        self.folder = folder
+        self.timed = timed
+        # Run once in every pool process, e.g. to apply the submitting app's
+        # settings, which a spawned process doesn't inherit
+        self.initializer = initializer
+        self.initargs = initargs
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.ttl = ttl
+        self._executor = None
+        self._pending = set()
+        self._lock = threading.Lock()
+        os.makedirs(folder, exist_ok=True)
+
+    def _get_executor(self):
+        if self._executor is None:
+            # spawn: forking a threaded WSGI worker can inherit held locks
+            self._executor = ProcessPoolExecutor(max_workers=self.max_workers, mp_context=multiprocessing.get_context('spawn'),
+                                                 initializer=self.initializer, initargs=self.initargs)
+        return self._executor
+
+    def submit(self, func, kwargs):
+        with self._lock:
+            if len(self._pending) >= self.max_pending:
+                raise QueueFull(f'{len(self._pending)} jobs already queued or running')
+            record = {'id': uuid.uuid4().hex, 'status': 'queued', 'submitted': time.time(), 'kwargs': kwargs}
+            _write_record(self.folder, record)
+            future = self._get_executor().submit(_run_job, self.folder, record, func, self.timed)
+            self._pending.add(future)
+        future.add_done_callback(lambda done: self._finished(done, record))
+        self.prune()
+        return record
+
+    def _finished(self, future, record):
+        with self._lock:
+            self._pending.discard(future)
+            error = future.exception()
+            if isinstance(error, BrokenProcessPool):
+                # A pool process died; start a fresh pool for the next submission
+                self._executor = None
+        if error is not None:
+            # _run_job never got to write its final state
+            record.update(status='error', error=str(error) or type(error).__name__, finished=time.time())
+            _write_record(self.folder, record)
+        else:
+            metrics.observe(future.result())
+
+    def status(self, job_id):
+        return read_record(self.folder, job_id)
+
+    def prune(self):
+        cutoff = time.time() - self.ttl
+        for name in os.listdir(self.folder):
+            path = os.path.join(self.folder, name)
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+            except OSError:
+                pass
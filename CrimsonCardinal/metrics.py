@@ -0,0 +1,176 @@
+# === Request metrics ===
+# Wall time per processing stage (upload, decode, band extraction, index,
+# colormap, colorbar, encode, ...) is collected in a thread-local Timer that
+# lives for one request or one background job. Finished timers are folded into
+# in-process histograms, served in the Prometheus text format, and logged as
+# one JSON line each. Outside a timer, stage() hands back a shared no-op
+# context manager, so switching metrics off leaves a thread-local lookup per
+# stage. Histograms are per process: with several WSGI workers, scrape each.
+import bisect
+import contextlib
+import json
+import logging
+import threading
+import time
+
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+MEGAPIXEL_BUCKETS = (0.25, 1, 2, 5, 12, 20, 50, 100, 250, 500, 1000)
+BYTE_BUCKETS = tuple(4 ** k for k in range(8, 18))  # 64 KiB .. 16 GiB
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+logger = logging.getLogger('timing')
+
+
+def _label_value(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+class Histogram:
+    def __init__(self, name, help, buckets, labels=()):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.labels = tuple(labels)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        # Counts are kept per bucket and made cumulative when rendered
+        slot = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][slot] += 1
+            series[1] += value
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            series = sorted((key, list(counts), total) for key, (counts, total) in self._series.items())
+        for label_values, counts, total in series:
+            labels = ','.join(f'{name}="{_label_value(value)}"' for name, value in zip(self.labels, label_values))
+            prefix = labels + ',' if labels else ''
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{prefix}le="{bound}"}} {cumulative}')
+            suffix = f'{{{labels}}}' if labels else ''
+            lines.append(f'{self.name}_sum{suffix} {total!r}')
+            lines.append(f'{self.name}_count{suffix} {cumulative}')
+        return '\n'.join(lines)
+
+
+request_seconds = Histogram('crimson_request_seconds', 'Wall time of instrumented requests and jobs.', SECONDS_BUCKETS, ('endpoint', 'status'))
+stage_seconds = Histogram('crimson_stage_seconds', 'Wall time spent in each processing stage.', SECONDS_BUCKETS, ('endpoint', 'stage'))
+input_megapixels = Histogram('crimson_input_megapixels', 'Size of the processed frame in megapixels.', MEGAPIXEL_BUCKETS, ('endpoint',))
+input_bytes = Histogram('crimson_input_bytes', 'Decoded bytes of the processed frame.', BYTE_BUCKETS, ('endpoint',))
+HISTOGRAMS = (request_seconds, stage_seconds, input_megapixels, input_bytes)
+
+
+class Timer:
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.start = time.perf_counter()
+        self.stages = {}
+        self.megapixels = None
+        self.bytes = None
+
+
+class _Stage:
+    __slots__ = ('stages', 'name', 'start')
+
+    def __init__(self, stages, name):
+        self.stages = stages
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        # Stages entered repeatedly (once per strip) add up
+        self.stages[self.name] = self.stages.get(self.name, 0.0) + time.perf_counter() - self.start
+        return False
+
+
+_NO_STAGE = contextlib.nullcontext()
+_local = threading.local()
+
+
+def start(endpoint):
+    timer = _local.timer = Timer(endpoint)
+    return timer
+
+
+def finish(status=None):
+    # Ends the thread's timer and returns it as a plain dict, which can cross
+    # a process boundary before being observed
+    timer = getattr(_local, 'timer', None)
+    if timer is None:
+        return None
+    _local.timer = None
+    return {
+        'endpoint': timer.endpoint,
+        'status': status,
+        'seconds': time.perf_counter() - timer.start,
+        'stages': timer.stages,
+        'megapixels': timer.megapixels,
+        'bytes': timer.bytes,
+    }
+
+
+def stage(name):
+    timer = getattr(_local, 'timer', None)
+    return _NO_STAGE if timer is None else _Stage(timer.stages, name)
+
+
+def timed_iter(name, iterable):
+    # Times producing each item of a lazy iterable (strips, plan results) as
+    # the stage, leaving whatever the consumer does in between to its own stages
+    if getattr(_local, 'timer', None) is None:
+        return iterable
+    return _timed_iter(name, iter(iterable))
+
+
+def _timed_iter(name, iterator):
+    while True:
+        with stage(name):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
+
+
+def record_input(rgb):
+    timer = getattr(_local, 'timer', None)
+    if timer is not None:
+        timer.megapixels = rgb.shape[0] * rgb.shape[1] / 1e6
+        timer.bytes = rgb.nbytes
+
+
+def observe(record):
+    if record is None:
+        return
+    endpoint = record['endpoint']
+    request_seconds.observe(record['seconds'], endpoint, str(record['status']))
+    for name, seconds in record['stages'].items():
+        stage_seconds.observe(seconds, endpoint, name)
+    if record['megapixels'] is not None:
+        input_megapixels.observe(record['megapixels'], endpoint)
+        input_bytes.observe(record['bytes'], endpoint)
+    if logger.isEnabledFor(logging.INFO):
+        other = record['seconds'] - sum(record['stages'].values())
+        logger.info(json.dumps({
+            'event': 'timing',
+            **{key: record[key] for key in ('endpoint', 'status', 'megapixels', 'bytes')},
+            'seconds': round(record['seconds'], 4),
+            'stages': {name: round(seconds, 4) for name, seconds in record['stages'].items()},
+            'other': round(max(other, 0.0), 4),
+        }))
+
+
+def render():
+    return '\n'.join(histogram.render() for histogram in HISTOGRAMS) + '\n'
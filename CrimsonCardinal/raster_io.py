@@ -0,0 +1,402 @@
+# === Raster input/output for tiled processing ===
+# open_raster() returns an array-like frame that can be sliced by rows without
+# decoding the whole image (memory-mapped .npy and uncompressed TIFF), always
+# as (rows, columns, bands) in the file's own sample type, and
+# PngStripWriter writes a PNG a few rows at a time, so neither side of the
+# tiled pipeline has to hold the full frame. The raw float writers and the
+# tile pyramid writer take the same row strips.
+import json
+import math
+import os
+import struct
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+try:
+    import tifffile
+except ImportError:
+    tifffile = None
+
+try:
+    # Enables the floating-point predictor, which makes float TIFFs compress far better
+    import imagecodecs
+except ImportError:
+    imagecodecs = None
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+PNG_FILTERS = {'none': 0, 'sub': 1}
+GDAL_NODATA = 42113
+# Amount of filtered scanline data each thread deflates at a time
+PARALLEL_CHUNK_BYTES = 1 << 20
+# Output formats and their extensions; webp_lossless is WebP's lossless mode
+OUTPUT_FORMATS = {'png': '.png', 'jpeg': '.jpg', 'webp': '.webp', 'webp_lossless': '.webp'}
+
+
+def channels_last(data, axes=None):
+    # (rows, columns, bands) view of a decoded raster. axes are tifffile's
+    # ('YXS' interleaved, 'SYX' planar, 'IYX'/'QYX' one band per page);
+    # without them the array is taken as (rows, columns[, bands]).
+    if axes is None:
+        axes = 'YXS'[:data.ndim]
+    other = [axis for axis, name in enumerate(axes) if name not in 'YX']
+    if len(axes) != data.ndim or 'Y' not in axes or 'X' not in axes or len(other) > 1:
+        raise ValueError(f'Unsupported raster layout {axes} {data.shape}: expected rows, columns and at most one band axis')
+    data = data.transpose([axes.index('Y'), axes.index('X')] + other)
+    return data if other else data[:, :, np.newaxis]
+
+
+def _read_tiff(source):
+    # 8/16/32-bit and float TIFFs with bands interleaved, planar, one per page,
+    # or one per series (pages written one at a time). Data stored uncompressed
+    # and contiguously in a file on disk are memory-mapped, not decoded.
+    with tifffile.TiffFile(source) as tif:
+        series = list(tif.series)
+        first = series[0]
+        if len(series) > 1 and all(s.axes == 'YX' and s.shape == first.shape and s.dtype == first.dtype for s in series):
+            layouts = [(number, 'YX') for number in range(len(series))]
+        else:
+            layouts = [(0, first.axes)]
+        parts = []
+        for number, axes in layouts:
+            data = None
+            if isinstance(source, str):
+                try:
+                    data = tifffile.memmap(source, series=number, mode='r')
+                except ValueError:
+                    pass
+            if data is None:
+                data = tif.series[number].asarray()
+            parts.append(channels_last(data, axes))
+    # Bands from separate series can't be viewed as one array
+    return parts[0] if len(parts) == 1 else np.concatenate(parts, axis=2)
+
+
+def open_raster(path):
+    # Always (rows, columns, bands), whatever the band count or sample type
+    ext = os.path.splitext(path)[1].lower()
+    if ext == '.npy':
+        return channels_last(np.load(path, mmap_mode='r'))
+    if ext in ('.tif', '.tiff') and tifffile is not None:
+        return _read_tiff(path)
+    # JPEG/PNG can't be read by window; decode once, later stages stay tiled.
+    # imageio is imported here as it takes ~70 ms, which most processes never need
+    import imageio.v2 as imageio
+    return channels_last(imageio.imread(path))
+
+
+def read_raster(stream, filename):
+    # Decodes an in-memory or spooled upload; the extension picks the reader
+    ext = os.path.splitext(filename)[1].lower()
+    if ext == '.npy':
+        return channels_last(np.load(stream))
+    if ext in ('.tif', '.tiff') and tifffile is not None:
+        return _read_tiff(stream)
+    import imageio.v2 as imageio
+    return channels_last(imageio.imread(stream))
+
+
+def _deflate_chunk(data, compress_level, zdict):
+    # Raw deflate ending on a byte boundary (sync flush), so chunks compressed
+    # independently can be concatenated into one stream, as pigz does.
+    # Priming with the previous chunk's tail keeps the ratio close to serial.
+    if zdict:
+        compressor = zlib.compressobj(compress_level, zlib.DEFLATED, -15, zdict=zdict)
+    else:
+        compressor = zlib.compressobj(compress_level, zlib.DEFLATED, -15)
+    return compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+
+class PngStripWriter:
+    # With workers > 1, scanlines are deflated in ~1 MiB chunks on a thread
+    # pool (zlib releases the GIL) and written back in order
+    def __init__(self, path, width, height, compress_level=6, filter_type='sub', workers=1):
+        self.width = width
+        self.height = height
+        self.compress_level = compress_level
+        self.filter = PNG_FILTERS[filter_type]
+        self.rows_written = 0
+        self.file = open(path, 'wb')
+        if workers > 1:
+            self.executor = ThreadPoolExecutor(workers)
+            self.pending = deque()
+            self.max_pending = 2 * workers
+            self.adler = zlib.adler32(b'')
+            self.previous = b''
+            # zlib header: deflate, 32K window
+            self.prefix = b'\x78\x9c'
+        else:
+            self.executor = None
+            self.compressor = zlib.compressobj(compress_level)
+        self.file.write(PNG_SIGNATURE)
+        # 8-bit RGB, deflate, adaptive filtering, no interlace
+        self._chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0))
+
+    def _chunk(self, kind, data):
+        self.file.write(struct.pack('>I', len(data)))
+        self.file.write(kind)
+        self.file.write(data)
+        self.file.write(struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff))
+
+    def write_rows(self, rows):
+        rows = np.ascontiguousarray(rows, dtype=np.uint8).reshape(len(rows), -1)
+        filtered = np.empty((len(rows), rows.shape[1] + 1), dtype=np.uint8)
+        filtered[:, 0] = self.filter
+        if self.filter:
+            # The PNG "Sub" filter (byte minus the byte one pixel to the left)
+            # deflates far better than raw pixels
+            filtered[:, 1:4] = rows[:, :3]
+            np.subtract(rows[:, 3:], rows[:, :-3], out=filtered[:, 4:])
+        else:
+            filtered[:, 1:] = rows
+        self.rows_written += len(rows)
+
+        if self.executor is None:
+            data = self.compressor.compress(filtered.tobytes())
+            if data:
+                self._chunk(b'IDAT', data)
+            return
+
+        chunk_rows = max(1, PARALLEL_CHUNK_BYTES // filtered.shape[1])
+        for start in range(0, len(filtered), chunk_rows):
+            data = filtered[start:start + chunk_rows].tobytes()
+            self.adler = zlib.adler32(data, self.adler)
+            self.pending.append(self.executor.submit(_deflate_chunk, data, self.compress_level, self.previous))
+            self.previous = data[-32768:]
+            while len(self.pending) > self.max_pending:
+                self._write_pending()
+
+    def _write_pending(self):
+        data = self.pending.popleft().result()
+        self._chunk(b'IDAT', self.prefix + data)
+        self.prefix = b''
+
+    def close(self):
+        try:
+            if self.rows_written != self.height:
+                raise ValueError(f'PNG declared {self.height} rows but {self.rows_written} were written')
+            if self.executor is None:
+                self._chunk(b'IDAT', self.compressor.flush())
+            else:
+                while self.pending:
+                    self._write_pending()
+                # Final empty block, then the checksum of all uncompressed data
+                tail = zlib.compressobj(self.compress_level, zlib.DEFLATED, -15).flush()
+                self._chunk(b'IDAT', self.prefix + tail + struct.pack('>I', self.adler & 0xffffffff))
+            self._chunk(b'IEND', b'')
+        finally:
+            self._shutdown()
+
+    def _shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(cancel_futures=True)
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self._shutdown()
+
+
+def encode_image(path, image, output_format='png', quality=90, compress_level=6, png_filter='sub', workers=1):
+    # PNG goes through PngStripWriter so it can use several cores; libjpeg
+    # and libwebp each produce a single stream, so those are encoded by PIL
+    # in one piece
+    if output_format == 'png':
+        with PngStripWriter(path, image.shape[1], image.shape[0], compress_level, png_filter, workers) as writer:
+            writer.write_rows(image)
+    elif output_format == 'jpeg':
+        Image.fromarray(image).save(path, format='JPEG', quality=quality)
+    elif output_format == 'webp':
+        Image.fromarray(image).save(path, format='WEBP', quality=quality)
+    elif output_format == 'webp_lossless':
+        # For lossless WebP, quality is compression effort; follow the zlib level
+        Image.fromarray(image).save(path, format='WEBP', lossless=True, quality=round(compress_level * 100 / 9))
+    else:
+        raise ValueError(f'Unknown output format {output_format}')
+
+
+def _halve(block):
+    # 2x2 box filter for uint8 RGB; odd edges are padded by repeating the last row/column
+    if len(block) % 2:
+        block = np.concatenate([block, block[-1:]])
+    if block.shape[1] % 2:
+        block = np.concatenate([block, block[:, -1:]], axis=1)
+    total = block[0::2, 0::2].astype(np.uint16)
+    total += block[1::2, 0::2]
+    total += block[0::2, 1::2]
+    total += block[1::2, 1::2]
+    total += 2
+    total //= 4
+    return total.astype(np.uint8)
+
+
+class TilePyramidWriter:
+    # Cuts an RGB image arriving in row strips into {z}/{x}/{y}.png tiles for
+    # a pan-and-zoom viewer: z = max_zoom is full resolution and every lower
+    # level halves it, down to a single tile at z = 0. Each level only holds
+    # one row of tiles, and each completed row is halved and fed to the level
+    # below. info.json records the size and zoom range.
+    def __init__(self, folder, width, height, tile=256, compress_level=1):
+        self.folder = folder
+        self.width = width
+        self.height = height
+        self.tile = tile
+        self.compress_level = compress_level
+        self.max_zoom = max(0, math.ceil(math.log2(max(width, height) / tile)))
+        self.levels = []
+        for zoom in range(self.max_zoom, -1, -1):
+            self.levels.append({'zoom': zoom, 'width': width, 'pending': [], 'rows': 0, 'tile_row': 0})
+            width, height = -(-width // 2), -(-height // 2)
+
+    def write_rows(self, rows):
+        self._feed(0, np.asarray(rows, dtype=np.uint8))
+
+    def _feed(self, depth, rows):
+        level = self.levels[depth]
+        level['pending'].append(rows)
+        level['rows'] += len(rows)
+        while level['rows'] >= self.tile:
+            pending = np.concatenate(level['pending']) if len(level['pending']) > 1 else level['pending'][0]
+            rest = pending[self.tile:]
+            level['pending'] = [rest] if len(rest) else []
+            level['rows'] = len(rest)
+            self._emit(depth, pending[:self.tile])
+
+    def _emit(self, depth, block):
+        level = self.levels[depth]
+        zoom_folder = os.path.join(self.folder, str(level['zoom']))
+        for column, x in enumerate(range(0, level['width'], self.tile)):
+            tile = np.full((self.tile, self.tile, 3), 255, dtype=np.uint8)
+            part = block[:, x:x + self.tile]
+            tile[:part.shape[0], :part.shape[1]] = part
+            os.makedirs(os.path.join(zoom_folder, str(column)), exist_ok=True)
+            Image.fromarray(tile).save(os.path.join(zoom_folder, str(column), f"{level['tile_row']}.png"), compress_level=self.compress_level)
+        level['tile_row'] += 1
+        if depth + 1 < len(self.levels):
+            self._feed(depth + 1, _halve(block))
+
+    def close(self):
+        # Partial last rows, from full resolution down, so each flush can
+        # still feed the level below before that one is flushed
+        for depth, level in enumerate(self.levels):
+            if level['rows']:
+                pending = np.concatenate(level['pending']) if len(level['pending']) > 1 else level['pending'][0]
+                level['pending'] = []
+                level['rows'] = 0
+                self._emit(depth, pending)
+        with open(os.path.join(self.folder, 'info.json'), 'w') as f:
+            json.dump({'width': self.width, 'height': self.height, 'tile_size': self.tile, 'max_zoom': self.max_zoom}, f)
+
+
+def _row_blocks(strips, rows):
+    # Regroups strips of any height into blocks of exactly `rows` rows (the last may be shorter)
+    pending = []
+    count = 0
+    for strip in strips:
+        pending.append(strip)
+        count += len(strip)
+        while count >= rows:
+            merged = np.concatenate(pending) if len(pending) > 1 else pending[0]
+            yield merged[:rows]
+            rest = merged[rows:]
+            pending = [rest] if len(rest) else []
+            count = len(rest)
+    if count:
+        yield np.concatenate(pending) if len(pending) > 1 else pending[0]
+
+
+def _downsample(block, factor):
+    # Mean of each factor x factor cell, ignoring NaN; edges are padded with NaN
+    height, width = block.shape
+    padded_height = -(-height // factor) * factor
+    padded_width = -(-width // factor) * factor
+    if (padded_height, padded_width) != block.shape:
+        padded = np.full((padded_height, padded_width), np.nan, dtype=np.float32)
+        padded[:height, :width] = block
+        block = padded
+    cells = block.reshape(padded_height // factor, factor, padded_width // factor, factor)
+    finite = np.isfinite(cells)
+    total = np.where(finite, cells, 0).sum(axis=(1, 3), dtype=np.float64)
+    count = finite.sum(axis=(1, 3))
+    with np.errstate(invalid='ignore'):
+        return (total / count).astype(np.float32)
+
+
+def _padded_tiles(blocks, width, tile):
+    # tile x tile pieces of row blocks of up to `tile` rows, NaN-padded, in
+    # the row-major order TiffWriter expects for a tiled page
+    padded_width = -(-width // tile) * tile
+    for block in blocks:
+        padded = np.full((tile, padded_width), np.nan, dtype=np.float32)
+        padded[:len(block), :width] = block
+        for x in range(0, padded_width, tile):
+            yield padded[:, x:x + tile]
+
+
+def write_float_tiff(path, strips, height, width, tile=256, compress_level=6):
+    # Tiled, compressed float32 TIFF with NaN as nodata and reduced-resolution
+    # pages (2x, 4x, ...) after the full-resolution one, which GDAL and
+    # tifffile read as internal overviews. Overviews are built from each row
+    # of tiles as it is written and go to memory-mapped scratch files until
+    # their pages are written, so neither the full-resolution array nor the
+    # overviews are held in memory.
+    if tifffile is None:
+        raise RuntimeError('TIFF export requires the tifffile package')
+    factors = []
+    factor = 2
+    while factor <= tile and max(height, width) // factor >= tile:
+        factors.append(factor)
+        factor *= 2
+    scratch_paths = [f'{path}.{factor}.tmp.npy' for factor in factors]
+
+    def tiles(overviews):
+        row = 0
+        for block in _row_blocks(strips, tile):
+            block = np.asarray(block, dtype=np.float32)
+            for level, factor in zip(overviews, factors):
+                reduced = _downsample(block, factor)
+                level[row // factor:row // factor + len(reduced)] = reduced
+            row += len(block)
+            yield block
+
+    options = {
+        'tile': (tile, tile),
+        'compression': 'zlib',
+        'compressionargs': {'level': compress_level},
+        'predictor': imagecodecs is not None,
+        'extratags': [(GDAL_NODATA, 's', 0, 'nan', True)]
+    }
+    try:
+        overviews = [np.lib.format.open_memmap(scratch_path, mode='w+', dtype=np.float32, shape=(-(-height // factor), -(-width // factor)))
+                     for scratch_path, factor in zip(scratch_paths, factors)]
+        with tifffile.TiffWriter(path, bigtiff=height * width * 4 > 2 ** 31) as tif:
+            tif.write(_padded_tiles(tiles(overviews), width, tile), shape=(height, width), dtype=np.float32, **options)
+            for level in overviews:
+                blocks = (level[start:start + tile] for start in range(0, level.shape[0], tile))
+                tif.write(_padded_tiles(blocks, level.shape[1], tile), shape=level.shape, dtype=np.float32, subfiletype=1, **options)
+        del overviews
+    finally:
+        for scratch_path in scratch_paths:
+            if os.path.exists(scratch_path):
+                os.remove(scratch_path)
+
+
+def write_float_npy(path, strips, height, width):
+    # The .npy is created at full size up front and filled through a memory map
+    out = np.lib.format.open_memmap(path, mode='w+', dtype=np.float32, shape=(height, width))
+    row = 0
+    for strip in strips:
+        out[row:row + len(strip)] = strip
+        row += len(strip)
+    if row != height:
+        raise ValueError(f'Expected {height} rows but got {row}')
+    out.flush()
+    del out
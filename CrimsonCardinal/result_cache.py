@@ -0,0 +1,158 @@
+# === Content-addressed results ===
+# Uploads are identified by the SHA-256 of their bytes and results are stored
+# under a key derived from that digest plus everything that affects the
+# rendering, so a repeated request is answered by a file lookup and different
+# users' files with the same name never overwrite each other. The results folder is kept
+# under a size budget by evicting the least recently used files.
+import contextlib
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:  # Windows: files in use aren't protected from eviction
+    fcntl = None
+
+CHUNK_SIZE = 1 << 20
+# Temporary files and folders older than this are taken as left behind by a
+# worker that died mid-write, and evicted
+TEMPORARY_GRACE = 3600
+
+
+def hash_stream(stream):
+    # Leaves the stream rewound so it can be decoded afterwards
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: stream.read(CHUNK_SIZE), b''):
+        digest.update(chunk)
+    stream.seek(0)
+    return digest.hexdigest()
+
+
+def hash_streams(named_streams):
+    # One digest for uploads that only make sense together (separate band
+    # files): each stream's own digest under its name, in order
+    digest = hashlib.sha256()
+    for name, stream in named_streams:
+        digest.update(f'{name}\0{hash_stream(stream)}\n'.encode())
+    return digest.hexdigest()
+
+
+def result_key(digest, **params):
+    payload = json.dumps([digest, params], sort_keys=True)
+    return hashlib.sha256(payload.encode()).hexdigest()[:32]
+
+
+def temporary_path(path):
+    # Same extension, so writers that pick the format from it still work
+    root, ext = os.path.splitext(path)
+    return f'{root}.{os.getpid()}-{threading.get_ident()}.tmp{ext}'
+
+
+def discard(path):
+    # Removes what is left under a temporary name, i.e. when writing it failed
+    # before it was renamed into place; nothing to do after a successful rename
+    if path is None:
+        return
+    if os.path.isdir(path):
+        shutil.rmtree(path, ignore_errors=True)
+    else:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def lookup(path):
+    # A hit refreshes the file's mtime, which is what eviction orders by
+    try:
+        os.utime(path)
+        return True
+    except OSError:
+        return False
+
+
+@contextlib.contextmanager
+def pinned(paths):
+    # Holds a shared lock on each file while a request, job or batch reads
+    # it, which is what evict() checks before removing one. The kernel counts
+    # the holders across processes and drops the locks of a process that
+    # dies, so a crashed worker leaves no pins behind.
+    files = []
+    try:
+        for path in paths:
+            f = open(path, 'rb')
+            files.append(f)
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_SH)
+        yield
+    finally:
+        for f in files:
+            f.close()
+
+
+def _remove_unpinned(path):
+    # Removes the file unless someone holds a pin on it; the exclusive lock
+    # is kept until it is gone, so a reader that opened it just before
+    # waits and then keeps the unlinked file for as long as it needs it
+    with open(path, 'rb') as f:
+        if fcntl is not None:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return False
+        os.remove(path)
+    return True
+
+
+def _tree_size(path):
+    return sum(os.path.getsize(os.path.join(root, name)) for root, dirs, names in os.walk(path) for name in names)
+
+
+def evict(folder, max_bytes, max_age=None):
+    # Drops entries unused for longer than max_age, then the least recently
+    # used ones until the folder fits in max_bytes, skipping pinned files. A
+    # subfolder (a tile pyramid) counts as one entry with the size of
+    # everything in it. Temporary entries still being written count towards
+    # the budget but are left alone, unless older than TEMPORARY_GRACE.
+    now = time.time()
+    cutoff = -1 if max_age is None else now - max_age
+    entries = []
+    writing = 0
+    for entry in os.scandir(folder):
+        try:
+            if entry.is_file():
+                stat = entry.stat()
+                mtime, size = stat.st_mtime, stat.st_size
+            elif entry.is_dir():
+                mtime, size = entry.stat().st_mtime, _tree_size(entry.path)
+            else:
+                continue
+        except OSError:
+            # Renamed or removed meanwhile
+            continue
+        if '.tmp' in entry.name:
+            if mtime < now - TEMPORARY_GRACE:
+                discard(entry.path)
+            else:
+                writing += size
+            continue
+        entries.append((mtime, size, entry.path))
+    total = writing + sum(size for mtime, size, path in entries)
+    removed = 0
+    for mtime, size, path in sorted(entries):
+        if total <= max_bytes and mtime >= cutoff:
+            break
+        try:
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            elif not _remove_unpinned(path):
+                continue
+            total -= size
+            removed += 1
+        except OSError:
+            pass
+    return removed
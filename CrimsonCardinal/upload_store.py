@@ -0,0 +1,151 @@
+# === Decoded upload store ===
+# An upload is decoded once, straight from the request stream, and its pixels
+# are kept as an uncompressed (rows, columns, bands) .npy in the sensor's own
+# sample type (8/16-bit, float), named after the upload digest. Separate
+# single-band files are stacked into one such entry. Later
+# requests for the same upload (a different index or colormap) reference that
+# digest as their upload ID and memory-map the array instead of receiving and
+# decoding the file again. Entries expire after a TTL and the folder is kept
+# under a size budget.
+import os
+import re
+import shutil
+
+import numpy as np
+
+import result_cache
+from raster_io import channels_last, open_raster, read_raster
+
+# .npy and uncompressed TIFF are copied to disk and memory-mapped rather than
+# decoded in memory, so orthomosaics larger than RAM can still be uploaded
+MAPPABLE_EXTENSIONS = ('.npy', '.tif', '.tiff')
+# Rows copied into the stored stack at a time
+STORE_STRIP_BYTES = 32 * 1024 ** 2
+
+UPLOAD_ID_PATTERN = re.compile(r'^[0-9a-f]{64}$')
+
+
+def stack_path(folder, upload_id):
+    return os.path.join(folder, f'{upload_id}.npy')
+
+
+def load(folder, upload_id):
+    if not UPLOAD_ID_PATTERN.match(upload_id):
+        return None
+    path = stack_path(folder, upload_id)
+    if not result_cache.lookup(path):
+        return None
+    try:
+        # Single-band .npy uploads are stored as they came, without a band axis
+        return channels_last(np.load(path, mmap_mode='r'))
+    except (OSError, ValueError):
+        return None
+
+
+def store(folder, upload_id, *parts):
+    # Writes (rows, columns, bands) parts side by side as one band stack,
+    # a strip of rows at a time: memory-mapped TIFFs, planar (transposed)
+    # views and separate band files never have to be held in memory whole
+    height, width = parts[0].shape[:2]
+    if any(part.shape[:2] != (height, width) for part in parts):
+        raise ValueError('All bands must have the same size: ' + ', '.join(f'{part.shape[1]}x{part.shape[0]}' for part in parts))
+    path = stack_path(folder, upload_id)
+    tmp_path = result_cache.temporary_path(path)
+    try:
+        stack = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.result_type(*parts),
+                                          shape=(height, width, sum(part.shape[2] for part in parts)))
+        rows = max(1, STORE_STRIP_BYTES // max(1, stack[0].nbytes))
+        for start in range(0, height, rows):
+            channel = 0
+            for part in parts:
+                stack[start:start + rows, :, channel:channel + part.shape[2]] = part[start:start + rows]
+                channel += part.shape[2]
+        stack.flush()
+        del stack
+        os.replace(tmp_path, path)
+    finally:
+        result_cache.discard(tmp_path)
+    return np.load(path, mmap_mode='r')
+
+
+def _open_file(folder, upload_id, stream, filename, scratch_paths):
+    # The decoded (rows, columns, bands) array of one uploaded file; mappable
+    # formats are copied to a scratch file first and memory-mapped from there
+    ext = os.path.splitext(filename)[1].lower()
+    if ext not in MAPPABLE_EXTENSIONS:
+        return read_raster(stream, filename)
+    scratch_path = result_cache.temporary_path(os.path.join(folder, f'{upload_id}-{len(scratch_paths)}{ext}'))
+    scratch_paths.append(scratch_path)
+    with open(scratch_path, 'wb') as f:
+        shutil.copyfileobj(stream, f, result_cache.CHUNK_SIZE)
+    return open_raster(scratch_path)
+
+
+def store_upload(folder, upload_id, stream, filename):
+    scratch_paths = []
+    try:
+        rgb = _open_file(folder, upload_id, stream, filename, scratch_paths)
+        if scratch_paths and filename.lower().endswith('.npy') and rgb.flags.c_contiguous:
+            # Already in the stored format
+            del rgb
+            os.replace(scratch_paths.pop(), stack_path(folder, upload_id))
+            return np.load(stack_path(folder, upload_id), mmap_mode='r')
+        return store(folder, upload_id, rgb)
+    finally:
+        for scratch_path in scratch_paths:
+            if os.path.exists(scratch_path):
+                os.remove(scratch_path)
+
+
+def store_band_files(folder, upload_id, files):
+    # Separate single-band files (one per wavelength), given as (stream,
+    # filename) pairs in channel order, stacked into one upload
+    scratch_paths = []
+    try:
+        parts = [_open_file(folder, upload_id, stream, filename, scratch_paths) for stream, filename in files]
+        for part, (stream, filename) in zip(parts, files):
+            if part.shape[2] != 1:
+                raise ValueError(f'{filename} has {part.shape[2]} bands; upload separate band files with one band each')
+        return store(folder, upload_id, *parts)
+    finally:
+        for scratch_path in scratch_paths:
+            if os.path.exists(scratch_path):
+                os.remove(scratch_path)
+
+
+# === Shared band store ===
+# Evaluating many indices at once (process_batch) works on float bands
+# converted up front. Rather than every worker converting a private copy of
+# the same frame, each channel is converted once per float type into its own
+# .npy next to the stack and memory-mapped read-only by every worker and job
+# process that needs it, so the page cache holds one copy however many
+# requests share it. Pin the files (result_cache.pinned) while reading; band
+# files age out of the folder like the stacks they were made from.
+def band_path(folder, upload_id, channel, dtype):
+    return os.path.join(folder, f'{upload_id}-{channel}-{np.dtype(dtype).name}.npy')
+
+
+def load_channels(folder, upload_id, rgb, channels, dtype):
+    # {channel: read-only (rows, columns) array of dtype} for the upload's
+    # stack rgb, converting the channels not stored yet a strip at a time
+    arrays = {}
+    for channel in channels:
+        path = band_path(folder, upload_id, channel, dtype)
+        if not result_cache.lookup(path):
+            tmp_path = result_cache.temporary_path(path)
+            try:
+                band = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=dtype, shape=rgb.shape[:2])
+                rows = max(1, STORE_STRIP_BYTES // max(1, band[0].nbytes))
+                for start in range(0, rgb.shape[0], rows):
+                    band[start:start + rows] = rgb[start:start + rows, :, channel]
+                band.flush()
+                del band
+                os.replace(tmp_path, path)
+            finally:
+                result_cache.discard(tmp_path)
+        arrays[channel] = np.load(path, mmap_mode='r')
+    return arrays
+
+
+def exists(folder, upload_id):
+    return bool(UPLOAD_ID_PATTERN.match(upload_id)) and os.path.isfile(stack_path(folder, upload_id))
@@ -1,4 +1,20 @@
-from app import app
+# WSGI entry point. app.py imports matplotlib and friends lazily; a server
+# warms them here instead, before the worker takes its first request (see
+# app.prewarm and the PREWARM setting).
+#
+# Given to gunicorn as its config file as well, this preloads the app in the
+# master, so the warm-up runs once and every worker, including ones restarted
+# later, is forked warm and shares those pages copy-on-write:
+#   gunicorn -c wsgi.py wsgi:app
+from app import app, prewarm
+
+if app.config['PREWARM']:
+    prewarm()
+
+# === gunicorn settings ===
+# Read only when this file is passed with -c. Job processes and encoding
+# threads are started on first use, so there is nothing to reset after fork.
+preload_app = True
 
 if __name__ == "__main__":
     app.run()
@@ -0,0 +1,253 @@
+# === Zonal statistics ===
+# Per-plot numbers for many field plots in one frame. The plots, polygons in
+# pixel coordinates or the regions of a label-mask image, are first turned
+# into a label raster (0 outside every plot, 1..n inside one), which is kept
+# as a zone layout named after the plots and the frame size. Asking again for
+# another index or another flight over the same layout only maps it back.
+# Every zone's numbers then come out of one pass over the index values, with
+# no loop over zones: counts and sums through np.bincount on the labels,
+# min/max through ufunc.at, and percentiles from one QuantileSketch-style
+# bucket histogram per zone, bincounted on label * buckets + bucket.
+import json
+import math
+import os
+import re
+
+import numpy as np
+
+import result_cache
+from index_stats import DEFAULT_PERCENTILES, QuantileSketch
+
+LAYOUT_ID_PATTERN = re.compile(r'^[0-9a-f]{32}$')
+# Pixels of a polygon's bounding box rasterized at a time
+RASTER_BLOCK_PIXELS = 1 << 22
+
+
+# === Zone layouts ===
+def parse_geojson(geojson):
+    # [(name, rings)] from a FeatureCollection, a Feature or a bare geometry,
+    # Polygon or MultiPolygon, with (x, y) = (column, row) coordinates. A
+    # zone is named after the feature's id, its properties' id or name, or
+    # its position (from 1). All rings of a zone are filled with the even-odd
+    # rule, so holes are left out.
+    if not isinstance(geojson, dict):
+        raise ValueError('Expected a GeoJSON object')
+    if geojson.get('type') == 'FeatureCollection':
+        features = geojson.get('features') or []
+    elif geojson.get('type') == 'Feature':
+        features = [geojson]
+    else:
+        features = [{'geometry': geojson}]
+    zones = []
+    for number, feature in enumerate(features, 1):
+        if not isinstance(feature, dict):
+            raise ValueError(f'Zone {number}: expected a GeoJSON Feature')
+        properties = feature.get('properties') or {}
+        name = feature.get('id', properties.get('id', properties.get('name', number)))
+        geometry = feature.get('geometry') or {}
+        if geometry.get('type') == 'Polygon':
+            polygons = [geometry.get('coordinates')]
+        elif geometry.get('type') == 'MultiPolygon':
+            polygons = geometry.get('coordinates')
+        else:
+            raise ValueError(f'Zone {name}: unsupported geometry {geometry.get("type")}, expected Polygon or MultiPolygon')
+        try:
+            rings = [np.asarray(ring, dtype=np.float64) for polygon in polygons for ring in polygon]
+        except (TypeError, ValueError):
+            raise ValueError(f'Zone {name}: coordinates must be lists of [x, y] positions') from None
+        if not rings or any(ring.ndim != 2 or ring.shape[0] < 3 or ring.shape[1] < 2 for ring in rings):
+            raise ValueError(f'Zone {name}: every ring needs at least three [x, y] positions')
+        zones.append((name, [ring[:, :2] for ring in rings]))
+    if not zones:
+        raise ValueError('No zones given')
+    return zones
+
+
+def fill_rings(labels, rings, label):
+    # Sets the pixels whose centers lie inside the rings to label, in row
+    # blocks of the rings' bounding box. A pixel center exactly on an edge
+    # belongs to the zone on its right (or below), so plots sharing an edge
+    # don't share pixels.
+    height, width = labels.shape
+    points = np.concatenate(rings)
+    x0, x1 = max(0, math.floor(points[:, 0].min())), min(width, math.ceil(points[:, 0].max()))
+    y0, y1 = max(0, math.floor(points[:, 1].min())), min(height, math.ceil(points[:, 1].max()))
+    if x0 >= x1 or y0 >= y1:
+        return
+    starts = np.concatenate(rings)
+    ends = np.concatenate([np.roll(ring, -1, axis=0) for ring in rings])
+    span = x1 - x0
+    block_rows = max(1, RASTER_BLOCK_PIXELS // span)
+    for y in range(y0, y1, block_rows):
+        centers = np.arange(y, min(y + block_rows, y1)) + 0.5
+        # Where each edge crosses each row's center line (edges x rows), left to right
+        below_start, below_end = starts[:, 1, None] <= centers, ends[:, 1, None] <= centers
+        with np.errstate(divide='ignore', invalid='ignore'):
+            x = starts[:, 0, None] + (centers - starts[:, 1, None]) * ((ends[:, 0] - starts[:, 0]) / (ends[:, 1] - starts[:, 1]))[:, None]
+        x = np.where(below_start != below_end, x, np.inf)
+        x.sort(axis=0)
+        # Rows always cross an even number of edges: inside from the 1st
+        # crossing to the 2nd, from the 3rd to the 4th, ...
+        columns = np.clip(np.ceil(x[:len(x) // 2 * 2] - 0.5) - x0, 0, span).astype(np.intp)
+        rows = np.broadcast_to(np.arange(len(centers)), columns[0::2].shape)
+        steps = np.zeros((len(centers), span + 1), dtype=np.int32)
+        np.add.at(steps, (rows, columns[0::2]), 1)
+        np.add.at(steps, (rows, columns[1::2]), -1)
+        inside = np.cumsum(steps[:, :span], axis=1) > 0
+        labels[y:y + len(centers), x0:x1][inside] = label
+
+
+def label_dtype(zone_count):
+    return np.uint16 if zone_count < 2 ** 16 else np.uint32
+
+
+def layout_path(folder, layout_id):
+    return os.path.join(folder, layout_id)
+
+
+def load_layout(folder, layout_id):
+    # (labels, zone names) of a stored layout, the labels memory-mapped, or None
+    if not LAYOUT_ID_PATTERN.match(layout_id):
+        return None
+    path = layout_path(folder, layout_id)
+    if not result_cache.lookup(path):
+        return None
+    try:
+        with open(os.path.join(path, 'zones.json')) as f:
+            zones = json.load(f)['zones']
+        return np.load(os.path.join(path, 'labels.npy'), mmap_mode='r'), zones
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def _store_layout(folder, layout_id, zones, height, width, fill):
+    # A layout is a folder, labels.npy and zones.json, written under a
+    # temporary name and renamed, so eviction and lookups see both or neither
+    path = layout_path(folder, layout_id)
+    tmp_path = result_cache.temporary_path(path)
+    try:
+        os.makedirs(tmp_path)
+        labels = np.lib.format.open_memmap(os.path.join(tmp_path, 'labels.npy'), mode='w+', dtype=label_dtype(len(zones)),
+                                           shape=(height, width))
+        fill(labels)
+        labels.flush()
+        del labels
+        with open(os.path.join(tmp_path, 'zones.json'), 'w') as f:
+            json.dump({'zones': zones, 'height': height, 'width': width}, f)
+        try:
+            os.replace(tmp_path, path)
+        except OSError:
+            # Another worker stored the same layout first
+            pass
+    finally:
+        result_cache.discard(tmp_path)
+    return load_layout(folder, layout_id)
+
+
+def store_polygons(folder, layout_id, zones, height, width):
+    # zones as parse_geojson returns them; a later zone overlapping an
+    # earlier one takes the shared pixels
+    def fill(labels):
+        for label, (name, rings) in enumerate(zones, 1):
+            fill_rings(labels, rings, label)
+    return _store_layout(folder, layout_id, [name for name, rings in zones], height, width, fill)
+
+
+def store_mask(folder, layout_id, mask, max_zones=None, strip_rows=1024):
+    # A (rows, columns, 1) label image: every distinct non-zero value is a
+    # zone, named after that value, and 0 is outside every zone
+    if mask.shape[2] != 1:
+        raise ValueError(f'A zone mask needs one band, this one has {mask.shape[2]}')
+    if not np.issubdtype(mask.dtype, np.integer):
+        raise ValueError(f'A zone mask needs integer pixel values, not {mask.dtype}')
+    height, width = mask.shape[:2]
+    values = np.unique(np.concatenate([np.unique(mask[start:start + strip_rows]) for start in range(0, height, strip_rows)]))
+    values = values[values != 0]
+    if not values.size:
+        raise ValueError('The zone mask has no non-zero pixels')
+    if max_zones is not None and values.size > max_zones:
+        raise ValueError(f'The zone mask has {values.size} zones, at most {max_zones} are allowed')
+
+    def fill(labels):
+        for start in range(0, height, strip_rows):
+            strip = mask[start:start + strip_rows, :, 0]
+            label = np.searchsorted(values, strip) + 1
+            label[strip == 0] = 0
+            labels[start:start + strip_rows] = label
+    return _store_layout(folder, layout_id, values.tolist(), height, width, fill)
+
+
+# === Per-zone statistics ===
+class ZonalStats:
+    # Like StreamingStats, for every zone at once. Percentiles come from a
+    # coarser QuantileSketch per zone (1 % relative accuracy, magnitudes
+    # 1e-3..1e6, roughly 2000 counters per zone), clamped to the zone's exact
+    # min and max.
+    def __init__(self, zone_count, accuracy=0.01, min_magnitude=1e-3, max_magnitude=1e6):
+        size = zone_count + 1
+        self.zone_count = zone_count
+        self.count = np.zeros(size, dtype=np.int64)
+        self.nonfinite = np.zeros(size, dtype=np.int64)
+        self.total = np.zeros(size)
+        self.total_squares = np.zeros(size)
+        self.minimum = np.full(size, np.inf)
+        self.maximum = np.full(size, -np.inf)
+        self.sketch = QuantileSketch(accuracy, min_magnitude, max_magnitude)
+        self.counts = np.zeros((size, len(self.sketch.counts)), dtype=np.int64)
+
+    def add(self, values, labels):
+        # values and labels of the same row strip
+        values = np.asarray(values).ravel()
+        labels = np.asarray(labels).ravel().astype(np.intp)
+        size = self.zone_count + 1
+        finite = np.isfinite(values)
+        if not finite.all():
+            self.nonfinite += np.bincount(labels[~finite], minlength=size)
+            values, labels = values[finite], labels[finite]
+        if not values.size:
+            return
+        # Buckets in the values' own precision, sums in float64
+        first, last = int(labels.min()), int(labels.max()) + 1
+        buckets = self.counts.shape[1]
+        keys = self.sketch.keys(values)
+        values = values.astype(np.float64)
+        self.count += np.bincount(labels, minlength=size)
+        self.total += np.bincount(labels, weights=values, minlength=size)
+        self.total_squares += np.bincount(labels, weights=values * values, minlength=size)
+        np.minimum.at(self.minimum, labels, values)
+        np.maximum.at(self.maximum, labels, values)
+        # Only the zones the strip touches, which are usually a band of plots
+        keys += (labels - first) * buckets
+        self.counts[first:last] += np.bincount(keys, minlength=(last - first) * buckets).reshape(last - first, buckets)
+
+    def summary(self, names, percentiles=DEFAULT_PERCENTILES):
+        # One dict per zone, in label order; zones without a finite value get Nones
+        count = self.count[1:]
+        has_values = count > 0
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean = self.total[1:] / count
+            std = np.sqrt(np.maximum(self.total_squares[1:] / count - mean * mean, 0.0))
+        cumulative = np.cumsum(self.counts[1:], axis=1)
+        quantiles = {}
+        for q in {50, *percentiles}:
+            if q <= 0 or q >= 100:
+                value = self.minimum[1:] if q <= 0 else self.maximum[1:]
+            else:
+                rank = np.minimum((q / 100 * count).astype(np.int64), count - 1)
+                value = self.sketch.values((cumulative > rank[:, None]).argmax(axis=1))
+                value = np.clip(value, self.minimum[1:], self.maximum[1:])
+            quantiles[q] = value.tolist()
+
+        def number(array, i):
+            return float(array[i]) if has_values[i] else None
+        return [{
+            'zone': name,
+            'count': int(count[i]),
+            'nonfinite': int(self.nonfinite[i + 1]),
+            'min': number(self.minimum[1:], i),
+            'max': number(self.maximum[1:], i),
+            'mean': number(mean, i),
+            'std': number(std, i),
+            'median': quantiles[50][i] if has_values[i] else None,
+            'percentiles': {f'{q:g}': quantiles[q][i] if has_values[i] else None for q in percentiles}
+        } for i, name in enumerate(names)]
@@ -1,21 +1,35 @@
 import logging
-from flask import Flask, request, render_template, jsonify, send_from_directory, url_for
+from flask import Flask, Request, request, render_template, jsonify, send_from_directory, url_for
 import os
-import imageio.v2 as imageio
+import sys
+import tempfile
+from io import BytesIO
 import numpy as np
-from matplotlib import pyplot as plt
-from matplotlib.colors import LinearSegmentedColormap
 
-plt.switch_backend('Agg')
+# The index library is shared with CrimsonCardinal and lives at the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from vegetation_indices import INDICES, read_bands
+from vegetation_indices.render import ColorbarCache, apply_lut, colorbar_footer, colormap_lut, render_colorbar, scan
 
 app = Flask(__name__)
-app.config['UPLOAD_FOLDER'] = 'uploads'
+app.config['UPLOAD_SPOOL_BYTES'] = 64 * 1024 ** 2  # larger uploads spill to an anonymous temporary file
 app.config['RESULT_FOLDER'] = 'static/results'
+app.config['BAND_DTYPE'] = 'float32'  # 'float64' for full double precision
+app.config['COLORBAR_CACHE_SIZE'] = 32
+app.config['COLORBAR_CACHE_FOLDER'] = None  # e.g. 'cache/colorbars' to keep strips across restarts
+app.config['PREWARM'] = True  # wsgi.py loads matplotlib, fonts, LUTs and imageio before serving (see prewarm)
 app.secret_key = "supersecretkey"
 
-os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 os.makedirs(app.config['RESULT_FOLDER'], exist_ok=True)
 
+class SpooledRequest(Request):
+    # Werkzeug spills every upload over 500 KB to disk; keep camera frames in
+    # memory so they are decoded straight from the request
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return tempfile.SpooledTemporaryFile(max_size=app.config['UPLOAD_SPOOL_BYTES'], mode='rb+')
+
+app.request_class = SpooledRequest
+
 # Setup basic logging
 logging.basicConfig(level=logging.DEBUG)
 
@@ -23,58 +37,6 @@ logging.basicConfig(level=logging.DEBUG)
 def favicon():
     return send_from_directory(os.path.join(app.root_path, 'templates'), 'favicon.ico', mimetype='image/vnd.microsoft.icon')
 
-def calculate_ndvi(NIR, R):
-    return np.true_divide(np.subtract(NIR, R), np.add(NIR, R))
-
-def calculate_ndvi_ngb(NIR, B):
-    return np.true_divide(np.subtract(NIR, B), np.add(NIR, B))
-
-def calculate_endvi(NIR, G, B):
-    NIRG = np.add(NIR, G)
-    return np.true_divide(np.subtract(NIRG, 2*B), np.add(NIRG, 2*B))
-
-def calculate_endvi_rgn(NIR, R, G):
-    NIRR = np.add(NIR, R)
-    return np.true_divide(np.subtract(NIRR, 2*G), np.add(NIRR, 2*G))
-
-def calculate_savi(NIR, R, L=0.5):
-    NIRminusR = np.subtract(NIR, R)
-    NIRplusRplusL = np.add(np.add(NIR, R), L)
-    return np.multiply(np.true_divide(NIRminusR, NIRplusRplusL), (1 + L))
-
-def calculate_tvi(NIR, R, G):
-    return 0.5 * (120 * (NIR - G) - 200 * (R - G))
-
-def calculate_gndvi(NIR, G):
-    return np.true_divide(np.subtract(NIR, G), np.add(NIR, G))
-
-def calculate_msavi(NIR, R):
-    return 0.5 * (2 * NIR + 1 - np.sqrt((2 * NIR + 1) ** 2 - 8 * (NIR - R)))
-
-def calculate_cvi(NIR, R):
-    return np.true_divide(NIR, R) - 1
-
-def calculate_cvi2(NIR, R, G):
-    return np.true_divide(np.multiply(NIR, R), np.square(G))
-
-def calculate_pri(NIR, R):
-    return np.true_divide(np.subtract(NIR, R), np.add(NIR, R))
-
-def calculate_ndwi(G, NIR):
-    return np.true_divide(np.subtract(G, NIR), np.add(G, NIR))
-
-def calculate_vari(G, R, B):
-    return np.true_divide(np.subtract(G, R), np.add(np.subtract(G, R), B))
-
-def calculate_evi(NIR, R, B):
-    return 2.5 * np.true_divide(np.subtract(NIR, R), np.add(np.add(NIR, 6 * R), np.add(-7.5 * B, 1)))
-
-def calculate_ng(G, NIR, R):
-    return np.true_divide(G, np.add(np.add(NIR, R), G))
-
-def create_colormap(cols):
-    return LinearSegmentedColormap.from_list(name='custom1', colors=cols)
-
 colormap_options = {
     'Color 1 (blue, green, yellow, red)': ['blue', 'green', 'yellow', 'red'],
     'Color 2 (gray, gray, red, yellow, green)': ['gray', 'gray', 'red', 'yellow', 'green'],
@@ -82,90 +44,88 @@ colormap_options = {
     'Color 4 (black, gray, blue, green, yellow, red)': ['black', 'gray', 'blue', 'green', 'yellow', 'red']
 }
 
-def process_and_save(image_path, output_name, calculation_func, label, colormap_name, *args):
-    try:
-        colormap = colormap_options[colormap_name]
-        rgb = imageio.imread(image_path)
-        result = calculation_func(*args)
-
-        abs_max = max(abs(np.min(result)), abs(np.max(result)))
-
-        fig, ax = plt.subplots()
-        image = ax.imshow(result, cmap=create_colormap(colormap), vmin=-abs_max, vmax=abs_max)
-        plt.axis('off')
-
-        from io import BytesIO
-        buf = BytesIO()
-        fig.savefig(buf, format='png', dpi=600, bbox_inches='tight', pad_inches=0)
-        plt.close(fig)
-        buf.seek(0)
-
-        main_image = imageio.imread(buf)
-        if main_image.shape[2] == 4:
-            main_image = main_image[:, :, :3]
-
-        fig, ax = plt.subplots(figsize=(main_image.shape[1] * 0.8 / 100, 1))
-        norm = plt.Normalize(vmin=-abs_max, vmax=abs_max)
-        cbar = plt.colorbar(image, cax=ax, orientation='horizontal', norm=norm)
-        cbar.ax.tick_params(labelsize=10)
-        cbar.update_ticks()
-        cbar.set_label(label, fontsize=16, fontweight='bold', labelpad=-50)
+_colormap_luts = {}
 
-        buf = BytesIO()
-        fig.savefig(buf, format='png', dpi=600, bbox_inches='tight', pad_inches=0)
-        plt.close(fig)
-        buf.seek(0)
+def get_colormap_lut(colormap_name, lut_size=256):
+    key = (colormap_name, lut_size)
+    lut = _colormap_luts.get(key)
+    if lut is None:
+        lut = _colormap_luts[key] = colormap_lut(colormap_options[colormap_name], lut_size)
+    return lut
 
-        colorbar_image = imageio.imread(buf)
-        if (colorbar_image.shape[2] == 4):
-            colorbar_image = colorbar_image[:, :, :3]
+_colorbars = ColorbarCache()
 
-        from PIL import Image
-        colorbar_image_pil = Image.fromarray(colorbar_image)
-        colorbar_image_pil = colorbar_image_pil.resize((int(main_image.shape[1] * 0.8), int(main_image.shape[0] * 0.1)))
-        colorbar_image = np.array(colorbar_image_pil)
+def get_colorbar(colormap_name, label, vmin, vmax, width, height):
+    return _colorbars.get(colormap_name, colormap_options[colormap_name], label, vmin, vmax, width, height,
+                          app.config['COLORBAR_CACHE_SIZE'], app.config['COLORBAR_CACHE_FOLDER'])
 
-        padding_height = colorbar_image.shape[0]
-        white_padding = np.full((padding_height, main_image.shape[1], 3), [255, 255, 255], dtype=np.uint8)
+def process_and_save(output_name, calculation_func, label, colormap_name, *args):
+    try:
+        result = calculation_func(*args)
 
-        x_offset = (white_padding.shape[1] - colorbar_image.shape[1]) // 2
-        y_offset = (white_padding.shape[0] - colorbar_image.shape[0]) // 2
-        white_padding[y_offset:y_offset + colorbar_image.shape[0], x_offset:x_offset + colorbar_image.shape[1]] = colorbar_image
+        vmin, vmax, valid = scan(result)
+        abs_max = max(abs(vmin), abs(vmax))
 
-        space_height = int(main_image.shape[0] * 0.01)
-        space_padding = np.full((space_height, main_image.shape[1], 3), [255, 255, 255], dtype=np.uint8)
+        # Output canvas: index image, 1% white spacer, colorbar band (10% of height)
+        height, width = result.shape
+        colorbar_image = get_colorbar(colormap_name, label, -abs_max, abs_max, int(width * 0.8), int(height * 0.1))
+        footer = colorbar_footer(height, width, colorbar_image)
+        canvas = np.empty((height + footer.shape[0], width, 3), dtype=np.uint8)
+        canvas[height:] = footer
 
-        result_with_padding = np.vstack((main_image, space_padding, white_padding))
+        apply_lut(result, get_colormap_lut(colormap_name), -abs_max, abs_max, out=canvas[:height], valid=valid)
 
-        imageio.imwrite(output_name, result_with_padding)
+        import imageio.v2 as imageio
+        imageio.imwrite(output_name, canvas)
         logging.info(f"Image processed and saved to {output_name}")
 
     except Exception as e:
         logging.error(f"Error in processing and saving image: {e}")
         raise
 
-index_functions = {
-    '1': ('NDVI', calculate_ndvi, ['gray', 'blue', 'green', 'yellow', 'red'], ['RGN']),
-    '2': ('NDVI_NGB', calculate_ndvi_ngb, ['gray', 'blue', 'green', 'yellow', 'red'], ['NGB']),
-    '3': ('ENDVI', calculate_endvi, ['gray', 'blue', 'green', 'yellow', 'red'], ['NGB']),
-    '4': ('ENDVI_RGN', calculate_endvi_rgn, ['gray', 'blue', 'green', 'yellow', 'red'], ['RGN']),
-    '5': ('SAVI', calculate_savi, ['gray', 'blue', 'green', 'yellow', 'red'], ['RGN']),
-    '6': ('TVI', calculate_tvi, ['gray', 'blue', 'green', 'yellow', 'red'], ['RGN']),
-    '7': ('GNDVI', calculate_gndvi, ['gray', 'blue', 'green', 'yellow', 'red'], ['RGN', 'NGB', 'RGB']),
-    '8': ('MSAVI', calculate_msavi, ['gray', 'blue', 'green', 'yellow', 'red'], ['RGN']),
-    '9': ('CVI', calculate_cvi, ['gray', 'blue', 'green', 'yellow', 'red'], ['RGN']),
-    '10': ('CVI2', calculate_cvi2, ['gray', 'blue', 'green', 'yellow', 'red'], ['RGN']),
-    '11': ('PRI', calculate_pri, ['gray', 'blue', 'green', 'yellow', 'red'], ['RGN']),
-    '12': ('NDWI', calculate_ndwi, ['gray', 'blue', 'green', 'yellow', 'red'], ['RGN', 'NGB']),
-    '13': ('VARI', calculate_vari, ['gray', 'blue', 'green', 'yellow', 'red'], ['RGN', 'NGB', 'RGB']),
-    '14': ('EVI', calculate_evi, ['gray', 'blue', 'green', 'yellow', 'red'], ['RGN']),
-    '15': ('NG', calculate_ng, ['gray', 'blue', 'green', 'yellow', 'red'], ['RGN'])
-}
+# This app offers the first 15 indices of the shared registry
+indices = {key: INDICES[key] for key in map(str, range(1, 16))}
+# except GNDVI, which the shared entry computes from R on RGB frames (as
+# CrimsonCardinal always has); here it still needs a real NIR band, so RGB
+# frames get the missing-bands error as before
+indices['7'] = INDICES['7'].with_bands(('NIR', 'G'))
+
+# matplotlib and imageio are imported on first use; wsgi.py calls prewarm()
+# so a server loads them, the colormap LUTs, the fonts and the index formulas
+# before its first request rather than during it
+_prewarmed = False
+
+def prewarm():
+    global _prewarmed
+    if _prewarmed:
+        return
+    import imageio.v2 as imageio
+    for colormap_name in colormap_options:
+        get_colormap_lut(colormap_name)
+    render_colorbar(next(iter(colormap_options.values())), 'NDVI', -1.0, 1.0, 256, 32)
+
+    rgb = np.random.default_rng(0).integers(1, 256, (8, 8, 3), dtype=np.uint8)
+    with np.errstate(all='ignore'):
+        for spec in indices.values():
+            for image_type in spec.image_types:
+                names = spec.band_names(image_type)
+                if names is not None:
+                    spec.formula(*spec.arguments(read_bands(rgb, image_type, app.config['BAND_DTYPE'], names), image_type))
+
+    buf = BytesIO()
+    imageio.imwrite(buf, rgb, format='jpeg')
+    buf.seek(0)
+    imageio.imread(buf)
+    imageio.imwrite(BytesIO(), rgb, format='png')
+    with app.test_request_context():
+        render_template('index.html', indices=indices, colormap_options=colormap_options)
+    _prewarmed = True
+    app.logger.info('Prewarmed matplotlib, colormaps, index formulas and codecs')
 
 @app.route('/')
 def index():
     app.logger.debug('Index page accessed')
-    return render_template('index.html', index_functions=index_functions, colormap_options=colormap_options)
+    return render_template('index.html', indices=indices, colormap_options=colormap_options)
 
 @app.route('/process', methods=['POST'])
 def process():
@@ -181,67 +141,31 @@ def process():
             index = request.form['index']
             image_type = request.form['image_type']
             colormap_name = request.form['colormap']
-            label, func, colormap, valid_types = index_functions[index]
+            if index not in indices:
+                error_message = f"Error: Invalid index selection."
+                app.logger.error(error_message)
+                return error_message, 400
+            spec = indices[index]
+            label = spec.label
 
-            if image_type not in valid_types:
+            if image_type not in spec.image_types:
                 error_message = f"Error: The selected index {label} is not valid for the image type {image_type}."
                 app.logger.error(error_message)
                 return error_message, 400
 
-            filename = os.path.join(app.config['UPLOAD_FOLDER'], file.filename)
-            file.save(filename)
-            app.logger.debug(f"File saved to {filename}")
-
-            rgb = imageio.imread(filename)
-
-            if image_type == 'RGN':
-                R = np.asarray(rgb[:,:,0], float)
-                G = np.asarray(rgb[:,:,1], float)
-                NIR = np.asarray(rgb[:,:,2], float)
-                B = None
-            elif image_type == 'NGB':
-                NIR = np.asarray(rgb[:,:,0], float)
-                G = np.asarray(rgb[:,:,1], float)
-                B = np.asarray(rgb[:,:,2], float)
-                R = None
-            else:  # RGB
-                R = np.asarray(rgb[:,:,0], float)
-                G = np.asarray(rgb[:,:,1], float)
-                B = np.asarray(rgb[:,:,2], float)
-                NIR = None
-
-            args = {
-                '1': (NIR, R),
-                '2': (NIR, B),
-                '3': (NIR, G, B),
-                '4': (NIR, R, G),
-                '5': (NIR, R),
-                '6': (NIR, R, G),
-                '7': (NIR, G),
-                '8': (NIR, R),
-                '9': (NIR, R),
-                '10': (NIR, R, G),
-                '11': (NIR, R),
-                '12': (G, NIR),
-                '13': (G, R, B),
-                '14': (NIR, R, B),
-                '15': (G, NIR, R)
-            }
-
-            if index in args:
-                index_args = args[index]
-                if any(arg is None for arg in index_args):
-                    error_message = f"Error: The selected index {label} requires bands that are not available in the image type {image_type}."
-                    app.logger.error(error_message)
-                    return error_message, 400
-            else:
-                error_message = f"Error: Invalid index selection."
+            names = spec.band_names(image_type)
+            if names is None:
+                error_message = f"Error: The selected index {label} requires bands that are not available in the image type {image_type}."
                 app.logger.error(error_message)
                 return error_message, 400
 
+            import imageio.v2 as imageio
+            rgb = imageio.imread(file.stream)
+            index_args = spec.arguments(read_bands(rgb, image_type, app.config['BAND_DTYPE'], names), image_type)
+
             base_filename, ext = os.path.splitext(file.filename)
             output_name = os.path.join(app.config['RESULT_FOLDER'], f'{base_filename}_{label}.png')
-            process_and_save(filename, output_name, func, label, colormap_name, *index_args)
+            process_and_save(output_name, spec.formula, label, colormap_name, *index_args)
 
             app.logger.debug(f'Processed image saved: {output_name}')
             return jsonify({'processed_image_url': url_for('static', filename=f'results/{base_filename}_{label}.png')})
@@ -1,4 +1,18 @@
-from app import app
+# WSGI entry point. app.py imports matplotlib and imageio lazily; a server
+# warms them here instead, before the worker takes its first request (see
+# app.prewarm and the PREWARM setting).
+#
+# Given to gunicorn as its config file as well, this preloads the app in the
+# master, so the warm-up runs once and every forked worker starts warm:
+#   gunicorn -c wsgi.py wsgi:app
+from app import app, prewarm
+
+if app.config['PREWARM']:
+    prewarm()
+
+# === gunicorn settings ===
+# Read only when this file is passed with -c
+preload_app = True
 
 if __name__ == "__main__":
     app.run()
@@ -0,0 +1,82 @@
+# Output encoding benchmark: encodes one rendered index canvas (colorbar
+# included, as written by save_result) in every output format, at several PNG
+# compression levels and filters and with 1..N encoding threads. Reports the
+# best wall time, throughput and file size for each setting.
+#
+#   python benchmarks/bench_encode.py --megapixels 15 --workers 1,4 --repeat 3
+import argparse
+import logging
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'CrimsonCardinal'))
+
+
+def render_canvas(app, megapixels):
+    # A smooth NDVI-like field looks more like a real render than noise, which
+    # would make every encoder look far worse than it is
+    side = int((megapixels * 1e6) ** 0.5)
+    y, x = np.mgrid[0:side, 0:side].astype(np.float32) / side
+    rng = np.random.default_rng(0)
+    result = np.sin(x * 12) * np.cos(y * 9) * 0.6 + rng.normal(0, 0.05, (side, side)).astype(np.float32)
+    output_name = os.path.join(tempfile.mkdtemp(), 'canvas.png')
+    captured = {}
+    encode = app.write_canvas
+    app.write_canvas = lambda name, canvas, encoding=None: captured.setdefault('canvas', canvas)
+    try:
+        app.save_result(result, output_name, 'NDVI', 'RdYlGn')
+    finally:
+        app.write_canvas = encode
+    return captured['canvas']
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time every output format, PNG compression level, filter and encoding thread count.')
+    parser.add_argument('--megapixels', type=float, default=4)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--workers', default=f'1,{os.cpu_count() or 1}', help='comma-separated PNG thread counts')
+    parser.add_argument('--levels', default='1,3,6,9', help='comma-separated PNG compression levels')
+    options = parser.parse_args()
+
+    import app
+    from raster_io import encode_image
+    logging.getLogger().setLevel(logging.WARNING)
+
+    canvas = render_canvas(app, options.megapixels)
+    megapixels = canvas.shape[0] * canvas.shape[1] / 1e6
+    workers = sorted({int(w) for w in options.workers.split(',')})
+    levels = [int(level) for level in options.levels.split(',')]
+
+    settings = []
+    for level in levels:
+        for png_filter in ('none', 'sub'):
+            for count in workers:
+                settings.append((f'png level {level} {png_filter}', count,
+                                 dict(output_format='png', compress_level=level, png_filter=png_filter, workers=count)))
+    for quality in (75, 90):
+        settings.append((f'jpeg q{quality}', 1, dict(output_format='jpeg', quality=quality)))
+        settings.append((f'webp q{quality}', 1, dict(output_format='webp', quality=quality)))
+    for level in (1, 6):
+        settings.append((f'webp lossless {level}', 1, dict(output_format='webp_lossless', compress_level=level)))
+
+    folder = tempfile.mkdtemp()
+    print(f'{canvas.shape[1]}x{canvas.shape[0]} canvas ({megapixels:.1f} MP), {os.cpu_count()} cores')
+    print(f'{"format":<22} {"threads":>7} {"ms":>8} {"MP/s":>7} {"MiB":>7}')
+    for name, count, kwargs in settings:
+        path = os.path.join(folder, 'out' + app.OUTPUT_FORMATS[kwargs['output_format']])
+        best = float('inf')
+        for _ in range(options.repeat):
+            start = time.perf_counter()
+            encode_image(path, canvas, **kwargs)
+            best = min(best, time.perf_counter() - start)
+        size = os.path.getsize(path)
+        print(f'{name:<22} {count:>7} {best * 1e3:>8.0f} {megapixels / best:>7.1f} {size / 2**20:>7.2f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+# Microbenchmark for every entry in the vegetation_indices registry:
+# eager NumPy (the plain formula body) vs the compiled expression plan vs
+# numexpr when it is installed. Reports best wall time and peak allocation.
+#
+#   python benchmarks/bench_indices.py --megapixels 20 --repeat 3 --dtype float32
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+import warnings
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def measure(func, repeat):
+    best = float('inf')
+    peak = 0
+    for _ in range(repeat):
+        tracemalloc.start()
+        start = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - start)
+        peak = max(peak, tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+        del result
+    return best, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time every registry index through eager NumPy, the expression plan and numexpr.')
+    parser.add_argument('--megapixels', type=float, default=4)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--dtype', choices=['float32', 'float64'], default='float32')
+    parser.add_argument('--index', action='append', help='index key to run (default: all)')
+    options = parser.parse_args()
+
+    from vegetation_indices import INDICES, engine
+
+    side = int((options.megapixels * 1e6) ** 0.5)
+    rng = np.random.default_rng(0)
+    bands = {name: rng.integers(1, 256, (side, side)).astype(options.dtype) for name in ('R', 'G', 'B', 'NIR')}
+    frame_bytes = bands['R'].nbytes
+
+    print(f'{side}x{side} {options.dtype} frame ({frame_bytes / 2**20:.0f} MiB); peak is extra memory in frames')
+    print(f'{"index":<6} {"label":<10} {"eager ms":>9} {"peak":>5} {"plan ms":>9} {"peak":>5} {"numexpr ms":>11} {"peak":>5}')
+    warnings.simplefilter('ignore')
+    for key in options.index or INDICES:
+        spec = INDICES[key]
+        label, func = spec.label, spec.formula
+        index_args = spec.arguments(bands, spec.image_types[0])
+        try:
+            eager = measure(lambda: func.func(*index_args), options.repeat)
+        except TypeError as e:
+            print(f'{key:<6} {label:<10} skipped: {e}')
+            continue
+
+        engine.USE_NUMEXPR = False
+        planned = measure(lambda: func(*index_args), options.repeat)
+        row = f'{key:<6} {label:<10} {eager[0] * 1e3:9.1f} {eager[1] / frame_bytes:5.1f} {planned[0] * 1e3:9.1f} {planned[1] / frame_bytes:5.1f}'
+        if engine.numexpr is not None:
+            engine.USE_NUMEXPR = True
+            numexpr_timing = measure(lambda: func(*index_args), options.repeat)
+            row += f' {numexpr_timing[0] * 1e3:11.1f} {numexpr_timing[1] / frame_bytes:5.1f}'
+        print(row)
+
+
+if __name__ == '__main__':
+    main()
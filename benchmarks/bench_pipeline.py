@@ -0,0 +1,234 @@
+# Stage-by-stage benchmark of CrimsonCardinal's render pipeline for every
+# entry in the vegetation_indices registry, on synthetic RGN/NGB/RGB frames of
+# several sizes and on testImage.JPG. Each index is timed through the same steps
+# save_result takes: band extraction, index calculation, normalization (value
+# range and no-data mask), colormap rendering, colorbar drawing (cache cleared
+# first), compositing and encoding; best of --repeat per stage. Peak RSS is measured
+# per index on Linux (reset through /proc/self/clear_refs), otherwise it is the
+# process high-water mark. Results are written as JSON tagged with the git
+# commit; --compare prints per-index ratios against an earlier run.
+#
+#   python benchmarks/bench_pipeline.py --sizes 1,12,20,100 -o before.json
+#   python benchmarks/bench_pipeline.py --sizes 1,12 --types RGN --index 1 --index 5 --compare before.json
+import argparse
+import json
+import logging
+import math
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'CrimsonCardinal'))
+
+IMAGE_TYPES = ('RGN', 'NGB', 'RGB')
+STAGES = ('bands', 'index', 'normalize', 'colormap', 'colorbar', 'composite', 'encode')
+STRIP_ROWS = 1024
+
+
+def reset_peak_rss():
+    # Linux >= 4.0 lets a process reset its VmHWM
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss_mib():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2**20 if sys.platform == 'darwin' else peak / 1024
+
+
+def synthetic_frame(megapixels, image_type, seed=0):
+    # Smooth vegetation cover plus sensor noise, mapped to plausible band
+    # reflectances for the camera type; generated in strips to keep 100 MP cheap
+    width = int(math.sqrt(megapixels * 1e6 * 4 / 3))
+    height = int(megapixels * 1e6 / width)
+    rng = np.random.default_rng(seed)
+    x = np.linspace(0, 40, width, dtype=np.float32)
+    # (base, gain with vegetation) per channel
+    bands = {
+        'RGN': ((70, -40), (90, 30), (80, 140)),
+        'NGB': ((80, 140), (90, 30), (60, -20)),
+        'RGB': ((110, -60), (120, 40), (90, -40)),
+    }[image_type]
+    frame = np.empty((height, width, 3), dtype=np.uint8)
+    for start in range(0, height, STRIP_ROWS):
+        y = np.linspace(0, 30, height, dtype=np.float32)[start:start + STRIP_ROWS, None]
+        cover = 0.5 + 0.25 * (np.sin(x) * np.cos(y * 0.7) + np.sin(x * 0.13 + y * 0.11))
+        for channel, (base, gain) in enumerate(bands):
+            value = base + gain * cover + rng.normal(0, 6, cover.shape).astype(np.float32)
+            frame[start:start + STRIP_ROWS, :, channel] = np.clip(value, 0, 255)
+    return frame
+
+
+def timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    value = func(*args, **kwargs)
+    return value, time.perf_counter() - start
+
+
+def run_index(app, rgb, image_type, key, output_name, repeat):
+    spec = app.INDICES[key]
+    label, func, colormap_name = spec.label, spec.formula, spec.colormap
+    best = dict.fromkeys(STAGES, math.inf)
+    for _ in range(repeat):
+        args, t = timed(app.index_inputs, rgb, image_type, key)
+        best['bands'] = min(best['bands'], t)
+        result, t = timed(func, *args, dtype=app.app.config['BAND_DTYPE'])
+        best['index'] = min(best['index'], t)
+        del args
+
+        # Mirrors save_result, one stage at a time
+        (vmin, vmax, valid), t = timed(app.scan, result)
+        best['normalize'] = min(best['normalize'], t)
+        height, width = result.shape
+
+        app._colorbars.clear()
+        colorbar_image, t = timed(app.get_colorbar, colormap_name, label, vmin, vmax, int(width * 0.8), int(height * 0.1))
+        best['colorbar'] = min(best['colorbar'], t)
+
+        start = time.perf_counter()
+        footer = app.colorbar_footer(height, width, colorbar_image)
+        canvas = np.empty((height + footer.shape[0], width, 3), dtype=np.uint8)
+        canvas[height:] = footer
+        composite = time.perf_counter() - start
+
+        _, t = timed(app.render_colormap, result, colormap_name, vmin, vmax, out=canvas[:height], valid=valid)
+        best['colormap'] = min(best['colormap'], t)
+        best['composite'] = min(best['composite'], composite)
+        del result
+
+        _, t = timed(app.write_canvas, output_name, canvas)
+        best['encode'] = min(best['encode'], t)
+        del canvas
+    return label, best
+
+
+def git_revision():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT, capture_output=True, text=True, check=True).stdout.strip()
+        dirty = bool(subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=ROOT,
+                                    capture_output=True, text=True, check=True).stdout.strip())
+        return commit, dirty
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+
+
+def compare(results, baseline_path, threshold):
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    before = {(r['frame'], r['image_type'], r['index']): r for r in baseline['results'] if 'total' in r}
+    ratios = []
+    print(f'\nagainst {baseline.get("commit") or baseline_path} (ratio = now / before, > {threshold:g} flagged)')
+    for r in results:
+        old = before.get((r['frame'], r['image_type'], r['index']))
+        if 'total' not in r or old is None:
+            continue
+        ratio = r['total'] / old['total']
+        ratios.append(ratio)
+        slowest = max(STAGES, key=lambda stage: r['stages'][stage] / max(old['stages'].get(stage, 0), 1e-9))
+        flag = '  REGRESSION' if ratio > threshold else ''
+        print(f'{r["frame"]:<10} {r["image_type"]:<4} {r["index"]:>3} {r["label"]:<10} {ratio:>6.2f}x  (worst stage: {slowest}){flag}')
+    if ratios:
+        print(f'geometric mean {math.exp(sum(map(math.log, ratios)) / len(ratios)):.3f}x over {len(ratios)} runs')
+    return sum(ratio > threshold for ratio in ratios)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time every stage of CrimsonCardinal's render pipeline for every registry index.")
+    parser.add_argument('--sizes', default='1,12,20,100', help='comma-separated synthetic frame sizes in megapixels')
+    parser.add_argument('--types', default=','.join(IMAGE_TYPES), help='comma-separated image types')
+    parser.add_argument('--index', action='append', help='index key to run (default: all valid for the type)')
+    parser.add_argument('--no-test-image', action='store_true', help='skip testImage.JPG')
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('-o', '--output', help='JSON results file (default: pipeline-<commit>.json)')
+    parser.add_argument('--compare', help='earlier JSON results to compare against')
+    parser.add_argument('--threshold', type=float, default=1.10, help='ratio flagged as a regression by --compare')
+    options = parser.parse_args()
+
+    import imageio.v2 as imageio
+    import app
+    logging.getLogger().setLevel(logging.WARNING)
+    # Measure real colorbar drawing, not the disk tier
+    app.app.config['COLORBAR_CACHE_FOLDER'] = None
+
+    image_types = [t for t in options.types.split(',') if t]
+    frames = [(f'{size:g}MP', lambda size=size, image_type=None: synthetic_frame(size, image_type))
+              for size in map(float, options.sizes.split(',') if options.sizes else [])]
+    if not options.no_test_image:
+        frames.append(('testImage', lambda image_type=None: imageio.imread(os.path.join(ROOT, 'testImage.JPG'))[:, :, :3]))
+
+    commit, dirty = git_revision()
+    rss_resets = reset_peak_rss()
+    folder = tempfile.mkdtemp()
+    output_name = os.path.join(folder, 'out' + app.OUTPUT_FORMATS[app.app.config['OUTPUT_FORMAT']])
+    results = []
+    print(f'{"frame":<10} {"type":<4} {"key":>3} {"label":<10} ' + ' '.join(f'{stage:>9}' for stage in STAGES) + f' {"total":>9} {"RSS MiB":>8}')
+    for frame_name, make_frame in frames:
+        for image_type in image_types:
+            rgb = make_frame(image_type=image_type)
+            height, width = rgb.shape[:2]
+            keys = options.index or [key for key, spec in app.INDICES.items() if image_type in spec.image_types]
+            for key in keys:
+                record = {'frame': frame_name, 'image_type': image_type, 'width': width, 'height': height,
+                          'megapixels': round(width * height / 1e6, 2), 'index': key, 'label': app.INDICES[key].label}
+                reset_peak_rss()
+                try:
+                    label, stages = run_index(app, rgb, image_type, key, output_name, options.repeat)
+                except Exception as e:
+                    record['error'] = f'{type(e).__name__}: {e}'
+                    print(f'{frame_name:<10} {image_type:<4} {key:>3} {record["label"]:<10} error: {record["error"]}')
+                    results.append(record)
+                    continue
+                record['stages'] = stages
+                record['total'] = sum(stages.values())
+                record['peak_rss_mib'] = round(peak_rss_mib(), 1)
+                results.append(record)
+                print(f'{frame_name:<10} {image_type:<4} {key:>3} {label:<10} ' + ' '.join(f'{stages[stage] * 1e3:>7.0f}ms' for stage in STAGES)
+                      + f' {record["total"] * 1e3:>7.0f}ms {record["peak_rss_mib"]:>8.0f}')
+            del rgb
+
+    try:
+        import numexpr
+        numexpr_version = numexpr.__version__
+    except ImportError:
+        numexpr_version = None
+    report = {
+        'commit': commit,
+        'dirty': dirty,
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'machine': {'platform': platform.platform(), 'python': platform.python_version(), 'numpy': np.__version__,
+                    'numexpr': numexpr_version, 'cpu_count': os.cpu_count()},
+        'config': {key: app.app.config[key] for key in ('BAND_DTYPE', 'OUTPUT_FORMAT', 'PNG_COMPRESS_LEVEL', 'PNG_FILTER', 'ENCODE_WORKERS')},
+        'repeat': options.repeat,
+        'peak_rss': 'per index' if rss_resets else 'process high-water mark',
+        'results': results,
+    }
+    output = options.output or f'pipeline-{(commit or "unknown")[:10]}{"-dirty" if dirty else ""}.json'
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=1)
+    print(f'results written to {output}')
+
+    if options.compare:
+        return 1 if compare(results, options.compare, options.threshold) else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,113 @@
+# Cold start benchmark for the two web apps: each measurement runs in a fresh
+# interpreter, which imports the app (app.py alone, or wsgi.py, which is what
+# a WSGI server loads and where workers are warmed), then sends a first and a
+# second /process request for testImage.JPG through Flask's test client.
+# Reports import time (including any warm-up wsgi.py does), both request
+# latencies and app.py's most expensive imports (from -X importtime). --root points at another checkout, so the
+# same script can measure a tree from before a change.
+#
+#   python benchmarks/bench_startup.py --repeat 5
+#   python benchmarks/bench_startup.py --root /tmp/before --repeat 5
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+APPS = ('CrimsonCardinal', 'SpectralSparrow')
+# (index, image type, colormap) of the first and second request; the second
+# one uses another index and colormap, so nothing it needs is cached yet
+REQUESTS = {
+    'CrimsonCardinal': (('1', 'RGN', 'RdYlGn'), ('5', 'RGN', 'Viridis')),
+    'SpectralSparrow': (('1', 'RGN', 'Color 1 (blue, green, yellow, red)'), ('5', 'RGN', 'Color 2 (gray, gray, red, yellow, green)')),
+}
+
+
+def child(app_dir, module, image_path):
+    # Runs in the fresh interpreter; prints one JSON line
+    import logging
+    os.chdir(tempfile.mkdtemp())
+    sys.path.insert(0, app_dir)
+    start = time.perf_counter()
+    loaded = __import__(module)
+    imported = time.perf_counter() - start
+    app = loaded.app
+    logging.disable(logging.CRITICAL)
+
+    folder = tempfile.mkdtemp()
+    app.config['RESULT_FOLDER'] = os.path.join(folder, 'results')
+    os.makedirs(app.config['RESULT_FOLDER'])
+    if 'UPLOAD_CACHE_FOLDER' in app.config:
+        app.config['UPLOAD_CACHE_FOLDER'] = os.path.join(folder, 'uploads')
+        os.makedirs(app.config['UPLOAD_CACHE_FOLDER'])
+    client = app.test_client()
+    latencies = []
+    for index, image_type, colormap in REQUESTS[os.path.basename(app_dir)]:
+        with open(image_path, 'rb') as f:
+            data = {'image': (f, 'testImage.JPG'), 'index': index, 'image_type': image_type, 'colormap': colormap}
+            start = time.perf_counter()
+            response = client.post('/process', data=data, content_type='multipart/form-data')
+            latencies.append(time.perf_counter() - start)
+        if response.status_code != 200:
+            raise SystemExit(f'/process answered {response.status_code}: {response.get_data(as_text=True)[:200]}')
+    print(json.dumps({'import': imported, 'first': latencies[0], 'second': latencies[1]}))
+
+
+def measure(root, app_name, module, image_path):
+    app_dir = os.path.join(root, app_name)
+    process = subprocess.run([sys.executable, '-X', 'importtime', os.path.abspath(__file__), '--child', app_dir, module, image_path],
+                             capture_output=True, text=True)
+    lines = process.stdout.strip().splitlines()
+    if process.returncode or not lines:
+        raise RuntimeError(f'{app_name}/{module}.py failed:\n{process.stderr[-2000:]}')
+    timings = json.loads(lines[-1])
+    # "import time: self [us] | cumulative | imported package"; nested imports
+    # are indented by two spaces a level and listed before their importer
+    imports, children = [], []
+    for line in process.stderr.splitlines():
+        if not line.startswith('import time:') or line.endswith('imported package'):
+            continue
+        self_us, cumulative, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip())) // 2
+        if depth == 1:
+            children.append((int(cumulative) / 1e6, name.strip()))
+        elif depth == 0:
+            if name.strip() == 'app':
+                imports = children
+            children = []
+    timings['imports'] = imports
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time cold imports and first requests of both web apps.')
+    parser.add_argument('--root', default=ROOT, help='checkout to measure (default: this one)')
+    parser.add_argument('--repeat', type=int, default=3, help='fresh interpreters per app and entry point')
+    parser.add_argument('--top', type=int, default=6, help="app.py's largest imports to list")
+    parser.add_argument('--child', nargs=3, help=argparse.SUPPRESS)
+    options = parser.parse_args()
+    if options.child:
+        return child(*options.child)
+
+    root = os.path.abspath(options.root)
+    image_path = os.path.join(ROOT, 'testImage.JPG')
+    print(f'{root}, median of {options.repeat} fresh interpreters')
+    print(f'{"app":<16} {"module":<6} {"import ms":>10} {"1st request ms":>15} {"2nd request ms":>15} {"import + 1st":>13}')
+    for app_name in APPS:
+        for module in ('app', 'wsgi'):
+            runs = [measure(root, app_name, module, image_path) for _ in range(options.repeat)]
+            if module == 'app':
+                app_runs = runs
+            median = {key: statistics.median(run[key] for run in runs) for key in ('import', 'first', 'second')}
+            print(f'{app_name:<16} {module:<6} {median["import"] * 1e3:>10.0f} {median["first"] * 1e3:>15.0f} '
+                  f'{median["second"] * 1e3:>15.0f} {(median["import"] + median["first"]) * 1e3:>13.0f}')
+        top = sorted(app_runs[-1]['imports'], reverse=True)[:options.top]
+        print('    largest imports: ' + ', '.join(f'{name} {seconds * 1e3:.0f} ms' for seconds, name in top))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,68 @@
+# Compares every entry in the vegetation_indices registry computed from
+# float32 bands against float64 bands, for random 8-bit frames and
+# testImage.JPG. Reports the worst absolute error, the error relative to the
+# float64 value range, and the share of pixels that land in a different
+# colormap LUT bin; indices above the tolerance are flagged and the exit code
+# is non-zero. tests/test_precision.py asserts the same tolerance on every
+# run of the test suite; this script is for the full report.
+#
+#   python benchmarks/compare_precision.py --tolerance 1e-5
+import argparse
+import os
+import sys
+import warnings
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def lut_bins(result, vmin, vmax, lut_size=256):
+    span = vmax - vmin
+    scaled = (result.astype(np.float64) - vmin) / span * lut_size if span > 0 else np.zeros(result.shape)
+    return np.clip(np.nan_to_num(scaled), 0, lut_size - 1).astype(np.intp)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare every registry index computed from float32 and float64 bands.')
+    parser.add_argument('--tolerance', type=float, default=1e-5, help='max error relative to the float64 value scale')
+    parser.add_argument('--size', type=int, default=512)
+    options = parser.parse_args()
+
+    import imageio.v2 as imageio
+    from vegetation_indices import INDICES, read_bands
+    from vegetation_indices.render import finite_range
+
+    rng = np.random.default_rng(0)
+    frames = {
+        'random': rng.integers(0, 256, (options.size, options.size, 3), dtype=np.uint8),
+        'testImage': imageio.imread(os.path.join(ROOT, 'testImage.JPG')),
+    }
+    warnings.simplefilter('ignore')
+    failures = 0
+    print(f'{"frame":<10} {"type":<4} {"index":<6} {"label":<10} {"max abs":>10} {"max rel":>10} {"bins":>8}')
+    for frame_name, frame in frames.items():
+        for key, spec in INDICES.items():
+            label, image_type = spec.label, spec.image_types[0]
+            if spec.band_names(image_type) is None:
+                continue
+            reference, single = (spec.formula(*spec.arguments(read_bands(frame, image_type, dtype), image_type)).astype(np.float64)
+                                 for dtype in (np.float64, np.float32))
+            finite = np.isfinite(reference) & np.isfinite(single)
+            vmin, vmax = finite_range(reference)
+            scale = max(vmax - vmin, abs(vmin), abs(vmax)) or 1.0
+            abs_error = np.abs(reference[finite] - single[finite]).max(initial=0.0)
+            rel_error = abs_error / scale
+            bins = np.mean(lut_bins(reference, vmin, vmax) != lut_bins(single, vmin, vmax))
+            flag = ''
+            if rel_error > options.tolerance:
+                flag = '  <-- above tolerance'
+                failures += 1
+            print(f'{frame_name:<10} {image_type:<4} {key:<6} {label:<10} {abs_error:10.2e} {rel_error:10.2e} {bins:8.2%}{flag}')
+
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
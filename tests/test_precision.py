@@ -0,0 +1,48 @@
+# Every index computed from float32 bands (the default BAND_DTYPE) must stay
+# within 1e-5 of the float64 result, relative to the index's value scale, and
+# mark the same pixels as no-data.
+import os
+import sys
+import warnings
+
+import numpy as np
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from vegetation_indices import INDICES, read_bands  # noqa: E402
+from vegetation_indices.render import finite_range  # noqa: E402
+
+TOLERANCE = 1e-5
+
+
+def sample_frame():
+    # Random 8-bit bands with black and single-band-zero pixels, where the
+    # ratios divide by zero
+    rng = np.random.default_rng(0)
+    frame = rng.integers(0, 256, (96, 128, 3), dtype=np.uint8)
+    frame[:4] = 0
+    frame[10:14, :, 0] = 0
+    frame[20:24, :, 2] = 0
+    return frame
+
+
+CASES = [(key, image_type) for key, spec in INDICES.items() for image_type in spec.image_types
+         if spec.band_names(image_type) is not None]
+
+
+@pytest.mark.parametrize('key,image_type', CASES)
+def test_float32_matches_float64(key, image_type):
+    spec = INDICES[key]
+    frame = sample_frame()
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        reference, single = (np.asarray(spec.formula(*spec.arguments(read_bands(frame, image_type, dtype), image_type)), np.float64)
+                             for dtype in (np.float64, np.float32))
+    np.testing.assert_array_equal(np.isfinite(single), np.isfinite(reference), err_msg='no-data pixels differ')
+    finite = np.isfinite(reference)
+    vmin, vmax = finite_range(reference)
+    scale = max(vmax - vmin, abs(vmin), abs(vmax)) or 1.0
+    error = np.abs(reference[finite] - single[finite]).max(initial=0.0) / scale
+    assert error <= TOLERANCE, f'{spec.label}: relative error {error:.2e}'
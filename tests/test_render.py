@@ -0,0 +1,51 @@
+# The LUT renderer must give the same pixels as matplotlib's colormap +
+# Normalize, which is what the apps rendered through before (imshow), for
+# every colormap the apps offer. No-data pixels, drawn transparent by imshow
+# on a white figure, come out white.
+import os
+import sys
+
+import numpy as np
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'CrimsonCardinal'))
+
+from matplotlib.colors import Normalize  # noqa: E402
+
+from app import colormap_options  # noqa: E402
+from vegetation_indices.render import apply_lut, colormap_lut, resolve_colormap, scan  # noqa: E402
+
+WHITE = (255, 255, 255)
+
+
+def sample_values(dtype):
+    # Smooth values over the range, values just at and beyond its ends, and no-data
+    rng = np.random.default_rng(0)
+    values = rng.uniform(-1.2, 1.2, (64, 97)).astype(dtype)
+    values[0, :5] = [-1, 1, -1e6, 1e6, 0]
+    values[1, :3] = [np.nan, np.inf, -np.inf]
+    values[5:9, 10:40] = np.nan
+    return values
+
+
+def expected_pixels(values, cmap, vmin, vmax):
+    rgba = resolve_colormap(cmap)(Normalize(vmin, vmax)(values), bytes=True)
+    rgb = rgba[..., :3].copy()
+    rgb[~np.isfinite(values)] = WHITE
+    return rgb
+
+
+@pytest.mark.parametrize('dtype', [np.float32, np.float64])
+@pytest.mark.parametrize('colormap_name', sorted(colormap_options))
+def test_apply_lut_matches_matplotlib(colormap_name, dtype):
+    values = sample_values(dtype)
+    cmap = colormap_options[colormap_name]
+    lut = colormap_lut(cmap)
+    for vmin, vmax in [(-1.0, 1.0), (-0.3, 0.7)]:
+        expected = expected_pixels(values, cmap, vmin, vmax)
+        np.testing.assert_array_equal(apply_lut(values, lut, vmin, vmax), expected)
+        # Same pixels through the packed validity mask the apps pass in
+        _, _, valid = scan(values)
+        np.testing.assert_array_equal(apply_lut(values, lut, vmin, vmax, valid=valid), expected)
@@ -0,0 +1,7 @@
+# === Vegetation index library ===
+# Shared by CrimsonCardinal, SpectralSparrow and the batch tool: the
+# expression engine (engine), the index formulas (formulas) and the registry
+# of every index the apps offer (registry). Importing the package only loads
+# the registry; the engine, numexpr and the formula tracing wait until an
+# index is first computed.
+from .registry import CAMERA_BANDS, INDICES, IndexSpec, band_layout, make_plan, read_bands
@@ -0,0 +1,320 @@
+# === Expression-graph index engine ===
+# Index formulas are traced once with symbolic bands into small expression
+# trees. A tree (or several at once) compiles into a plan: identical
+# subexpressions are computed once, and intermediates live in a few scratch
+# buffers that are reused through ufunc out= arguments instead of allocating a
+# new full-frame temporary for every operator.
+import inspect
+
+import numpy as np
+
+try:
+    import numexpr
+except ImportError:
+    numexpr = None
+
+# numexpr evaluates a whole formula in cache-sized blocks on all cores; it is
+# used for single-index evaluation when installed and this flag is left on.
+USE_NUMEXPR = numexpr is not None
+# Bands of another type than the result (uint8/uint16 sensor data, views of a
+# memory-mapped upload) are converted this many elements at a time instead of
+# as full-frame copies
+CONVERT_BLOCK_ELEMENTS = 1 << 18
+
+COMMUTATIVE = {'add', 'multiply'}
+# A zero denominator (black pixels: 0/0, or x/0) makes the pixel no-data,
+# NaN, rather than ±inf, so ranges and colormaps skip it like any NaN
+DIVISIONS = {'divide', 'true_divide'}
+NUMEXPR_OPERATORS = {'add': '+', 'subtract': '-', 'multiply': '*', 'divide': '/', 'true_divide': '/', 'power': '**'}
+NUMEXPR_FUNCTIONS = {'sqrt': 'sqrt', 'negative': '-'}
+
+
+class Expr:
+    __slots__ = ('op', 'args', 'value', '_key')
+    __array_priority__ = 1000
+
+    def __init__(self, op, args=(), value=None):
+        self.op = op          # 'band', 'const' or a numpy ufunc
+        self.args = args
+        self.value = value    # band name or constant
+        self._key = None
+
+    @property
+    def key(self):
+        if self._key is None:
+            if self.op in ('band', 'const'):
+                self._key = (self.op, self.value)
+            else:
+                child_keys = tuple(arg.key for arg in self.args)
+                if self.op.__name__ in COMMUTATIVE:
+                    child_keys = tuple(sorted(child_keys, key=repr))
+                self._key = (self.op.__name__,) + child_keys
+        return self._key
+
+    # Tracing: numpy ufuncs called on an Expr build a new node instead of computing
+    def __array_ufunc__(self, ufunc, method, *inputs, **kwargs):
+        if method != '__call__' or kwargs:
+            return NotImplemented
+        return apply(ufunc, *inputs)
+
+    def __add__(self, other): return apply(np.add, self, other)
+    def __radd__(self, other): return apply(np.add, other, self)
+    def __sub__(self, other): return apply(np.subtract, self, other)
+    def __rsub__(self, other): return apply(np.subtract, other, self)
+    def __mul__(self, other): return apply(np.multiply, self, other)
+    def __rmul__(self, other): return apply(np.multiply, other, self)
+    def __truediv__(self, other): return apply(np.true_divide, self, other)
+    def __rtruediv__(self, other): return apply(np.true_divide, other, self)
+    def __neg__(self): return apply(np.negative, self)
+
+    def __pow__(self, other):
+        # Same fast path numpy takes for arr ** 2
+        if not isinstance(other, Expr) and other == 2:
+            return apply(np.square, self)
+        return apply(np.power, self, other)
+
+    def __repr__(self):
+        return to_source(self)
+
+
+def band(name):
+    return Expr('band', value=name)
+
+
+def const(value):
+    return Expr('const', value=float(value))
+
+
+def apply(ufunc, *inputs):
+    args = tuple(arg if isinstance(arg, Expr) else const(arg) for arg in inputs)
+    # Fold constant-only subtrees at trace time
+    if all(arg.op == 'const' for arg in args):
+        return const(ufunc(*(arg.value for arg in args)))
+    return Expr(ufunc, args)
+
+
+def substitute(expr, names, memo=None):
+    memo = {} if memo is None else memo
+    if id(expr) not in memo:
+        if expr.op == 'band':
+            memo[id(expr)] = band(names.get(expr.value, expr.value))
+        elif expr.op == 'const':
+            memo[id(expr)] = expr
+        else:
+            memo[id(expr)] = Expr(expr.op, tuple(substitute(arg, names, memo) for arg in expr.args))
+    return memo[id(expr)]
+
+
+def to_source(expr, constants=None):
+    # With a constants list, literals become names (_c0, _c1, ...) so numexpr can
+    # be handed typed scalars; bare float literals would upcast float32 to float64
+    if expr.op == 'band':
+        return expr.value
+    if expr.op == 'const':
+        if constants is None:
+            return repr(expr.value)
+        constants.append(expr.value)
+        return f'_c{len(constants) - 1}'
+    name = expr.op.__name__
+    args = [to_source(arg, constants) for arg in expr.args]
+    if constants is not None and name in DIVISIONS and expr.args[1].op != 'const':
+        return f'where({args[1]} != 0, {args[0]} / {args[1]}, _nan)'
+    if name in NUMEXPR_OPERATORS:
+        return f'({args[0]} {NUMEXPR_OPERATORS[name]} {args[1]})'
+    if name == 'square':
+        return f'({args[0]} ** 2)'
+    return f'{NUMEXPR_FUNCTIONS[name]}({args[0]})'
+
+
+def default_dtype(*arrays):
+    # Float bands keep their precision; integer sensor data is promoted to float64
+    dtypes = [np.asarray(array).dtype for array in arrays]
+    if dtypes and all(np.issubdtype(dtype, np.floating) for dtype in dtypes):
+        return np.result_type(*dtypes)
+    return np.dtype(np.float64)
+
+
+def divide_blocks(ufunc, numerator, denominator, out, dtype):
+    # Division with zero denominators giving NaN, in row blocks. Each block's
+    # zeros are found before its quotient is written, since out may be the
+    # denominator's buffer, in one mask buffer reused for every block.
+    if not out.ndim:
+        zero = np.equal(denominator, 0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ufunc(numerator, denominator, out=out, dtype=dtype)
+        np.copyto(out, np.nan, where=zero)
+        return
+    numerator = np.broadcast_to(numerator, out.shape) if np.ndim(numerator) else numerator
+    denominator = np.broadcast_to(denominator, out.shape)
+    rows = max(1, CONVERT_BLOCK_ELEMENTS // max(1, out[0].size))
+    mask = np.empty((min(rows, len(out)),) + out.shape[1:], dtype=bool)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for start in range(0, len(out), rows):
+            block = out[start:start + rows]
+            zero = mask[:len(block)]
+            np.equal(denominator[start:start + rows], 0, out=zero)
+            ufunc(numerator[start:start + rows] if np.ndim(numerator) else numerator, denominator[start:start + rows], out=block, dtype=dtype)
+            np.copyto(block, np.nan, where=zero)
+
+
+class Plan:
+    def __init__(self, outputs):
+        self.outputs = list(outputs)
+        self.bands = []
+        self.steps = []     # (ufunc, operand refs, out slot, output positions, refs released after)
+        self.slot_count = 0
+
+        nodes = {}          # canonical key -> ref
+        order = []
+        operands = {}
+
+        def visit(expr):
+            key = expr.key
+            if key in nodes:
+                return nodes[key]
+            if expr.op == 'band':
+                ref = ('band', expr.value)
+                if expr.value not in self.bands:
+                    self.bands.append(expr.value)
+            elif expr.op == 'const':
+                ref = ('const', expr.value)
+            else:
+                args = tuple(visit(arg) for arg in expr.args)
+                ref = ('node', len(order))
+                order.append(expr.op)
+                operands[ref] = args
+            nodes[key] = ref
+            return ref
+
+        output_refs = [visit(expr) for expr in self.outputs]
+
+        last_use = {}
+        for position, ufunc in enumerate(order):
+            for arg in operands[('node', position)]:
+                last_use[arg] = position
+
+        free_slots = []
+        slot_of = {}
+        for position, ufunc in enumerate(order):
+            ref = ('node', position)
+            args = operands[ref]
+            released = [arg for arg in set(args) if arg[0] == 'node' and last_use.get(arg) == position and arg not in output_refs]
+            # Operands that die here give their buffer back before the result
+            # is allocated, so the ufunc can write in place
+            for arg in released:
+                free_slots.append(slot_of[arg])
+            if free_slots:
+                slot = free_slots.pop()
+            else:
+                slot = self.slot_count
+                self.slot_count += 1
+            slot_of[ref] = slot
+            positions = tuple(i for i, out in enumerate(output_refs) if out == ref)
+            if positions:
+                # The caller keeps the output array; the slot starts fresh next time
+                free_slots.append(slot)
+            self.steps.append((ufunc, args, slot, positions, released))
+
+        # Outputs that are bare bands or constants need no computation
+        self.trivial = [(i, ref) for i, ref in enumerate(output_refs) if ref[0] != 'node']
+
+    def run(self, arrays, dtype=None):
+        # Yields (output position, array) as soon as each output is complete,
+        # so a caller can render it and let it go before the next one is built.
+        dtype = default_dtype(*(arrays[name] for name in self.bands)) if dtype is None else dtype
+        shape = np.broadcast_shapes(*(np.shape(arrays[name]) for name in self.bands))
+        slots = [None] * self.slot_count
+        values = {('band', name): arrays[name] for name in self.bands}
+
+        for position, ref in self.trivial:
+            value = values[ref] if ref[0] == 'band' else ref[1]
+            yield position, np.full(shape, value, dtype=dtype) if ref[0] == 'const' else np.asarray(value, dtype=dtype)
+
+        for number, (ufunc, args, slot, positions, released) in enumerate(self.steps):
+            out = slots[slot]
+            if out is None:
+                out = slots[slot] = np.empty(shape, dtype=dtype)
+            operands = [values[arg] if arg[0] != 'const' else arg[1] for arg in args]
+            if ufunc.__name__ in DIVISIONS and args[1][0] != 'const':
+                divide_blocks(ufunc, *operands, out, dtype)
+            else:
+                ufunc(*operands, out=out, dtype=dtype)
+            values[('node', number)] = out
+            for arg in released:
+                del values[arg]
+            if positions:
+                slots[slot] = None
+                for output_position in positions:
+                    yield output_position, out
+
+    def evaluate(self, arrays, dtype=None):
+        results = [None] * len(self.outputs)
+        for position, result in self.run(arrays, dtype):
+            results[position] = result
+        return results
+
+
+class IndexFormula:
+    def __init__(self, func):
+        self.func = func
+        self.__name__ = func.__name__
+        self.__doc__ = func.__doc__
+        parameters = inspect.signature(func).parameters.values()
+        self.bands = [p.name for p in parameters if p.default is inspect.Parameter.empty]
+        self.expr = func(*(band(name) for name in self.bands))
+        if not isinstance(self.expr, Expr):
+            raise TypeError(f'{func.__name__} does not depend on any band')
+        self.source = to_source(self.expr)
+        self.constants = []
+        self.numexpr_source = to_source(self.expr, self.constants)
+        self._plan = None
+
+    @property
+    def plan(self):
+        if self._plan is None:
+            self._plan = Plan([self.expr])
+        return self._plan
+
+    def bind(self, *names):
+        # Same formula with its parameters renamed to concrete band names, so
+        # formulas called with different argument orders share leaves in a Plan
+        if len(names) != len(self.bands):
+            raise TypeError(f'{self.__name__}() takes bands {", ".join(self.bands)} but got {len(names)}')
+        return substitute(self.expr, dict(zip(self.bands, names)))
+
+    def __call__(self, *arrays, dtype=None):
+        if len(arrays) != len(self.bands):
+            raise TypeError(f'{self.__name__}() takes bands {", ".join(self.bands)} but got {len(arrays)} arrays')
+        bindings = dict(zip(self.bands, arrays))
+        dtype = default_dtype(*arrays) if dtype is None else np.dtype(dtype)
+        if USE_NUMEXPR:
+            bindings.update((f'_c{i}', dtype.type(value)) for i, value in enumerate(self.constants))
+            bindings['_nan'] = dtype.type(np.nan)
+            if all(np.asarray(array).dtype == dtype for array in arrays):
+                result = numexpr.evaluate(self.numexpr_source, local_dict=bindings)
+                return result.astype(dtype, copy=False)
+            return self._evaluate_converted(bindings, dtype)
+        # ufuncs given dtype= already convert their inputs a buffer at a time
+        return self.plan.evaluate(bindings, dtype)[0]
+
+    def _evaluate_converted(self, bindings, dtype):
+        # numexpr would compute integer bands in its own types (int32, then
+        # float64), so they are converted to dtype in row blocks here; the
+        # values are the same as converting the whole bands first
+        shape = np.broadcast_shapes(*(np.shape(bindings[name]) for name in self.bands))
+        if not shape:
+            arrays = {name: np.asarray(bindings[name], dtype) for name in self.bands}
+            return np.asarray(numexpr.evaluate(self.numexpr_source, local_dict={**bindings, **arrays}), dtype)
+        out = np.empty(shape, dtype=dtype)
+        rows = max(1, CONVERT_BLOCK_ELEMENTS // max(1, out[0].size))
+        for start in range(0, shape[0], rows):
+            block = {name: np.asarray(np.broadcast_to(bindings[name], shape)[start:start + rows], dtype) for name in self.bands}
+            out[start:start + rows] = numexpr.evaluate(self.numexpr_source, local_dict={**bindings, **block})
+        return out
+
+    def __repr__(self):
+        return f'<IndexFormula {self.__name__}: {self.source}>'
+
+
+def index_formula(func):
+    return IndexFormula(func)
@@ -0,0 +1,277 @@
+# === Index formulas ===
+# Every formula the apps offer, written as plain NumPy on band arrays and
+# traced once into an expression plan (see engine). Parameters without a
+# default are the bands, in the order the registry binds them. Names are
+# unique here; several indices may share one formula.
+import numpy as np
+
+from .engine import index_formula
+
+# === Original indices ===
+@index_formula
+def calculate_ndvi(NIR, R):
+    return np.true_divide(np.subtract(NIR, R), np.add(NIR, R))
+
+@index_formula
+def calculate_ndvi_ngb(NIR, B):
+    return np.true_divide(np.subtract(NIR, B), np.add(NIR, B))
+
+@index_formula
+def calculate_endvi(NIR, G, B):
+    NIRG = np.add(NIR, G)
+    return np.true_divide(np.subtract(NIRG, 2*B), np.add(NIRG, 2*B))
+
+@index_formula
+def calculate_endvi_rgn(NIR, R, G):
+    NIRR = np.add(NIR, R)
+    return np.true_divide(np.subtract(NIRR, 2*G), np.add(NIRR, 2*G))
+
+@index_formula
+def calculate_savi(NIR, R, L=0.5):
+    NIRminusR = np.subtract(NIR, R)
+    NIRplusRplusL = np.add(np.add(NIR, R), L)
+    return np.multiply(np.true_divide(NIRminusR, NIRplusRplusL), (1 + L))
+
+@index_formula
+def calculate_tvi(NIR, R, G):
+    return 0.5 * (120 * (NIR - G) - 200 * (R - G))
+
+@index_formula
+def calculate_gndvi(NIR, G):
+    return np.true_divide(np.subtract(NIR, G), np.add(NIR, G))
+
+@index_formula
+def calculate_msavi(NIR, R):
+    return 0.5 * (2 * NIR + 1 - np.sqrt((2 * NIR + 1) ** 2 - 8 * (NIR - R)))
+
+# CVI as the ratio NIR / R - 1, which the registry pins index 9 to;
+# calculate_cvi below is the usual NIR * R / G^2
+@index_formula
+def calculate_cvi_ratio(NIR, R):
+    return np.true_divide(NIR, R) - 1
+
+@index_formula
+def calculate_cvi2(NIR, R, G):
+    return np.true_divide(np.multiply(NIR, R), np.square(G))
+
+@index_formula
+def calculate_pri(NIR, R):
+    return np.true_divide(np.subtract(NIR, R), np.add(NIR, R))
+
+@index_formula
+def calculate_ndwi(G, NIR):
+    return np.true_divide(np.subtract(G, NIR), np.add(G, NIR))
+
+@index_formula
+def calculate_vari(G, R, B):
+    return np.true_divide(np.subtract(G, R), np.add(np.subtract(G, R), B))
+
+@index_formula
+def calculate_evi(NIR, R, B):
+    return 2.5 * np.true_divide(np.subtract(NIR, R), np.add(np.add(NIR, 6 * R), np.add(-7.5 * B, 1)))
+
+@index_formula
+def calculate_ng(G, NIR, R):
+    return np.true_divide(G, np.add(np.add(NIR, R), G))
+
+# === New RGB indices ===
+@index_formula
+def calculate_ngrdi(G, R):
+    return np.true_divide(np.subtract(G, R), np.add(G, R))
+
+@index_formula
+def calculate_exg(G, R, B):
+    return 2 * G - R - B
+
+@index_formula
+def calculate_exr(R, G):
+    return 1.4 * R - G
+
+@index_formula
+def calculate_exgr(G, R, B):
+    return (2 * G - R - B) - (1.4 * R - G)
+
+@index_formula
+def calculate_gli(G, R, B):
+    numerator = 2 * G - R - B
+    denominator = 2 * G + R + B
+    return np.true_divide(numerator, denominator)
+
+@index_formula
+def calculate_gli2(G, R, B):
+    numerator = (G - R) + (G - B)
+    denominator = 2 * G + R + B
+    return np.true_divide(numerator, denominator)
+
+@index_formula
+def calculate_rgbvi(G, R, B):
+    return np.true_divide(np.square(G) - np.multiply(R, B), np.square(G) + np.multiply(R, B))
+
+@index_formula
+def calculate_tgi(R, G, B):
+    return -0.5 * ((660 - 550) * (R - G) - (660 - 480) * (R - B))
+
+@index_formula
+def calculate_ngbdi(G, B):
+    return np.true_divide(np.subtract(G, B), np.add(G, B))
+
+@index_formula
+def calculate_vdvi(G, R, B):
+    numerator = 2 * G - R - B
+    denominator = 2 * G + R + B
+    return np.true_divide(numerator, denominator)
+
+@index_formula
+def calculate_mexg(G, R, B):
+    return 1.262 * G - 0.884 * R - 0.311 * B
+
+@index_formula
+def calculate_veg(G, R, B):
+    return np.true_divide(G, (np.power(R, 0.667) * np.power(B, 0.333)))
+
+@index_formula
+def calculate_gcc(G, R, B):
+    return np.true_divide(G, np.add(np.add(R, G), B))
+
+@index_formula
+def calculate_cive(R, G, B):
+    return 0.441 * R - 0.811 * G + 0.385 * B + 18.78745
+
+@index_formula
+def calculate_ndti(R, G):
+    return np.true_divide(np.subtract(R, G), np.add(R, G))
+
+@index_formula
+def calculate_sci(R, G):
+    return np.true_divide(np.subtract(R, G), np.add(R, G))
+
+@index_formula
+def calculate_ndbi(R, G):
+    return np.true_divide(np.subtract(R, G), np.add(R, G))
+
+@index_formula
+def calculate_bi(R, G, B):
+    return np.sqrt((np.square(R) + np.square(G) + np.square(B)) / 3)
+
+@index_formula
+def calculate_ui(R, B):
+    return np.true_divide(R, np.add(np.add(R, B), R + B))  # Safe option
+
+# === New NGB indices ===
+@index_formula
+def calculate_ndvi_mod(NIR, G):
+    return np.true_divide(np.subtract(NIR, G), np.add(NIR, G))
+
+@index_formula
+def calculate_ndbi_blue(NIR, B):
+    return np.true_divide(np.subtract(NIR, B), np.add(NIR, B))
+
+@index_formula
+def calculate_ndgi(G, B):
+    return np.true_divide(np.subtract(G, B), np.add(G, B))
+
+@index_formula
+def calculate_bgi(G, B):
+    return np.true_divide(np.subtract(G, B), np.add(G, B))
+
+@index_formula
+def calculate_evi_mod(NIR, G, B):
+    return 2.5 * np.true_divide(np.subtract(NIR, G), np.add(np.add(NIR, 6 * G), np.add(-7.5 * B, 1)))
+
+# MSAVI with green standing in for red, for NGB cameras
+@index_formula
+def calculate_msavi_ngb(NIR, G):
+    return 0.5 * (2 * NIR + 1 - np.sqrt((2 * NIR + 1) ** 2 - 8 * (NIR - G)))
+
+@index_formula
+def calculate_endvi_ngb(NIR, G, B):
+    return np.true_divide(np.subtract(np.add(NIR, G), 2 * B), np.add(np.add(NIR, G), 2 * B))
+
+@index_formula
+def calculate_gndwi(G, NIR):
+    return np.true_divide(np.subtract(G, NIR), np.add(G, NIR))
+
+@index_formula
+def calculate_cig(NIR, G):
+    return np.true_divide(NIR, G) - 1
+
+@index_formula
+def calculate_gbndvi(NIR, G, B):
+    return np.true_divide(np.subtract(NIR, np.add(G, B)), np.add(NIR, np.add(G, B)))
+
+@index_formula
+def calculate_gsavi(NIR, G, L=0.16):
+    numerator = np.subtract(NIR, np.add(G, L))
+    denominator = np.add(np.add(NIR, G), L)
+    return np.true_divide(numerator, denominator)
+
+@index_formula
+def calculate_grndvi(NIR, G):
+    return np.true_divide(np.subtract(NIR, G), np.add(NIR, G))
+
+@index_formula
+def calculate_gosavi(NIR, G):
+    return np.true_divide(np.subtract(NIR, G), np.add(np.add(NIR, G), 0.16))
+
+@index_formula
+def calculate_bndvi(NIR, B):
+    return np.true_divide(np.subtract(NIR, B), np.add(NIR, B))
+
+@index_formula
+def calculate_ngbvi(G, B):
+    return np.true_divide(np.subtract(G, B), np.add(G, B))
+
+@index_formula
+def calculate_cig_simple(NIR, G):
+    return np.true_divide(NIR, G) - 1
+
+@index_formula
+def calculate_bwdrvi(NIR, B):
+    return np.true_divide(0.1 * NIR - B, 0.1 * NIR + B)
+
+# === New RGN indices ===
+@index_formula
+def calculate_osavi(NIR, R):
+    return np.multiply(np.true_divide(np.subtract(NIR, R), np.add(NIR, R) + 0.16), (1 + 0.16))
+
+@index_formula
+def calculate_evi2(NIR, R):
+    return 2.5 * np.true_divide(np.subtract(NIR, R), np.add(NIR, 2.4 * R + 1))
+
+@index_formula
+def calculate_sr(NIR, R):
+    return np.true_divide(NIR, R)
+
+@index_formula
+def calculate_rdvi(NIR, R):
+    return np.true_divide(np.subtract(NIR, R), np.sqrt(np.add(NIR, R)))
+
+@index_formula
+def calculate_wdrvi(NIR, R, a=0.1):
+    return np.true_divide(a * NIR - R, a * NIR + R)
+
+@index_formula
+def calculate_mtvi2(NIR, R, G):
+    numerator = 1.5 * (1.2 * (NIR - G) - 2.5 * (R - G))
+    denominator = np.sqrt((NIR + 1) ** 2 - (R + 1) ** 2)
+    return np.true_divide(numerator, denominator)
+
+@index_formula
+def calculate_dvi(NIR, R):
+    return np.subtract(NIR, R)
+
+@index_formula
+def calculate_cired(NIR, R):
+    return np.true_divide(NIR, R) - 1
+
+@index_formula
+def calculate_cvi(NIR, R, G):
+    return np.true_divide(np.multiply(NIR, R), np.square(G))
+
+@index_formula
+def calculate_grvi(G, R):
+    return np.true_divide(np.subtract(G, R), np.add(G, R))
+
+@index_formula
+def calculate_rgri(R, G):
+    return np.true_divide(R, G)
@@ -0,0 +1,198 @@
+# === Index registry ===
+# One declarative entry per index the apps offer: key, label, formula name,
+# the bands bound to the formula's parameters, default colormap and the
+# camera types it is offered for. Entries name their formula instead of
+# holding it, so the registry can be read (menus, validation) without
+# importing the engine or tracing any formula; formulas load on first use.
+import copy
+import importlib
+
+import numpy as np
+
+# Which band each channel of a 3-channel frame carries, per camera type
+CAMERA_BANDS = {
+    'RGN': ('R', 'G', 'NIR'),
+    'NGB': ('NIR', 'G', 'B'),
+    'RGB': ('R', 'G', 'B'),
+}
+
+
+def band_layout(image_type):
+    # The band each channel carries. Besides the camera types above, an image
+    # type can name the channels of any sensor in order, as a tuple or a
+    # comma-separated string ('B,G,R,NIR,RE'); bands no formula uses (RE,
+    # thermal, alpha) are simply never read.
+    if isinstance(image_type, str):
+        if image_type in CAMERA_BANDS:
+            return CAMERA_BANDS[image_type]
+        image_type = image_type.split(',')
+    layout = tuple(name.strip() for name in image_type)
+    if len(layout) < 2 or not all(layout) or len(set(layout)) != len(layout):
+        raise ValueError(f'Invalid band layout {",".join(layout)}: give two or more distinct band names')
+    return layout
+
+
+def read_bands(rgb, image_type, dtype='float32', names=None):
+    # {band name: array} for the layout's channels, or only the named ones, so
+    # a two-band index doesn't touch the third channel. With dtype=None the
+    # bands are views of the frame (no copy, even of a memory-mapped upload)
+    # in its own type, for IndexFormula to convert a block at a time.
+    layout = band_layout(image_type)
+    channels = rgb.shape[2] if rgb.ndim == 3 else 1
+    bands = {}
+    for channel, name in enumerate(layout):
+        if names is not None and name not in names:
+            continue
+        if channel >= channels:
+            raise ValueError(f'Band {name} is channel {channel + 1} of {",".join(layout)}, but the image has {channels}')
+        band = rgb[:, :, channel] if rgb.ndim == 3 else rgb
+        bands[name] = band if dtype is None else np.asarray(band, dtype)
+    return bands
+
+
+# Value ranges the bounded indices can take for non-negative bands, for
+# colormaps on a fixed scale (comparable between frames and dates)
+NORMALIZED_DIFFERENCE = (-1.0, 1.0)
+FRACTION = (0.0, 1.0)
+
+
+class IndexSpec:
+    def __init__(self, key, label, formula, bands, colormap, image_types, value_range=None):
+        self.key = key
+        self.label = label
+        self.formula_name = formula
+        # One entry per formula parameter: a band name, or a tuple of
+        # alternatives taken in order of preference
+        self.bands = tuple(bands)
+        self.colormap = colormap
+        self.image_types = tuple(image_types)
+        # (low, high), or None for indices without a natural bound (ratios, EVI)
+        self.value_range = value_range
+
+    @property
+    def formula(self):
+        return getattr(importlib.import_module('.formulas', __package__), self.formula_name)
+
+    def offered_for(self, image_type):
+        # Camera types list their indices; any index whose bands a custom
+        # layout has can be computed from it
+        if isinstance(image_type, str) and image_type in CAMERA_BANDS:
+            return image_type in self.image_types
+        return True
+
+    def band_names(self, image_type):
+        # Concrete bands bound for this image type, or None if one is missing
+        available = band_layout(image_type)
+        names = []
+        for band in self.bands:
+            name = next((choice for choice in (band if isinstance(band, tuple) else (band,)) if choice in available), None)
+            if name is None:
+                return None
+            names.append(name)
+        return tuple(names)
+
+    def arguments(self, bands, image_type):
+        names = self.band_names(image_type)
+        if names is None:
+            raise ValueError(f'{self.label} needs bands that the image type {image_type} does not have')
+        return tuple(bands[name] for name in names)
+
+    def compute(self, rgb, image_type, dtype='float32'):
+        names = self.band_names(image_type)
+        return self.formula(*self.arguments(read_bands(rgb, image_type, None, names), image_type), dtype=dtype)
+
+    def with_bands(self, bands):
+        # The same index with other bands bound, for an app that computes it
+        # differently from the shared entry
+        spec = copy.copy(self)
+        spec.bands = tuple(bands)
+        return spec
+
+    def bind(self, image_type):
+        # The formula as an expression over concrete band names, for a Plan
+        # that evaluates several indices over the same bands at once
+        return self.formula.bind(*self.band_names(image_type))
+
+    def __repr__(self):
+        return f'<IndexSpec {self.key} {self.label}: {self.formula_name}{self.bands}>'
+
+
+def make_plan(specs, image_type):
+    # One engine Plan for several indices; shared subexpressions run once
+    from .engine import Plan
+    return Plan([spec.bind(image_type) for spec in specs])
+
+
+INDICES = {spec.key: spec for spec in [
+    IndexSpec('1', 'NDVI', 'calculate_ndvi', ('NIR', 'R'), 'RdYlGn', ('RGN',), NORMALIZED_DIFFERENCE),
+    IndexSpec('2', 'NDVI_NGB', 'calculate_ndvi_ngb', ('NIR', 'B'), 'RdYlGn', ('NGB',), NORMALIZED_DIFFERENCE),
+    IndexSpec('3', 'ENDVI', 'calculate_endvi', ('NIR', 'G', 'B'), 'Viridis', ('NGB',), NORMALIZED_DIFFERENCE),
+    IndexSpec('4', 'ENDVI_RGN', 'calculate_endvi_rgn', ('NIR', 'R', 'G'), 'Viridis', ('RGN',), NORMALIZED_DIFFERENCE),
+    IndexSpec('5', 'SAVI', 'calculate_savi', ('NIR', 'R'), 'Magma', ('RGN',), (-1.5, 1.5)),
+    IndexSpec('6', 'TVI', 'calculate_tvi', ('NIR', 'R', 'G'), 'Viridis', ('RGN',)),
+    IndexSpec('7', 'GNDVI', 'calculate_gndvi', (('NIR', 'R'), 'G'), 'RdYlGn', ('RGN', 'NGB', 'RGB'), NORMALIZED_DIFFERENCE),
+    IndexSpec('8', 'MSAVI', 'calculate_msavi', ('NIR', 'R'), 'RdYlGn', ('RGN',)),
+    IndexSpec('9', 'CVI', 'calculate_cvi_ratio', ('NIR', 'R'), 'RdYlGn', ('RGN',)),
+    IndexSpec('10', 'CVI2', 'calculate_cvi2', ('NIR', 'R', 'G'), 'RdYlGn', ('RGN',)),
+    IndexSpec('11', 'PRI', 'calculate_pri', ('NIR', 'R'), 'Cividis', ('RGN',), NORMALIZED_DIFFERENCE),
+    IndexSpec('12', 'NDWI', 'calculate_ndwi', ('G', 'NIR'), 'Blues', ('RGN', 'NGB'), NORMALIZED_DIFFERENCE),
+    IndexSpec('13', 'VARI', 'calculate_vari', ('G', 'R', 'B'), 'Jet', ('RGB',)),
+    IndexSpec('14', 'EVI', 'calculate_evi', ('NIR', 'R', 'B'), 'Plasma', ('RGN',)),
+    IndexSpec('15', 'NG', 'calculate_ng', ('G', 'NIR', 'R'), 'Inferno', ('RGN',), FRACTION),
+    IndexSpec('16', 'NGRDI', 'calculate_ngrdi', ('G', 'R'), 'RdYlGn', ('RGB',), NORMALIZED_DIFFERENCE),
+    IndexSpec('17', 'ExG', 'calculate_exg', ('G', 'R', 'B'), 'RdYlGn', ('RGB',)),
+    IndexSpec('18', 'ExR', 'calculate_exr', ('R', 'G'), 'Magma', ('RGB',)),
+    IndexSpec('19', 'ExGR', 'calculate_exgr', ('G', 'R', 'B'), 'Viridis', ('RGB',)),
+    IndexSpec('20', 'GLI', 'calculate_gli', ('G', 'R', 'B'), 'RdYlGn', ('RGB',), NORMALIZED_DIFFERENCE),
+    IndexSpec('21', 'RGBVI', 'calculate_rgbvi', ('G', 'R', 'B'), 'RdYlGn', ('RGB',), NORMALIZED_DIFFERENCE),
+    IndexSpec('22', 'TGI', 'calculate_tgi', ('R', 'G', 'B'), 'Plasma', ('RGB',)),
+    IndexSpec('23', 'NGBDI', 'calculate_ngbdi', ('G', 'B'), 'Blues', ('RGB',), NORMALIZED_DIFFERENCE),
+    IndexSpec('24', 'VDVI', 'calculate_vdvi', ('G', 'R', 'B'), 'RdYlGn', ('RGB',), NORMALIZED_DIFFERENCE),
+    IndexSpec('25', 'MExG', 'calculate_mexg', ('G', 'R', 'B'), 'Viridis', ('RGB',)),
+    IndexSpec('26', 'VEG', 'calculate_veg', ('G', 'R', 'B'), 'Cividis', ('RGB',)),
+    IndexSpec('27', 'GCC', 'calculate_gcc', ('G', 'R', 'B'), 'Inferno', ('RGB',), FRACTION),
+    IndexSpec('28', 'CIVE', 'calculate_cive', ('R', 'G', 'B'), 'Greys', ('RGB',)),
+    IndexSpec('29', 'NDTI', 'calculate_ndti', ('R', 'G'), 'Blues', ('RGB',), NORMALIZED_DIFFERENCE),
+    IndexSpec('30', 'SCI', 'calculate_sci', ('R', 'G'), 'Greys', ('RGB',), NORMALIZED_DIFFERENCE),
+    IndexSpec('31', 'NDBI', 'calculate_ndbi', ('R', 'G'), 'Greys', ('RGB',), NORMALIZED_DIFFERENCE),
+    IndexSpec('32', 'BI', 'calculate_bi', ('R', 'G', 'B'), 'Cividis', ('RGB',)),
+    IndexSpec('33', 'UI', 'calculate_ui', ('R', 'B'), 'Greys', ('RGB',), (0.0, 0.5)),
+    IndexSpec('34', 'NDVI_Mod', 'calculate_ndvi_mod', ('NIR', 'G'), 'RdYlGn', ('NGB',), NORMALIZED_DIFFERENCE),
+    IndexSpec('35', 'GNDVI', 'calculate_gndvi', ('NIR', 'G'), 'RdYlGn', ('NGB',), NORMALIZED_DIFFERENCE),
+    IndexSpec('36', 'NDBI-Blue', 'calculate_ndbi_blue', ('NIR', 'B'), 'Blues', ('NGB',), NORMALIZED_DIFFERENCE),
+    IndexSpec('37', 'NDGI', 'calculate_ndgi', ('G', 'B'), 'RdYlGn', ('NGB',), NORMALIZED_DIFFERENCE),
+    IndexSpec('38', 'BGI', 'calculate_bgi', ('G', 'B'), 'RdYlGn', ('NGB',), NORMALIZED_DIFFERENCE),
+    IndexSpec('39', 'EVI_Mod', 'calculate_evi_mod', ('NIR', 'G', 'B'), 'Plasma', ('NGB',)),
+    IndexSpec('40', 'MSAVI', 'calculate_msavi_ngb', ('NIR', 'G'), 'RdYlGn', ('NGB',)),
+    IndexSpec('41', 'ENDVI', 'calculate_endvi_ngb', ('NIR', 'G', 'B'), 'Viridis', ('NGB',), NORMALIZED_DIFFERENCE),
+    IndexSpec('42', 'GNDWI', 'calculate_gndwi', ('G', 'NIR'), 'Blues', ('NGB',), NORMALIZED_DIFFERENCE),
+    IndexSpec('43', 'CIG', 'calculate_cig', ('NIR', 'G'), 'Cividis', ('NGB',)),
+    IndexSpec('44', 'GBNDVI', 'calculate_gbndvi', ('NIR', 'G', 'B'), 'RdYlGn', ('NGB',), NORMALIZED_DIFFERENCE),
+    IndexSpec('45', 'GSAVI', 'calculate_gsavi', ('NIR', 'G'), 'Magma', ('NGB',), NORMALIZED_DIFFERENCE),
+    IndexSpec('46', 'GRNDVI', 'calculate_grndvi', ('NIR', 'G'), 'RdYlGn', ('NGB',), NORMALIZED_DIFFERENCE),
+    IndexSpec('48', 'GOSAVI', 'calculate_gosavi', ('NIR', 'G'), 'Magma', ('NGB',), NORMALIZED_DIFFERENCE),
+    IndexSpec('49', 'NDWI', 'calculate_ndwi', ('G', 'NIR'), 'Blues', ('NGB',), NORMALIZED_DIFFERENCE),
+    IndexSpec('50', 'BNDVI', 'calculate_bndvi', ('NIR', 'B'), 'RdYlGn', ('NGB',), NORMALIZED_DIFFERENCE),
+    IndexSpec('51', 'NGBVI', 'calculate_ngbvi', ('G', 'B'), 'RdYlGn', ('NGB',), NORMALIZED_DIFFERENCE),
+    IndexSpec('52', 'CIg', 'calculate_cig_simple', ('NIR', 'G'), 'Cividis', ('NGB',)),
+    IndexSpec('53', 'BWDRVI', 'calculate_bwdrvi', ('NIR', 'B'), 'RdYlGn', ('NGB',), NORMALIZED_DIFFERENCE),
+    IndexSpec('54', 'NDVI', 'calculate_ndvi', ('NIR', 'R'), 'RdYlGn', ('RGN',), NORMALIZED_DIFFERENCE),
+    IndexSpec('55', 'GNDVI', 'calculate_gndvi', ('NIR', 'G'), 'RdYlGn', ('RGN',), NORMALIZED_DIFFERENCE),
+    IndexSpec('56', 'SAVI', 'calculate_savi', ('NIR', 'R'), 'Magma', ('RGN',), (-1.5, 1.5)),
+    IndexSpec('57', 'MSAVI', 'calculate_msavi', ('NIR', 'R'), 'RdYlGn', ('RGN',)),
+    IndexSpec('58', 'OSAVI', 'calculate_osavi', ('NIR', 'R'), 'Magma', ('RGN',), (-1.16, 1.16)),
+    IndexSpec('59', 'EVI2', 'calculate_evi2', ('NIR', 'R'), 'Plasma', ('RGN',)),
+    IndexSpec('60', 'SR', 'calculate_sr', ('NIR', 'R'), 'Cividis', ('RGN',)),
+    IndexSpec('61', 'RDVI', 'calculate_rdvi', ('NIR', 'R'), 'RdYlGn', ('RGN',)),
+    IndexSpec('62', 'WDRVI', 'calculate_wdrvi', ('NIR', 'R'), 'Inferno', ('RGN',), NORMALIZED_DIFFERENCE),
+    IndexSpec('63', 'MTVI2', 'calculate_mtvi2', ('NIR', 'R', 'G'), 'Viridis', ('RGN',)),
+    IndexSpec('64', 'DVI', 'calculate_dvi', ('NIR', 'R'), 'RdYlGn', ('RGN',)),
+    IndexSpec('65', 'NDWI', 'calculate_ndwi', ('G', 'NIR'), 'Blues', ('RGN',), NORMALIZED_DIFFERENCE),
+    IndexSpec('66', 'CIg', 'calculate_cig', ('NIR', 'G'), 'Cividis', ('RGN',)),
+    IndexSpec('67', 'CIred', 'calculate_cired', ('NIR', 'R'), 'Cividis', ('RGN',)),
+    IndexSpec('68', 'CVI', 'calculate_cvi', ('NIR', 'R', 'G'), 'RdYlGn', ('RGN',)),
+    IndexSpec('69', 'GRVI', 'calculate_grvi', ('G', 'R'), 'RdYlGn', ('RGN',), NORMALIZED_DIFFERENCE),
+    IndexSpec('70', 'RGRI', 'calculate_rgri', ('R', 'G'), 'RdYlGn', ('RGN',)),
+    IndexSpec('71', 'NGRDI', 'calculate_ngrdi', ('G', 'R'), 'RdYlGn', ('RGN',), NORMALIZED_DIFFERENCE),
+    IndexSpec('72', 'GLI2', 'calculate_gli2', ('G', 'R', 'B'), 'RdYlGn', ('RGB',), NORMALIZED_DIFFERENCE),
+]}
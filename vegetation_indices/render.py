@@ -0,0 +1,194 @@
+# === Index rendering ===
+# Turning an index array into the picture both apps serve: colormap lookup at
+# native resolution, the value range it is scaled over, and the colorbar
+# strip below the image, drawn with matplotlib once per (colormap, label,
+# range, size) and reused. Colormaps can be given as a matplotlib name, a
+# Colormap or a list of colors (or of (position, color) pairs). matplotlib is
+# only imported once a colormap or colorbar is actually needed.
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from io import BytesIO
+
+import numpy as np
+from PIL import Image
+
+RENDER_STRIP_ROWS = 512
+# Rows are scanned for their range this many values at a time, so the block
+# is still in cache for the min, the max and the validity mask
+SCAN_BLOCK_ELEMENTS = 1 << 16
+
+
+def resolve_colormap(cmap):
+    import matplotlib
+    from matplotlib.colors import LinearSegmentedColormap
+    if isinstance(cmap, str):
+        return matplotlib.colormaps[cmap]
+    if isinstance(cmap, (list, tuple)):
+        return LinearSegmentedColormap.from_list(name='custom1', colors=cmap)
+    return cmap
+
+
+def colormap_lut(cmap, lut_size=256):
+    cmap = resolve_colormap(cmap)
+    if cmap.N != lut_size:
+        cmap = cmap.resampled(lut_size)
+    return cmap(np.arange(lut_size), bytes=True)[:, :3]
+
+
+def scan(result, default=(0.0, 0.0), mask=True):
+    # (vmin, vmax, valid) of a 2-D result, reading it from memory once. fmin/fmax
+    # skip NaN without nanmin's all-NaN warning; only a block holding ±inf
+    # is reduced again over its finite values. valid marks the finite pixels,
+    # 8 to a byte along each row (np.packbits), with the padding bits of the
+    # last byte set, so a fully valid row is all 0xff; None with mask=False.
+    height, width = result.shape
+    valid = np.empty((height, (width + 7) // 8), dtype=np.uint8) if mask else None
+    vmin, vmax = np.inf, -np.inf
+    rows = max(1, SCAN_BLOCK_ELEMENTS // max(1, width))
+    for start in range(0, height, rows):
+        block = result[start:start + rows]
+        if mask:
+            valid[start:start + rows] = np.packbits(np.isfinite(block), axis=1)
+        low, high = np.fmin.reduce(block, axis=None), np.fmax.reduce(block, axis=None)
+        if not (np.isfinite(low) and np.isfinite(high)):
+            finite = block[np.isfinite(block)]
+            if not finite.size:
+                continue
+            low, high = finite.min(), finite.max()
+        vmin, vmax = min(vmin, float(low)), max(vmax, float(high))
+    if mask and width % 8:
+        valid[:, -1] |= 0xff >> (width % 8)
+    if vmin > vmax:
+        vmin, vmax = default
+    return vmin, vmax, valid
+
+
+def finite_range(result, default=(0.0, 0.0)):
+    vmin, vmax, _ = scan(result, (None, None), mask=False)
+    return default if vmin is None else (vmin, vmax)
+
+
+def invalid_pixels(valid, width):
+    # Boolean mask of the no-data pixels in rows of a packed validity mask,
+    # or None if there are none
+    if np.all(valid == 0xff):
+        return None
+    return np.unpackbits(valid, axis=1, count=width) == 0
+
+
+# Same colors as imshow + Normalize, but at native resolution and in row strips
+# so only one strip of float temporaries is alive at a time. NaN/inf -> bad_color,
+# the no-data color. With valid, the packed mask from scan, those pixels are
+# looked up there, and strips without any skip the no-data fixups altogether.
+def apply_lut(result, lut, vmin, vmax, bad_color=(255, 255, 255), out=None, valid=None):
+    lut_size = len(lut)
+    height, width = result.shape
+    image = np.empty((height, width, 3), dtype=np.uint8) if out is None else out
+    span = vmax - vmin
+    for start in range(0, height, RENDER_STRIP_ROWS):
+        block = result[start:start + RENDER_STRIP_ROWS]
+        out = image[start:start + RENDER_STRIP_ROWS]
+        if valid is None:
+            bad = ~np.isfinite(block)
+            if not bad.any():
+                bad = None
+        else:
+            bad = invalid_pixels(valid[start:start + RENDER_STRIP_ROWS], width)
+        # Keep the result's own precision for the strip, rounding the same way
+        # matplotlib's Normalize does (float64 arithmetic, stored back in place)
+        scaled = np.empty(block.shape, dtype=np.result_type(block.dtype, np.float32))
+        np.subtract(block, np.float64(vmin), out=scaled)
+        if np.isfinite(span) and span > 0:
+            scaled /= np.float64(span)
+        else:
+            scaled.fill(0)
+        scaled *= lut_size
+        if bad is not None:
+            scaled[bad] = 0
+        np.clip(scaled, 0, lut_size - 1, out=scaled)
+        np.take(lut, scaled.astype(np.intp), axis=0, out=out)
+        if bad is not None:
+            out[bad] = bad_color
+    return image
+
+
+def round_sig(value, digits=3):
+    return float(f'{value:.{digits}g}')
+
+
+def render_colorbar(cmap, label, vmin, vmax, width, height):
+    # A bare Figure rather than pyplot: no backend or figure manager to load,
+    # nothing global to close, and safe to draw from several request threads
+    from matplotlib.cm import ScalarMappable
+    from matplotlib.colors import Normalize
+    from matplotlib.figure import Figure
+    fig = Figure(figsize=(width / 100, 1))
+    ax = fig.subplots()
+    norm = Normalize(vmin=vmin, vmax=vmax)
+    cbar = fig.colorbar(ScalarMappable(norm=norm, cmap=resolve_colormap(cmap)), cax=ax, orientation='horizontal')
+    cbar.ax.tick_params(labelsize=10)
+    cbar.update_ticks()
+    cbar.set_label(label, fontsize=16, fontweight='bold', labelpad=-50)
+
+    buf = BytesIO()
+    fig.savefig(buf, format='png', dpi=600, bbox_inches='tight', pad_inches=0)
+    buf.seek(0)
+
+    colorbar_image = Image.open(buf).convert('RGB').resize((width, height))
+    return np.array(colorbar_image)
+
+
+class ColorbarCache:
+    # Colorbar strips only depend on (colormap, label, value range, size), so
+    # they are kept in a bounded LRU, with an optional on-disk tier shared
+    # between workers and restarts. The range is rounded to 3 significant
+    # digits for the key and the drawing alike.
+    def __init__(self):
+        self._strips = OrderedDict()
+        self._lock = threading.Lock()
+
+    def clear(self):
+        with self._lock:
+            self._strips.clear()
+
+    def get(self, colormap_name, cmap, label, vmin, vmax, width, height, max_entries=32, folder=None):
+        key = (colormap_name, label, round_sig(vmin), round_sig(vmax), width, height)
+        with self._lock:
+            strip = self._strips.get(key)
+            if strip is not None:
+                self._strips.move_to_end(key)
+                return strip
+
+        cache_path = None
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+            cache_path = os.path.join(folder, hashlib.sha1(repr(key).encode()).hexdigest() + '.png')
+            if os.path.exists(cache_path):
+                strip = np.array(Image.open(cache_path).convert('RGB'))
+
+        if strip is None:
+            strip = render_colorbar(cmap, label, key[2], key[3], width, height)
+            if cache_path:
+                tmp_path = f'{cache_path}.{os.getpid()}.tmp'
+                Image.fromarray(strip).save(tmp_path, format='png')
+                os.replace(tmp_path, cache_path)
+
+        strip.setflags(write=False)
+        with self._lock:
+            self._strips[key] = strip
+            self._strips.move_to_end(key)
+            while len(self._strips) > max_entries:
+                self._strips.popitem(last=False)
+        return strip
+
+
+def colorbar_footer(height, width, colorbar_image):
+    # Rows below an index image of the given height: a 1% white spacer, then
+    # the colorbar centered on white
+    space_height = int(height * 0.01)
+    footer = np.full((space_height + colorbar_image.shape[0], width, 3), 255, dtype=np.uint8)
+    x_offset = (width - colorbar_image.shape[1]) // 2
+    footer[space_height:, x_offset:x_offset + colorbar_image.shape[1]] = colorbar_image
+    return footer